@@ -0,0 +1,218 @@
+"""Asyncio engine: movies, genres and persons are loaded concurrently on one event loop."""
+import asyncio
+import json
+import logging
+import re
+from collections import deque
+from contextlib import AsyncExitStack
+from typing import AsyncIterator, Callable, Optional, Tuple
+
+import asyncpg
+from elasticsearch import AsyncElasticsearch
+from YamJam import yamjam
+
+from async_service import AsyncElasticSaverService, AsyncPostgresLoaderService
+from backoff import async_backoff
+from connections import elastic_options
+from elastic_schema import genres_index_schema, filmworks_index_schema, persons_index_schema
+from dead_letters import DeadLetterSpool
+from fingerprints import FingerprintStore
+from service import TransformDataService
+from settings import EtlSettings
+from snapshot import snapshot_pool
+from state_saver import create_state
+
+logger = logging.getLogger()
+
+StreamBatch = Tuple[Optional[tuple], Optional[dict]]
+
+
+def postgres_connect_options(postgres_dsn: dict) -> dict:
+    """Convert psycopg2 connection options from config.yaml to asyncpg ones."""
+    return {
+        'database': postgres_dsn['dbname'],
+        'user': postgres_dsn['user'],
+        'password': str(postgres_dsn['password']),
+        'host': postgres_dsn['host'],
+        'port': postgres_dsn['port'],
+        'server_settings': dict(re.findall(r'-c\s*(\w+)=(\S+)', postgres_dsn.get('options', ''))),
+    }
+
+
+async def init_postgres_connection(connection: asyncpg.Connection) -> None:
+    """Decode uuid as str and json as python objects, like psycopg2 does, so rows fit the same dataclasses."""
+    await connection.set_type_codec('uuid', encoder=str, decoder=str, schema='pg_catalog')
+    await connection.set_type_codec('json', encoder=json.dumps, decoder=json.loads, schema='pg_catalog')
+
+
+@async_backoff()
+async def create_postgres_pool(pool_size: int) -> asyncpg.Pool:
+    postgres_dsn = yamjam()['movies']['database']
+    try:
+        pool = await asyncpg.create_pool(
+            **postgres_connect_options(postgres_dsn),
+            min_size=1,
+            max_size=pool_size,
+            init=init_postgres_connection,
+        )
+        logger.info("Success connect to postgres.")
+        return pool
+    except Exception:
+        logger.info("Can not connect to postgres, retry later.")
+        raise
+
+
+@async_backoff()
+async def connect_async_elastic(settings: EtlSettings) -> AsyncElasticsearch:
+    es_dsn = yamjam()['elastic']['envs']
+    es = AsyncElasticsearch(
+        [es_dsn],
+        http_compress=settings.load.http_compress,
+        **elastic_options(settings.connections, asynchronous=True),
+    )
+    if await es.ping():
+        logger.info("Success connect to elastic")
+        return es
+    await es.close()
+    logger.info("Can not connect to elastic, retry later.")
+    raise Exception
+
+
+async def filmworks_batches(postgres_service: AsyncPostgresLoaderService) -> AsyncIterator[StreamBatch]:
+    while (batches := await postgres_service.load_filmworks_data()) is not None:
+        for batch in batches:
+            yield batch, None
+        yield None, dict(postgres_service.states_after_save)
+
+
+async def filmworks_documents_batches(postgres_service: AsyncPostgresLoaderService) -> AsyncIterator[StreamBatch]:
+    while (filmworks_documents := await postgres_service.load_filmworks_documents()) is not None:
+        yield (filmworks_documents,), dict(postgres_service.states_after_save)
+
+
+async def filmworks_persons_batches(postgres_service: AsyncPostgresLoaderService) -> AsyncIterator[StreamBatch]:
+    while (filmworks_persons := await postgres_service.load_filmworks_persons()) is not None:
+        yield (filmworks_persons,), dict(postgres_service.states_after_save)
+
+
+async def genres_batches(postgres_service: AsyncPostgresLoaderService) -> AsyncIterator[StreamBatch]:
+    while genres_data := await postgres_service.load_genres_data():
+        yield (genres_data,), dict(postgres_service.states_after_save)
+
+
+async def persons_batches(postgres_service: AsyncPostgresLoaderService) -> AsyncIterator[StreamBatch]:
+    while persons_data := await postgres_service.load_persons_data():
+        yield (persons_data,), dict(postgres_service.states_after_save)
+
+
+async def load_stream(
+    index_name: str,
+    batches: AsyncIterator[StreamBatch],
+    transform: Callable[..., list],
+    saver_service: AsyncElasticSaverService,
+    es: AsyncElasticsearch,
+    max_in_flight: int,
+    partial: bool = False,
+) -> None:
+    """Transform batches of one index and keep up to `max_in_flight` bulk requests running.
+
+    States are saved in extraction order, each one after its batch and all previous
+    batches were indexed.
+    """
+    in_flight = deque()
+
+    async def complete_oldest():
+        task, states = in_flight.popleft()
+        if task:
+            await task
+        if states:
+            saver_service.save_states(states)
+
+    try:
+        async for data, states in batches:
+            task = None
+            if data:
+                logger.info("Get %s data from postgres. Transformed to save to elastic..", index_name)
+                docs = transform(*data)
+                task = asyncio.ensure_future(saver_service.bulk_store(es, index_name, docs, partial))
+            in_flight.append((task, states))
+            while len(in_flight) > max_in_flight:
+                await complete_oldest()
+        while in_flight:
+            await complete_oldest()
+    finally:
+        for task, _ in in_flight:
+            if task:
+                task.cancel()
+
+
+async def async_load_from_postgres_to_elastic(settings: EtlSettings) -> None:
+    """Load movies, genres and persons concurrently, each stream with its own postgres connection."""
+
+    pool = await create_postgres_pool(settings.async_engine.pool_size)
+    es = await connect_async_elastic(settings)
+    try:
+        state_loader = create_state(settings.state.storage, settings.state.path)
+        service = AsyncElasticSaverService(
+            state_loader,
+            chunk_size=settings.load.chunk_size,
+            max_chunk_bytes=settings.load.max_chunk_bytes,
+            max_retries=settings.load.max_retries,
+            propagate_genre_renames=settings.extract.propagate_genre_renames,
+            fingerprints=FingerprintStore(settings.fingerprints.path) if settings.fingerprints.enabled else None,
+            dead_letters=DeadLetterSpool(settings.dead_letters.directory) if settings.dead_letters.enabled else None,
+        )
+        await asyncio.gather(
+            service.create_index(es, 'movies', filmworks_index_schema),
+            service.create_index(es, 'genres', genres_index_schema),
+            service.create_index(es, 'persons', persons_index_schema),
+        )
+
+        transform_service = TransformDataService(**settings.transform.dict())
+        if settings.extract.denormalized:
+            movies_stream = (
+                'movies', filmworks_documents_batches, transform_service.transform_filmworks_documents, False,
+            )
+        else:
+            movies_stream = ('movies', filmworks_batches, transform_service.transform_filmworks_data, False)
+        streams = [
+            movies_stream,
+            # Persons state is moved either by movies stream or, once films are loaded, by this one.
+            ('movies', filmworks_persons_batches, transform_service.transform_filmworks_persons, True),
+            ('genres', genres_batches, transform_service.transform_genres_data, False),
+            ('persons', persons_batches, transform_service.transform_persons_data, False),
+        ]
+        async with AsyncExitStack() as stack:
+            source = pool
+            if settings.extract.consistent_snapshot:
+                # Streams read one snapshot, so documents of all indices agree with each other.
+                source = await stack.enter_async_context(snapshot_pool(pool, settings.async_engine.pool_size))
+            tasks = [
+                asyncio.ensure_future(load_stream(
+                    index_name,
+                    batches(AsyncPostgresLoaderService(
+                        source,
+                        itersize=settings.extract.itersize,
+                        state_loader=state_loader,
+                        genre_batch_size=settings.batch_size.genre,
+                        person_batch_size=settings.batch_size.person,
+                        propagate_genre_renames=settings.extract.propagate_genre_renames,
+                        partial_person_updates=settings.extract.partial_person_updates,
+                    )),
+                    transform,
+                    service,
+                    es,
+                    settings.async_engine.max_in_flight,
+                    partial,
+                ))
+                for index_name, batches, transform, partial in streams
+            ]
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            for task in done:
+                task.result()
+    finally:
+        await es.close()
+        await pool.close()
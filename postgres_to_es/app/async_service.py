@@ -0,0 +1,321 @@
+"""Asyncio service to load data from postgres to elasticsearch."""
+import asyncio
+import logging
+import time
+from datetime import datetime
+from itertools import islice
+from typing import Dict, List, Optional, Tuple, Union
+
+from asyncpg import Pool
+from elasticsearch import AsyncElasticsearch
+from elasticsearch.helpers import async_streaming_bulk
+
+from backoff import async_backoff, exponential_sleep_generator
+from dead_letters import DeadLetterSpool
+from fingerprints import FingerprintStore
+from metrics import METRICS, record_stage, stage
+from postgres_data_query import (
+    filmworks_additional_query,
+    filmworks_by_genre,
+    filmworks_by_person,
+    filmworks_documents_query,
+    filmworks_persons_documents_query,
+    filmworks_persons_by_ids_query,
+    genres_query,
+    genres_data_query,
+    persons_query,
+    persons_documents_query,
+)
+from postgres_schemas import (
+    MovieData,
+    PersonFilm,
+    GenreData,
+    PersonDocument,
+    FilmworkDocument,
+    FilmworkPersons,
+)
+from service import (
+    BASE_STATE,
+    RETRY_STATUSES,
+    BaseLoaderService,
+    BulkResult,
+    changed_documents,
+    dead_letter_failures,
+    genre_rename_query,
+)
+from snapshot import SnapshotPool
+from state_saver import State
+
+logger = logging.getLogger()
+
+
+class AsyncPostgresLoaderService(BaseLoaderService):
+    """Load data from postgres with asyncpg.
+
+    Every instance remembers its own extracted states, so movies, genres and persons
+    may be loaded concurrently by separate instances sharing one pool.
+    Instances sharing a snapshot pool read the database at one point in time.
+    """
+
+    def __init__(self, pool: Union[Pool, SnapshotPool], itersize: int = 1000, **kwargs):
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.itersize = itersize
+
+    def _state_params(self, state_key: str, limit: int) -> tuple:
+        """Get query parameters of the page after saved state, asyncpg binds timestamps as datetime."""
+        updated_at, last_id = self._extract_state(state_key)
+        if updated_at == BASE_STATE:
+            return datetime.min, last_id, limit
+        return datetime.fromisoformat(updated_at), last_id, limit
+
+    async def _changed_ids(self, state_key: str, query: str, limit: int) -> List[str]:
+        """Get ids changed since saved state and remember state to save after load."""
+        changed_data = await self.pool.fetch(query, *self._state_params(state_key, limit))
+        if changed_data:
+            self._remember_state(state_key, changed_data[-1][1], changed_data[-1][0])
+        return [item[0] for item in changed_data]
+
+    async def _changed_genres_ids(self) -> List[str]:
+        """Get ids of changed genres to reload their films."""
+        genres_ids = await self._changed_ids('genres_state', genres_query, self.genre_batch_size)
+        return self._ids_to_reload('genres_state', genres_ids, self.propagate_genre_renames)
+
+    async def _changed_persons_ids(self) -> List[str]:
+        """Get ids of changed persons to reload their films."""
+        if self.partial_person_updates and self.films_loaded['persons_state']:
+            # Changes are left to load_filmworks_persons, which moves the state then.
+            return []
+        persons_ids = await self._changed_ids('persons_state', persons_query, self.person_batch_size)
+        return self._ids_to_reload('persons_state', persons_ids, self.partial_person_updates)
+
+    @stage('extract')
+    @async_backoff()
+    async def load_filmworks_data(self) -> Optional[List[Tuple[List[MovieData], List[PersonFilm]]]]:
+        """Load raw filmworks data changed since saved state, split to batches of `itersize` films.
+
+        Return None if there are no changed genres and persons.
+        """
+
+        genres_ids = await self._changed_genres_ids()
+        persons_ids = await self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
+
+        film_ids = []
+        if genres_ids:
+            film_ids.extend(record[0] for record in await self.pool.fetch(filmworks_by_genre, genres_ids))
+        if persons_ids:
+            film_ids.extend(record[0] for record in await self.pool.fetch(filmworks_by_person, persons_ids))
+
+        batches = []
+        film_ids = iter(dict.fromkeys(film_ids))
+        while filmworks_ids := list(islice(film_ids, self.itersize)):
+            person_film_data, film_work_data = await asyncio.gather(
+                self.pool.fetch(filmworks_persons_by_ids_query, filmworks_ids),
+                self.pool.fetch(filmworks_additional_query, filmworks_ids),
+            )
+            batches.append((
+                [MovieData(*item) for item in film_work_data],
+                [PersonFilm(*item) for item in person_film_data],
+            ))
+        return batches
+
+    @stage('extract')
+    @async_backoff()
+    async def load_filmworks_documents(self) -> Optional[List[FilmworkDocument]]:
+        """Load filmwork documents aggregated by postgres, one row per film.
+
+        Return None if there are no changed genres and persons.
+        """
+
+        genres_ids = await self._changed_genres_ids()
+        persons_ids = await self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
+
+        raw_documents = await self.pool.fetch(filmworks_documents_query, genres_ids, persons_ids, [])
+        return [FilmworkDocument(*item) for item in raw_documents]
+
+    @stage('extract')
+    @async_backoff()
+    async def load_filmworks_persons(self) -> Optional[List[FilmworkPersons]]:
+        """Load cast of films of changed persons, see PostgresLoaderService.load_filmworks_persons."""
+        if not self.partial_person_updates or not self.films_loaded['persons_state']:
+            return None
+        persons_ids = await self._changed_ids('persons_state', persons_query, self.person_batch_size)
+        if not persons_ids:
+            return None
+        raw_filmworks_persons = await self.pool.fetch(filmworks_persons_documents_query, persons_ids)
+        return [FilmworkPersons(*item) for item in raw_filmworks_persons]
+
+    @stage('extract')
+    @async_backoff()
+    async def load_genres_data(self) -> List[GenreData]:
+        """Load genres data from postgres."""
+        params = self._state_params('genres_data_state', self.genre_batch_size)
+        raw_genres_data = await self.pool.fetch(genres_data_query, *params)
+        if raw_genres_data:
+            self._remember_state('genres_data_state', raw_genres_data[-1][-1], raw_genres_data[-1][0])
+
+        return [GenreData(*item) for item in raw_genres_data]
+
+    @stage('extract')
+    @async_backoff()
+    async def load_persons_data(self) -> List[PersonDocument]:
+        """Load persons documents aggregated by postgres."""
+        params = self._state_params('persons_data_state', self.person_batch_size)
+        persons_documents = [PersonDocument(*item) for item in await self.pool.fetch(persons_documents_query, *params)]
+        if persons_documents:
+            self._remember_state('persons_data_state', persons_documents[-1].updated_at, persons_documents[-1].id)
+        return persons_documents
+
+
+class AsyncElasticSaverService:
+    """Save data from postgres to elastic with AsyncElasticsearch."""
+
+    def __init__(
+        self,
+        state_loader: State,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 100 * 1024 * 1024,
+        max_retries: int = 3,
+        propagate_genre_renames: bool = False,
+        fingerprints: Optional[FingerprintStore] = None,
+        dead_letters: Optional[DeadLetterSpool] = None,
+    ):
+        self.state_loader = state_loader
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.propagate_genre_renames = propagate_genre_renames
+        self.fingerprints = fingerprints
+        self.dead_letters = dead_letters
+
+    @async_backoff()
+    async def create_index(self, es: AsyncElasticsearch, index_name: str, index_settings: dict) -> bool:
+        """Create index if not exist."""
+        if not await es.indices.exists(index=index_name):
+            # Ignore 400 means to ignore "Index Already Exist" error.
+            await es.indices.create(index=index_name, ignore=400, body=index_settings)
+            logger.info('Index created')
+            if self.fingerprints:
+                self.fingerprints.forget(index_name)
+        return True
+
+    def gendata(self, index_name: str, docs: List[dict], partial: bool = False) -> dict:
+        for doc in docs:
+            if partial:
+                yield {
+                    "_op_type": "update",
+                    "_index": index_name,
+                    "_id": doc['id'],
+                    "doc": doc
+                }
+                continue
+            yield {
+                "_index": index_name,
+                "_id": doc['id'],
+                "_source": doc
+            }
+
+    @async_backoff()
+    async def rename_genres(self, es: AsyncElasticsearch, genres_docs: List[dict]) -> None:
+        """Apply renames of genres to movies in elastic, see ElasticSaverService.rename_genres."""
+        names = {doc['id']: doc['name'] for doc in genres_docs}
+        saved_genres = await es.mget(index='genres', body={'ids': list(names)}, _source_includes=['name'])
+        for genre in saved_genres['docs']:
+            if not genre.get('found') or genre['_source']['name'] == names[genre['_id']]:
+                continue
+            old_name, new_name = genre['_source']['name'], names[genre['_id']]
+            result = await es.update_by_query(
+                index='movies',
+                body=genre_rename_query(old_name, new_name),
+                slices='auto',
+                refresh=True,
+            )
+            if self.fingerprints:
+                self.fingerprints.forget('movies')
+            if result.get('failures'):
+                raise Exception('Rename of genre {0} failed: {1}'.format(old_name, result['failures'][:10]))
+            logger.info('Genre %s renamed to %s in %s movies.', old_name, new_name, result.get('updated'))
+
+    @async_backoff()
+    async def _send_bulk(
+        self,
+        es: AsyncElasticsearch,
+        index_name: str,
+        docs: List[dict],
+        partial: bool = False,
+    ) -> Tuple[int, List[dict]]:
+        """Send documents with bulk requests, return count of indexed documents and failed items."""
+        success = 0
+        failed_items = []
+        results = async_streaming_bulk(
+            es,
+            self.gendata(index_name, docs, partial),
+            chunk_size=self.chunk_size,
+            max_chunk_bytes=self.max_chunk_bytes,
+            raise_on_error=False,
+        )
+        async for ok, item in results:
+            if ok:
+                success += 1
+            else:
+                failed_items.append(item)
+        return success, failed_items
+
+    async def bulk_store(
+        self,
+        es: AsyncElasticsearch,
+        index_name: str,
+        list_of_record: List[dict],
+        partial: bool = False,
+    ) -> BulkResult:
+        """Index documents, see ElasticSaverService.bulk_store.
+
+        States are not saved here, batches of one stream may finish out of order.
+        """
+        started = time.perf_counter()
+        if index_name == 'genres' and self.propagate_genre_renames and list_of_record:
+            await self.rename_genres(es, list_of_record)
+
+        docs, fingerprints = changed_documents(self.fingerprints, index_name, list_of_record, partial)
+        sent_docs = {doc['id']: doc for doc in docs}
+        result = BulkResult(success=0, failed=0, errors=[])
+        sleep_generator = exponential_sleep_generator(0.1, 2, 10)
+        missing = 0
+        for attempt in range(self.max_retries + 1):
+            success, failed_items = await self._send_bulk(es, index_name, docs, partial)
+            result.success += success
+
+            docs_by_id: Dict[str, dict] = {doc['id']: doc for doc in docs}
+            docs = []
+            for item in failed_items:
+                info = next(iter(item.values()))
+                if partial and info.get('status') == 404:
+                    missing += 1
+                elif info.get('status') in RETRY_STATUSES and attempt < self.max_retries:
+                    docs.append(docs_by_id[info['_id']])
+                else:
+                    result.failed += 1
+                    result.errors.append(info)
+            if not docs:
+                break
+            METRICS.inc('etl_bulk_rejected_total', len(docs), index=index_name)
+            logger.info('%s documents rejected by elastic, retry them.', len(docs))
+            await asyncio.sleep(next(sleep_generator))
+
+        record_stage('load', 'bulk_store', time.perf_counter() - started, result.success)
+        METRICS.inc('etl_bulk_failed_total', result.failed, index=index_name)
+        logger.info('Load to %s: %s documents indexed, %s failed.', index_name, result.success, result.failed)
+        if missing:
+            logger.info('%s partial documents skipped, they are missing in %s.', missing, index_name)
+        dead_letter_failures(self.dead_letters, index_name, result, sent_docs, fingerprints, partial)
+        if self.fingerprints:
+            self.fingerprints.save(index_name, fingerprints)
+        return result
+
+    def save_states(self, states: dict) -> None:
+        """Save states of loaded data with one commit."""
+        self.state_loader.set_states(states)
@@ -1,30 +1,78 @@
+import asyncio
 import functools
 import logging
 import random
 import time
+from threading import Event
+from typing import Optional
 
 logger = logging.getLogger()
 
 
-def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
-    """Exponential time decorator to make retries if service is not allowed."""
+class StopEvent(Event):
+    """Shutdown request, calls in flight when it is set are still retried for `grace_period` seconds."""
 
-    def exponential_sleep_generator(start_time, factor_incr, border_time):
-        """Generates sleep intervals based on the exponential back-off algorithm."""
-        delay = start_time
-        while True:
-            yield min(random.uniform(0.0, delay * 2.0), border_time)
-            delay = delay * factor_incr
+    def __init__(self, grace_period: float = 30.0):
+        super().__init__()
+        self.grace_period = grace_period
+        self.deadline: Optional[float] = None
+
+    def set(self) -> None:
+        if self.deadline is None:
+            self.deadline = time.monotonic() + self.grace_period
+        super().set()
+
+    def clear(self) -> None:
+        self.deadline = None
+        super().clear()
+
+
+# Set on shutdown, then failed calls are retried only until its grace period is over.
+STOP_EVENT = StopEvent()
+
+
+class NotRetriedError(Exception):
+    """Error retries can not fix, backoff raises it at once."""
+
+
+def grace_left(stop_event: Event) -> float:
+    """Seconds failed calls are still retried for after `stop_event` was set, plain events give no grace."""
+    deadline = getattr(stop_event, 'deadline', None)
+    return max(deadline - time.monotonic(), 0.0) if deadline is not None else 0.0
+
+
+def exponential_sleep_generator(start_time, factor_incr, border_time):
+    """Generates sleep intervals based on the exponential back-off algorithm."""
+    delay = start_time
+    while True:
+        yield min(random.uniform(0.0, delay * 2.0), border_time)
+        delay = delay * factor_incr
+
+
+def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10, stop_event: Optional[Event] = None):
+    """Exponential time decorator to make retries if service is not allowed.
+
+    Retries are given up once `stop_event`, STOP_EVENT by default, is set and its grace period
+    is over, waiting for a retry is cut by it.
+    """
 
     def retry_target(target, sleep_generator):
         """Call a function and retry if it fails."""
 
+        stop = stop_event or STOP_EVENT
         for sleep in sleep_generator:
             try:
                 return target()
+            except NotRetriedError:
+                raise
             except Exception as exc:
+                if stop.is_set() and not grace_left(stop):
+                    raise
                 logger.info('Service unavailable. will retry. Exception %s', str(exc))
-                time.sleep(sleep)
+                if stop.is_set():
+                    time.sleep(min(sleep, grace_left(stop)))
+                elif stop.wait(sleep) and not grace_left(stop):
+                    raise
 
         raise ValueError("Sleep generator stopped yielding sleep values.")
 
@@ -39,3 +87,31 @@ def backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
         return wrapped
 
     return func_wrapper
+
+
+def async_backoff(start_sleep_time=0.1, factor=2, border_sleep_time=10):
+    """Exponential time decorator for coroutines, sleeps without blocking event loop.
+
+    Retries are given up once STOP_EVENT is set and its grace period is over.
+    """
+
+    def func_wrapper(func):
+        @functools.wraps(func)
+        async def wrapped(*args, **kwargs):
+            """A wrapper that awaits target coroutine with retry."""
+            for sleep in exponential_sleep_generator(start_sleep_time, factor, border_sleep_time):
+                try:
+                    return await func(*args, **kwargs)
+                except NotRetriedError:
+                    raise
+                except Exception as exc:
+                    if STOP_EVENT.is_set() and not grace_left(STOP_EVENT):
+                        raise
+                    logger.info('Service unavailable. will retry. Exception %s', str(exc))
+                    await asyncio.sleep(min(sleep, grace_left(STOP_EVENT)) if STOP_EVENT.is_set() else sleep)
+
+            raise ValueError("Sleep generator stopped yielding sleep values.")
+
+        return wrapped
+
+    return func_wrapper
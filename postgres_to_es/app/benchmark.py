@@ -0,0 +1,286 @@
+"""Benchmarks of transforms and of whole loads, run against synthetic data without production services.
+
+    python app/benchmark.py generate --films 100000
+    python app/benchmark.py transform --films 10000
+    python app/benchmark.py e2e --engine pipeline
+
+`generate` fills postgres from config.yaml with a synthetic catalog, `e2e` loads it to a local fake
+bulk endpoint with in-memory state, so saved states and real indices are not touched.
+"""
+import argparse
+import json
+import logging.config
+import multiprocessing
+import resource
+import socket
+import statistics
+import threading
+import time
+import tracemalloc
+import types
+from collections import defaultdict
+from os import path
+from typing import Callable, Dict, Iterable, List, Optional
+
+from elasticsearch import Elasticsearch
+
+from connections import elastic_options
+from fake_bulk import serve
+from load_data import INDEX_SCHEMAS, connect_to_postgres, create_postgres_pool, create_services, run_load
+from service import TransformDataService
+from settings import EtlSettings, load_settings
+from state_saver import create_state
+from synthetic_data import SyntheticCatalog, load_catalog
+
+logger = logging.getLogger()
+
+# Methods loads call on services, timed as stages of end-to-end runs.
+STAGE_METHODS = {
+    'extract': (
+        'load_filmworks_data',
+        'load_filmworks_documents',
+        'load_filmworks_persons',
+        'load_genres_data',
+        'load_persons_data',
+        'stream_filmworks_data',
+        'stream_filmworks_documents',
+        'stream_genres_data',
+        'stream_persons_data',
+    ),
+    'transform': (
+        'transform_filmworks_data',
+        'transform_filmworks_documents',
+        'transform_filmworks_persons',
+        'transform_genres_data',
+        'transform_persons_data',
+    ),
+    'load': ('bulk_store', 'rename_genres'),
+}
+
+
+def latency_summary(latencies: List[float]) -> dict:
+    """Total, median, 95th percentile and maximal latency in milliseconds."""
+    if not latencies:
+        return {'calls': 0}
+    ordered = sorted(latencies)
+    return {
+        'calls': len(ordered),
+        'total_ms': round(sum(ordered) * 1000, 3),
+        'p50_ms': round(statistics.median(ordered) * 1000, 3),
+        'p95_ms': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))] * 1000, 3),
+        'max_ms': round(ordered[-1] * 1000, 3),
+    }
+
+
+def peak_rss_mb() -> float:
+    """Peak resident memory of the process, linux reports it in kilobytes."""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+class StageTimer:
+    """Latencies of service calls by stage, collected from threads of pipeline engine too.
+
+    Iterators returned by streaming methods are timed while they are consumed.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+
+    def add(self, stage: str, latency: float) -> None:
+        with self.lock:
+            self.latencies[stage].append(latency)
+
+    def _timed_iterator(self, stage: str, iterator: Iterable) -> Iterable:
+        iterator = iter(iterator)
+        while True:
+            started = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                self.add(stage, time.perf_counter() - started)
+            yield item
+
+    def _timed_result(self, stage: str, result):
+        if isinstance(result, types.GeneratorType):
+            return self._timed_iterator(stage, result)
+        if isinstance(result, tuple):
+            return tuple(self._timed_result(stage, item) for item in result)
+        return result
+
+    def wrap(self, stage: str, method: Callable) -> Callable:
+        def timed(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return self._timed_result(stage, method(*args, **kwargs))
+            finally:
+                self.add(stage, time.perf_counter() - started)
+
+        return timed
+
+    def instrument(self, *services) -> None:
+        """Replace methods of stages by timed ones on service instances."""
+        for stage, names in STAGE_METHODS.items():
+            for service in services:
+                for name in names:
+                    if hasattr(service, name):
+                        setattr(service, name, self.wrap(stage, getattr(service, name)))
+
+    def summary(self) -> dict:
+        return {stage: latency_summary(self.latencies.get(stage, [])) for stage in STAGE_METHODS}
+
+
+def transform_cases(catalog: SyntheticCatalog, batch_size: int) -> Dict[str, Callable[[TransformDataService], list]]:
+    """Inputs of every transform function, prepared in advance, as calls producing documents of all batches."""
+    batches = [(start, start + batch_size) for start in range(0, catalog.films, batch_size)]
+    movie_data = [catalog.movie_data(*batch) for batch in batches]
+    documents = [catalog.filmwork_documents(*batch) for batch in batches]
+    filmworks_persons = [catalog.filmworks_persons(*batch) for batch in batches]
+    persons_data = [catalog.persons_data(*batch) for batch in batches]
+    genres_data = catalog.genres_data()
+    return {
+        'transform_filmworks_data': lambda service: [service.transform_filmworks_data(*data) for data in movie_data],
+        'transform_filmworks_documents': lambda service: [
+            service.transform_filmworks_documents(data) for data in documents
+        ],
+        'transform_filmworks_persons': lambda service: [
+            service.transform_filmworks_persons(data) for data in filmworks_persons
+        ],
+        'transform_genres_data': lambda service: [service.transform_genres_data(genres_data)],
+        'transform_persons_data': lambda service: [service.transform_persons_data(data) for data in persons_data],
+    }
+
+
+def benchmark_transforms(films: int, seed: int, batch_size: int, repeat: int, settings: EtlSettings) -> dict:
+    """Time every transform function on batches of synthetic films.
+
+    Rows per second are taken from the best of `repeat` runs, peak memory from one more run
+    traced by tracemalloc, as tracing slows down the code it traces.
+    """
+    catalog = SyntheticCatalog(films, seed)
+    service = TransformDataService(**settings.transform.dict())
+    results = {}
+    for name, case in transform_cases(catalog, batch_size).items():
+        timer = StageTimer()
+        case_service = TransformDataService(**settings.transform.dict())
+        timer.instrument(case_service)
+        runs = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            docs = sum(len(batch) for batch in case(case_service))
+            runs.append(time.perf_counter() - started)
+
+        tracemalloc.start()
+        case(service)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        results[name] = {
+            'rows': docs,
+            'rows_per_second': round(docs / min(runs)),
+            'best_seconds': round(min(runs), 4),
+            'peak_memory_mb': round(peak / 1024 / 1024, 2),
+            'batch_latency': latency_summary(timer.latencies['transform']),
+        }
+        logger.info('%s: %s rows/s', name, results[name]['rows_per_second'])
+    return results
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def benchmark_load(settings: EtlSettings, engine: str, latency: float = 0.0) -> dict:
+    """Load whole postgres database to fake bulk endpoint served by another process.
+
+    States are kept in memory, so every run loads all data from the beginning.
+    """
+    port = free_port()
+    server = multiprocessing.get_context('spawn').Process(target=serve, args=('127.0.0.1', port, latency), daemon=True)
+    server.start()
+    pool = create_postgres_pool(settings)
+    es = Elasticsearch([{'host': '127.0.0.1', 'port': port}], **elastic_options(settings.connections))
+    try:
+        while not es.ping():
+            time.sleep(0.1)
+        settings = settings.copy(deep=True)
+        settings.fingerprints.enabled = False
+        postgres_service, service = create_services(pool, settings, create_state('memory'))
+        transform_service = TransformDataService(**settings.transform.dict())
+        for index_name, index_settings in INDEX_SCHEMAS.items():
+            service.create_index(es, index_name, index_settings)
+
+        timer = StageTimer()
+        timer.instrument(postgres_service, transform_service, service)
+        started = time.perf_counter()
+        try:
+            run_load(postgres_service, transform_service, service, es, settings, engine)
+        finally:
+            postgres_service.release()
+        seconds = time.perf_counter() - started
+        stats = es.transport.perform_request('GET', '/_fake/stats')
+    finally:
+        es.close()
+        pool.closeall()
+        server.terminate()
+        server.join()
+
+    actions = sum(stats['actions'].values())
+    return {
+        'engine': engine,
+        'seconds': round(seconds, 3),
+        'actions': stats['actions'],
+        'rows_per_second': round(actions / seconds),
+        'bulk_requests': stats['requests'],
+        'bulk_megabytes': round(stats['bytes'] / 1024 / 1024, 2),
+        'peak_rss_mb': peak_rss_mb(),
+        'stages': timer.summary(),
+    }
+
+
+def report(results: dict, output: Optional[str] = None) -> None:
+    text = json.dumps(results, indent=2)
+    print(text)
+    if output:
+        with open(output, 'w') as file:
+            file.write(text)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark ETL on synthetic data.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    generate = subparsers.add_parser('generate', help='fill postgres with synthetic catalog')
+    generate.add_argument('--films', type=int, default=10000)
+    generate.add_argument('--seed', type=int, default=0)
+    generate.add_argument('--truncate', action='store_true', help='replace data of content tables')
+    transform = subparsers.add_parser('transform', help='micro-benchmarks of transform functions')
+    transform.add_argument('--films', type=int, default=10000)
+    transform.add_argument('--seed', type=int, default=0)
+    transform.add_argument('--batch-size', type=int, default=1000)
+    transform.add_argument('--repeat', type=int, default=3)
+    transform.add_argument('--output', help='also write results to this json file')
+    e2e = subparsers.add_parser('e2e', help='load postgres to fake bulk endpoint')
+    e2e.add_argument('--engine', choices=['sequential', 'pipeline'], default='sequential')
+    e2e.add_argument('--latency', type=float, default=0.0, help='seconds every bulk request takes')
+    e2e.add_argument('--output', help='also write results to this json file')
+    args = parser.parse_args()
+
+    log_file_path = path.join(path.dirname(path.abspath(__file__)), 'logging.conf')
+    logging.config.fileConfig(log_file_path)
+
+    settings = load_settings()
+
+    if args.command == 'generate':
+        pg_conn = connect_to_postgres()
+        try:
+            load_catalog(pg_conn, SyntheticCatalog(args.films, args.seed), args.truncate)
+        finally:
+            pg_conn.close()
+    elif args.command == 'transform':
+        report(benchmark_transforms(args.films, args.seed, args.batch_size, args.repeat, settings), args.output)
+    else:
+        report(benchmark_load(settings, args.engine, args.latency), args.output)
@@ -0,0 +1,50 @@
+"""Bulk request bodies serialized once to NDJSON with orjson."""
+from typing import Iterable, Iterator, Optional
+
+import orjson
+
+NEWLINE = b'\n'
+
+
+class NdjsonBulkWriter:
+    """Append bulk actions to a byte buffer and cut it into raw `_bulk` bodies.
+
+    Every document is serialized once, a body is cut when the next document would not fit
+    into `max_chunk_bytes` or the body already has `chunk_size` documents.
+    Buffer belongs to one call of `bodies`, so the writer may be shared by threads.
+    """
+
+    def __init__(self, chunk_size: int = 500, max_chunk_bytes: int = 100 * 1024 * 1024):
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+
+    def bodies(
+        self,
+        index_name: str,
+        docs: Iterable[dict],
+        partial: bool = False,
+        chunk_size: Optional[int] = None,
+    ) -> Iterator[bytes]:
+        """Yield `_bulk` bodies indexing documents to `index_name`, or updating their fields if `partial`.
+
+        Bodies have up to `chunk_size` documents, writer `chunk_size` by default.
+        """
+        chunk_size = chunk_size or self.chunk_size
+        op_type = 'update' if partial else 'index'
+        buffer = bytearray()
+        count = 0
+        for doc in docs:
+            action = orjson.dumps({op_type: {'_index': index_name, '_id': doc['id']}})
+            source = orjson.dumps({'doc': doc} if partial else doc)
+            size = len(action) + len(source) + 2
+            if count and (count >= chunk_size or len(buffer) + size > self.max_chunk_bytes):
+                yield bytes(buffer)
+                buffer.clear()
+                count = 0
+            buffer += action
+            buffer += NEWLINE
+            buffer += source
+            buffer += NEWLINE
+            count += 1
+        if count:
+            yield bytes(buffer)
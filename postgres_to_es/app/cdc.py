@@ -0,0 +1,185 @@
+"""Change data capture: postgres triggers notify about changed rows, the listener indexes them within seconds."""
+import json
+import logging
+import select
+import time
+from dataclasses import dataclass, field
+from typing import Optional, Set
+
+from elasticsearch import Elasticsearch
+from psycopg2 import sql
+
+from service import ElasticSaverService, PostgresLoaderService, TransformDataService
+
+logger = logging.getLogger()
+
+# Tables whose changes are captured, every one of them affects some elastic documents.
+CAPTURED_TABLES = ('genre', 'person', 'film_work', 'genre_film_work', 'person_film_work')
+
+notify_change_function = """
+            CREATE OR REPLACE FUNCTION content.etl_notify_change() RETURNS trigger AS $$
+            DECLARE
+                row_data jsonb;
+            BEGIN
+                IF TG_OP = 'DELETE' THEN
+                    row_data := to_jsonb(OLD);
+                ELSE
+                    row_data := to_jsonb(NEW);
+                END IF;
+                PERFORM pg_notify(TG_ARGV[0], json_strip_nulls(json_build_object(
+                    'table', TG_TABLE_NAME,
+                    'id', row_data->>'id',
+                    'film_work_id', row_data->>'film_work_id',
+                    'person_id', row_data->>'person_id'
+                ))::text);
+                RETURN NULL;
+            END;
+            $$ LANGUAGE plpgsql;
+        """
+
+
+@dataclass
+class ChangeSet:
+    """Ids of rows changed within one window, grouped by the documents they affect."""
+
+    # Genres and persons are reindexed themselves with the movies they belong to.
+    genres_ids: Set[str] = field(default_factory=set)
+    persons_ids: Set[str] = field(default_factory=set)
+    filmworks_ids: Set[str] = field(default_factory=set)
+    # Persons whose film roles changed, only their own documents are reindexed.
+    linked_persons_ids: Set[str] = field(default_factory=set)
+
+    def add(self, change: dict) -> None:
+        table = change['table']
+        if table == 'genre':
+            self.genres_ids.add(change['id'])
+        elif table == 'person':
+            self.persons_ids.add(change['id'])
+        elif table == 'film_work':
+            self.filmworks_ids.add(change['id'])
+        elif table == 'genre_film_work':
+            self.filmworks_ids.add(change['film_work_id'])
+        elif table == 'person_film_work':
+            self.filmworks_ids.add(change['film_work_id'])
+            self.linked_persons_ids.add(change['person_id'])
+
+    def __len__(self) -> int:
+        return len(self.genres_ids) + len(self.persons_ids) + len(self.filmworks_ids) + len(self.linked_persons_ids)
+
+
+def install_triggers(connection, channel: str) -> None:
+    """Create triggers notifying `channel` about changes of captured tables, existing ones are replaced."""
+    with connection.cursor() as cursor:
+        cursor.execute(notify_change_function)
+        for table in CAPTURED_TABLES:
+            trigger_params = {'table': sql.Identifier('content', table), 'channel': sql.Literal(channel)}
+            cursor.execute(sql.SQL('DROP TRIGGER IF EXISTS etl_notify_change ON {table}').format(**trigger_params))
+            cursor.execute(sql.SQL(
+                'CREATE TRIGGER etl_notify_change AFTER INSERT OR UPDATE OR DELETE ON {table} '
+                'FOR EACH ROW EXECUTE FUNCTION content.etl_notify_change({channel})'
+            ).format(**trigger_params))
+    connection.commit()
+    logger.info('Change notification triggers installed.')
+
+
+class ChangeListener:
+    """Receive change notifications and coalesce them to change sets.
+
+    Connection has to be in autocommit mode, postgres delivers notifications only between transactions.
+    """
+
+    def __init__(self, connection, channel: str, window: float = 1.0, max_ids: int = 1000):
+        self.connection = connection
+        self.channel = channel
+        self.window = window
+        self.max_ids = max_ids
+
+    def listen(self) -> None:
+        with self.connection.cursor() as cursor:
+            cursor.execute(sql.SQL('LISTEN {0}').format(sql.Identifier(self.channel)))
+        logger.info('Listen to changes on %s channel.', self.channel)
+
+    def _poll(self, changes: ChangeSet, timeout: float) -> None:
+        """Wait up to `timeout` seconds for notifications and add them to changes."""
+        if not self.connection.notifies:
+            select.select([self.connection], [], [], max(timeout, 0))
+            self.connection.poll()
+        while self.connection.notifies:
+            notify = self.connection.notifies.pop(0)
+            changes.add(json.loads(notify.payload))
+
+    def get_changes(self, timeout: float) -> Optional[ChangeSet]:
+        """Wait up to `timeout` seconds for the first change, then collect changes for `window` seconds.
+
+        Collection stops earlier if `max_ids` ids are collected. Return None if nothing changed.
+        """
+        changes = ChangeSet()
+        self._poll(changes, timeout)
+        if not changes:
+            return None
+
+        window_end = time.monotonic() + self.window
+        while len(changes) < self.max_ids and (remaining := window_end - time.monotonic()) > 0:
+            self._poll(changes, remaining)
+        return changes
+
+
+def index_changes(
+    changes: ChangeSet,
+    postgres_service: PostgresLoaderService,
+    transform_service: TransformDataService,
+    service: ElasticSaverService,
+    es: Elasticsearch,
+) -> None:
+    """Reindex documents affected by changes through the usual transform and bulk path.
+
+    Documents of deleted rows are deleted from elastic.
+    States are not saved here, they are moved by the catch-up load.
+    """
+
+    films_loaded = postgres_service.films_loaded
+    genres_ids = list(changes.genres_ids)
+    changed_persons_ids = list(changes.persons_ids)
+    partial_person_updates = postgres_service.partial_person_updates and films_loaded['persons_state']
+    filmworks_batches = postgres_service.stream_filmworks_documents_by_ids(
+        [] if postgres_service.propagate_genre_renames and films_loaded['genres_state'] else genres_ids,
+        [] if partial_person_updates else changed_persons_ids,
+        list(changes.filmworks_ids),
+    )
+    loaded_filmworks_ids = set()
+    for filmworks_documents in filmworks_batches:
+        loaded_filmworks_ids.update(document.id for document in filmworks_documents)
+        service.bulk_store(es, 'movies', transform_service.transform_filmworks_documents(filmworks_documents))
+    if partial_person_updates and changed_persons_ids:
+        filmworks_persons = postgres_service.load_filmworks_persons_by_ids(changed_persons_ids)
+        service.bulk_store(es, 'movies', transform_service.transform_filmworks_persons(filmworks_persons), partial=True)
+
+    genres_data = []
+    if genres_ids:
+        genres_data = postgres_service.load_genres_by_ids(genres_ids)
+        service.bulk_store(es, 'genres', transform_service.transform_genres_data(genres_data))
+
+    persons_ids = list(changes.persons_ids | changes.linked_persons_ids)
+    persons_data = []
+    if persons_ids:
+        persons_data = postgres_service.load_persons_by_ids(persons_ids)
+        service.bulk_store(es, 'persons', transform_service.transform_persons_data(persons_data))
+
+    # Rows deleted in postgres are not found by the queries, persons without films are not indexed.
+    deleted_ids = {
+        'movies': changes.filmworks_ids - loaded_filmworks_ids,
+        'genres': changes.genres_ids - {genre.id for genre in genres_data},
+        'persons': set(persons_ids) - {person.id for person in persons_data},
+    }
+    for index_name, ids in deleted_ids.items():
+        if ids:
+            service.bulk_delete(es, index_name, sorted(ids))
+
+    postgres_service.commit()
+    logger.info(
+        'Changes indexed: %s genres, %s persons, %s filmworks, %s documents deleted.',
+        len(changes.genres_ids),
+        len(persons_ids),
+        len(changes.filmworks_ids),
+        sum(len(ids) for ids in deleted_ids.values()),
+    )
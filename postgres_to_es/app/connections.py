@@ -0,0 +1,104 @@
+"""Connections shared by services: pool of checked postgres connections and tuned elastic transport."""
+import logging
+import time
+from threading import Lock
+from typing import Dict
+
+from elasticsearch import AIOHttpConnection, Urllib3HttpConnection
+from psycopg2 import InterfaceError, OperationalError
+from psycopg2.extras import DictCursor
+from psycopg2.pool import ThreadedConnectionPool
+
+from metrics import METRICS
+from settings import ConnectionSettings
+
+logger = logging.getLogger()
+
+
+class PostgresPool:
+    """Thread safe pool of postgres connections, dead connections are replaced when borrowed.
+
+    Connection which was idle in the pool longer than `check_interval` seconds is pinged before
+    it is given out, so a connection dropped by server or network is not handed to a service.
+    """
+
+    def __init__(self, dsn: dict, maxconn: int = 2, check_interval: float = 30.0):
+        self.pool = ThreadedConnectionPool(1, maxconn, cursor_factory=DictCursor, **dsn)
+        self.check_interval = check_interval
+        self.returned_at: Dict[int, float] = {}
+        self.lock = Lock()
+
+    def _alive(self, connection) -> bool:
+        if connection.closed:
+            return False
+        with self.lock:
+            returned_at = self.returned_at.pop(id(connection), None)
+        if returned_at is None or time.monotonic() - returned_at < self.check_interval:
+            return True
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            connection.rollback()
+            return True
+        except (InterfaceError, OperationalError):
+            return False
+
+    def getconn(self):
+        """Borrow live connection, connection error is raised if postgres is not available."""
+        while True:
+            connection = self.pool.getconn()
+            if self._alive(connection):
+                return connection
+            logger.info('Postgres connection is dead, it is replaced by a new one.')
+            self.pool.putconn(connection, close=True)
+
+    def putconn(self, connection, broken: bool = False) -> None:
+        """Return connection to the pool, open transaction is rolled back, broken connection is closed."""
+        if broken or connection.closed:
+            self.pool.putconn(connection, close=True)
+            return
+        with self.lock:
+            self.returned_at[id(connection)] = time.monotonic()
+        self.pool.putconn(connection)
+
+    def closeall(self) -> None:
+        self.pool.closeall()
+
+
+class MeasuredConnection(Urllib3HttpConnection):
+    """Elastic connection recording time of bulk requests."""
+
+    def perform_request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return super().perform_request(method, url, *args, **kwargs)
+        finally:
+            if url.endswith('/_bulk'):
+                METRICS.observe('etl_bulk_request_seconds', time.perf_counter() - started)
+
+
+class AsyncMeasuredConnection(AIOHttpConnection):
+    """Async elastic connection recording time of bulk requests."""
+
+    async def perform_request(self, method, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().perform_request(method, url, *args, **kwargs)
+        finally:
+            if url.endswith('/_bulk'):
+                METRICS.observe('etl_bulk_request_seconds', time.perf_counter() - started)
+
+
+def elastic_options(settings: ConnectionSettings, asynchronous: bool = False) -> dict:
+    """Transport options of sync and async elastic clients.
+
+    Connections are kept alive between requests, `elastic_maxsize` of them per node, which
+    should be at least `thread_count` of bulk load, otherwise threads wait for connections.
+    """
+    return {
+        'connection_class': AsyncMeasuredConnection if asynchronous else MeasuredConnection,
+        'maxsize': settings.elastic_maxsize,
+        'timeout': settings.elastic_timeout,
+        'retry_on_timeout': settings.elastic_retry_on_timeout,
+        'max_retries': settings.elastic_max_retries,
+    }
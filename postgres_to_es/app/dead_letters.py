@@ -0,0 +1,83 @@
+"""Dead-letter spool of documents elastic refused to index, kept as gzipped NDJSON to replay them later."""
+import gzip
+import logging
+import os
+import time
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from glob import glob
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import orjson
+
+logger = logging.getLogger()
+
+SPOOL_SUFFIX = '.ndjson.gz'
+REPLAY_SUFFIX = '.replaying'
+
+
+class DeadLetterSpool:
+    """Failed bulk actions with their error reasons, one gzip file of appended members per index.
+
+    Spooled documents may be stale by the time they are replayed, so replay takes only their ids
+    and loads current versions from postgres.
+    """
+
+    def __init__(self, directory: str = 'dead_letters'):
+        self.directory = directory
+        self.lock = Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def write(self, index_name: str, failures: List[Tuple[Optional[dict], dict]], partial: bool = False) -> None:
+        """Append failed documents with bulk items describing their errors."""
+        if not failures:
+            return
+        failed_at = datetime.now(timezone.utc).isoformat()
+        lines = b''.join(
+            orjson.dumps({
+                'index': index_name,
+                'id': info.get('_id'),
+                'partial': partial,
+                'status': info.get('status'),
+                'error': info.get('error'),
+                'failed_at': failed_at,
+                'doc': doc,
+            }) + b'\n'
+            for doc, info in failures
+        )
+        with self.lock, gzip.open(os.path.join(self.directory, index_name + SPOOL_SUFFIX), 'ab') as spool_file:
+            spool_file.write(lines)
+        logger.warning('%s documents of %s written to dead-letter spool %s.', len(failures), index_name, self.directory)
+
+    def _read_ids(self, file_path: str, ids: Dict[str, Dict[str, None]]) -> None:
+        try:
+            with gzip.open(file_path, 'rb') as spool_file:
+                for line in spool_file:
+                    entry = orjson.loads(line)
+                    ids[entry['index']][entry['id']] = None
+        except (EOFError, zlib.error, gzip.BadGzipFile, orjson.JSONDecodeError):
+            # Write interrupted by a crash leaves a broken tail, entries before it are still replayed.
+            logger.exception('Dead-letter file %s is damaged, its readable entries are replayed.', file_path)
+
+    @contextmanager
+    def replaying(self) -> Iterator[Dict[str, List[str]]]:
+        """Take spooled failures for replay as ids of documents by index.
+
+        Failures spooled during replay go to new files. Taken files are removed when replay
+        succeeded, otherwise they are taken again by the next replay.
+        """
+        with self.lock:
+            for file_path in glob(os.path.join(self.directory, '*' + SPOOL_SUFFIX)):
+                os.replace(file_path, '{0}.{1}{2}'.format(file_path, time.time_ns(), REPLAY_SUFFIX))
+        file_paths = sorted(glob(os.path.join(self.directory, '*' + REPLAY_SUFFIX)))
+
+        ids = defaultdict(dict)
+        for file_path in file_paths:
+            self._read_ids(file_path, ids)
+        yield {index_name: list(index_ids) for index_name, index_ids in ids.items()}
+
+        for file_path in file_paths:
+            os.remove(file_path)
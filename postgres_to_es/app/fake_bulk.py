@@ -0,0 +1,136 @@
+"""Local stand-in of elastic answering bulk requests without storing documents, for benchmarks.
+
+Every bulk action succeeds after optional `latency`, counts of received actions and bytes are
+returned by `GET /_fake/stats`. Index and alias management requests are acknowledged, requested
+documents are never found.
+"""
+import argparse
+import gzip
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import orjson
+
+ROOT_INFO = {
+    'name': 'fake_bulk',
+    'cluster_name': 'fake_bulk',
+    'version': {'number': '7.15.2', 'build_flavor': 'default'},
+    'tagline': 'You Know, for Search',
+}
+
+
+class BulkStats:
+    """Counters of received bulk requests, shared by handler threads."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.actions = Counter()
+
+    def add(self, body_size: int, actions: Counter) -> None:
+        with self.lock:
+            self.requests += 1
+            self.bytes += body_size
+            self.actions.update(actions)
+
+    def dict(self) -> dict:
+        with self.lock:
+            return {'requests': self.requests, 'bytes': self.bytes, 'actions': dict(self.actions)}
+
+
+class FakeBulkHandler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'
+    stats: BulkStats
+    latency: float = 0.0
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status: int, body: dict = None) -> None:
+        data = b'' if body is None else orjson.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('X-Elastic-Product', 'Elasticsearch')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(data)
+
+    def _body(self) -> bytes:
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        return body
+
+    def _bulk(self, body: bytes) -> dict:
+        items, actions = [], Counter()
+        lines = iter(line for line in body.split(b'\n') if line.strip())
+        for line in lines:
+            operation, meta = next(iter(orjson.loads(line).items()))
+            if operation != 'delete':
+                next(lines)
+            actions['{0}:{1}'.format(meta.get('_index'), operation)] += 1
+            items.append({operation: {'_index': meta.get('_index'), '_id': meta.get('_id'), 'status': 200}})
+        self.stats.add(len(body), actions)
+        return {'took': int(self.latency * 1000), 'errors': False, 'items': items}
+
+    def _mget(self, path: str, body: bytes) -> dict:
+        """Answer that none of requested documents is found."""
+        request = orjson.loads(body) if body else {}
+        index = path.rsplit('/_mget', 1)[0].strip('/') or None
+        docs = request.get('docs') or [{'_id': doc_id} for doc_id in request.get('ids', [])]
+        return {'docs': [{'_index': doc.get('_index', index), '_id': doc['_id'], 'found': False} for doc in docs]}
+
+    def do_HEAD(self):
+        self._send(200)
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        if path == '/':
+            return self._send(200, ROOT_INFO)
+        if path == '/_fake/stats':
+            return self._send(200, self.stats.dict())
+        if path.endswith('/_mget'):
+            return self._send(200, self._mget(path, self._body()))
+        self._send(200, {})
+
+    def do_PUT(self):
+        self._body()
+        self._send(200, {'acknowledged': True})
+
+    def do_DELETE(self):
+        self._send(200, {'acknowledged': True})
+
+    def do_POST(self):
+        body = self._body()
+        path = self.path.split('?')[0]
+        if path.endswith('/_bulk'):
+            time.sleep(self.latency)
+            return self._send(200, self._bulk(body))
+        if path.endswith('/_mget'):
+            return self._send(200, self._mget(path, body))
+        if path.endswith('/_update_by_query'):
+            return self._send(200, {'updated': 0, 'failures': []})
+        self._send(200, {'acknowledged': True, '_shards': {}})
+
+
+def create_server(host: str = '127.0.0.1', port: int = 9299, latency: float = 0.0) -> ThreadingHTTPServer:
+    handler = type('Handler', (FakeBulkHandler,), {'stats': BulkStats(), 'latency': latency})
+    return ThreadingHTTPServer((host, port), handler)
+
+
+def serve(host: str = '127.0.0.1', port: int = 9299, latency: float = 0.0) -> None:
+    create_server(host, port, latency).serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve fake elastic bulk endpoint for benchmarks.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9299)
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds every bulk request takes')
+    args = parser.parse_args()
+    serve(args.host, args.port, args.latency)
@@ -0,0 +1,90 @@
+"""Fingerprints of indexed documents, to skip sending documents elastic already has."""
+import hashlib
+import sqlite3
+from itertools import islice
+from threading import Lock
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import orjson
+
+# SQLite limits count of query parameters, ids are looked up by chunks of this size.
+LOOKUP_CHUNK_SIZE = 500
+
+
+def fingerprint(doc: dict) -> bytes:
+    """Hash of document content, equal for documents with equal fields."""
+    return hashlib.blake2b(orjson.dumps(doc, option=orjson.OPT_SORT_KEYS), digest_size=16).digest()
+
+
+class FingerprintStore:
+    """Fingerprints of last indexed version of every document, kept in a local SQLite file.
+
+    Fingerprints are saved only after elastic accepted documents, so a document is skipped
+    only if elastic already has exactly the same version of it.
+    """
+
+    def __init__(self, file_path: str = 'fingerprints.sqlite3'):
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS fingerprint ('
+            'index_name TEXT NOT NULL, id TEXT NOT NULL, hash BLOB NOT NULL, '
+            'PRIMARY KEY (index_name, id)) WITHOUT ROWID'
+        )
+        self.lock = Lock()
+
+    def _saved(self, index_name: str, ids: List[str]) -> Dict[str, bytes]:
+        saved = {}
+        ids = iter(ids)
+        with self.lock:
+            while chunk := list(islice(ids, LOOKUP_CHUNK_SIZE)):
+                rows = self.connection.execute(
+                    'SELECT id, hash FROM fingerprint WHERE index_name = ? AND id IN ({0})'.format(
+                        ', '.join('?' * len(chunk)),
+                    ),
+                    [index_name, *chunk],
+                )
+                saved.update(rows)
+        return saved
+
+    def changed_documents(self, index_name: str, docs: Iterable[dict]) -> Tuple[List[dict], Dict[str, bytes]]:
+        """Get documents differing from their indexed versions and fingerprints to save after they are indexed.
+
+        A document repeated in `docs` is taken once, its last version wins.
+        """
+        fingerprints = {str(doc['id']): (doc, fingerprint(doc)) for doc in docs}
+        saved = self._saved(index_name, list(fingerprints))
+        changed = {
+            doc_id: (doc, doc_hash)
+            for doc_id, (doc, doc_hash) in fingerprints.items()
+            if saved.get(doc_id) != doc_hash
+        }
+        return [doc for doc, _ in changed.values()], {doc_id: doc_hash for doc_id, (_, doc_hash) in changed.items()}
+
+    def save(self, index_name: str, fingerprints: Dict[str, bytes]) -> None:
+        """Save fingerprints of indexed documents with one transaction."""
+        if not fingerprints:
+            return
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(
+                    'INSERT INTO fingerprint (index_name, id, hash) VALUES (?, ?, ?) '
+                    'ON CONFLICT (index_name, id) DO UPDATE SET hash = excluded.hash',
+                    [(index_name, doc_id, doc_hash) for doc_id, doc_hash in fingerprints.items()],
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def forget(self, index_name: str, ids: Optional[Iterable[str]] = None) -> None:
+        """Drop fingerprints of documents changed in elastic by other means, of the whole index if `ids` is None."""
+        with self.lock:
+            if ids is None:
+                self.connection.execute('DELETE FROM fingerprint WHERE index_name = ?', (index_name,))
+                return
+            self.connection.executemany(
+                'DELETE FROM fingerprint WHERE index_name = ? AND id = ?',
+                [(index_name, str(doc_id)) for doc_id in ids],
+            )
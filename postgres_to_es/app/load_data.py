@@ -1,22 +1,50 @@
+import argparse
+import asyncio
 import logging.config
-from os import path
+import signal
+import time
+from os import environ, path
+from threading import Event
+from typing import Optional, Tuple
 
 from elasticsearch import Elasticsearch
 from psycopg2 import connect
 from psycopg2.extras import DictCursor
 from YamJam import yamjam
 
-from backoff import backoff
+from async_load_data import async_load_from_postgres_to_elastic
+from backoff import STOP_EVENT, backoff
+from cdc import ChangeListener, index_changes, install_triggers
+from connections import PostgresPool, elastic_options
+from dead_letters import DeadLetterSpool
 from elastic_schema import genres_index_schema, filmworks_index_schema, persons_index_schema
+from fingerprints import FingerprintStore
+from metrics import METRICS, log_summary, serve_metrics, state_lag
+from partitioned_reindex import partitioned_reindex_to_elastic
+from pipeline import PipelineRunner
+from profiling import enable_profiling
+from reindex import create_bulk_index, finish_bulk_index, next_index_name, swap_alias
 from service import ElasticSaverService, PostgresLoaderService, TransformDataService
+from settings import EtlSettings, load_settings
+from state_saver import State, create_state
+from throttle import create_throttle
 
 logger = logging.getLogger()
 
+# Daemons wait for changes with timeouts not longer than this, to notice stop requests.
+STOP_CHECK_INTERVAL = 1.0
+
+INDEX_SCHEMAS = {
+    'movies': filmworks_index_schema,
+    'genres': genres_index_schema,
+    'persons': persons_index_schema,
+}
+
 
 @backoff()
-def connect_elastic():
+def connect_elastic(settings: EtlSettings):
     es_dsn = yamjam()['elastic']['envs']
-    es = Elasticsearch([es_dsn])
+    es = Elasticsearch([es_dsn], http_compress=settings.load.http_compress, **elastic_options(settings.connections))
     if es.ping():
         logger.info("Success connect to elastic")
         return es
@@ -37,47 +65,450 @@ def connect_to_postgres():
         raise
 
 
-def load_from_postgres_to_elastic(pg_conn, es):
+@backoff()
+def create_postgres_pool(settings: EtlSettings) -> PostgresPool:
+    postgres_dsn = yamjam()['movies']['database']
+    try:
+        pool = PostgresPool(
+            postgres_dsn,
+            maxconn=settings.connections.postgres_pool_size,
+            check_interval=settings.connections.postgres_check_interval,
+        )
+        logger.info("Success connect to postgres.")
+        return pool
+    except Exception:
+        logger.info("Can not connect to postgres, retry later.")
+        raise
+
+
+def create_dead_letters(settings: EtlSettings) -> Optional[DeadLetterSpool]:
+    if not settings.dead_letters.enabled:
+        return None
+    return DeadLetterSpool(settings.dead_letters.directory)
+
+
+def create_services(
+    pool: PostgresPool,
+    settings: EtlSettings,
+    state_loader: Optional[State] = None,
+    **saver_options,
+) -> Tuple[PostgresLoaderService, ElasticSaverService]:
+    """Create postgres and elastic services sharing one state, they may be reused by repeated loads.
+
+    Postgres service borrows a connection from `pool`, it is returned by `release`.
+    `saver_options` override options of elastic service taken from settings.
+    """
+
+    state_loader = state_loader or create_state(settings.state.storage, settings.state.path)
+    postgres_service = PostgresLoaderService(
+        pool=pool,
+        itersize=settings.extract.itersize,
+        state_loader=state_loader,
+        genre_batch_size=settings.batch_size.genre,
+        person_batch_size=settings.batch_size.person,
+        propagate_genre_renames=settings.extract.propagate_genre_renames,
+        partial_person_updates=settings.extract.partial_person_updates,
+    )
+
+    saver_options = {
+        'thread_count': settings.load.thread_count,
+        'chunk_size': settings.load.chunk_size,
+        'max_chunk_bytes': settings.load.max_chunk_bytes,
+        'max_retries': settings.load.max_retries,
+        'state_loader': state_loader,
+        'ndjson': settings.load.ndjson,
+        'propagate_genre_renames': settings.extract.propagate_genre_renames,
+        'fingerprints': FingerprintStore(settings.fingerprints.path) if settings.fingerprints.enabled else None,
+        'dead_letters': create_dead_letters(settings),
+        'throttle': create_throttle(settings.throttle, settings.load.chunk_size, settings.load.thread_count)
+        if settings.throttle.enabled else None,
+        **saver_options,
+    }
+    service = ElasticSaverService(**saver_options)
+    return postgres_service, service
+
+
+def create_indexes(service: ElasticSaverService, es: Elasticsearch) -> None:
+    for index_name, index_settings in INDEX_SCHEMAS.items():
+        service.create_index(es, index_name, index_settings)
+
+
+def load_from_postgres_to_elastic(pool: PostgresPool, es, settings: EtlSettings, engine: str = 'sequential'):
     """Load data from postgres, transform and send to elastic."""
 
-    postgres_service = PostgresLoaderService(pg_conn)
+    postgres_service, service = create_services(pool, settings)
+    try:
+        create_indexes(service, es)
+        run_load(postgres_service, TransformDataService(**settings.transform.dict()), service, es, settings, engine)
+    finally:
+        postgres_service.release()
+
+
+def reindex_postgres_to_elastic(pool: PostgresPool, es, settings: EtlSettings, engine: str = 'sequential'):
+    """Load all data to new versioned indices and switch aliases of live indices to them.
+
+    New indices are loaded without refreshes and replicas, so the load does not compete with
+    search on live indices. Saved states are replaced by states of the reindex after the switch.
+    """
+
+    target_indices = {alias: next_index_name(es, alias) for alias in INDEX_SCHEMAS}
+    reindex_state = create_state('memory')
+    try:
+        for alias, index_name in target_indices.items():
+            create_bulk_index(es, index_name, INDEX_SCHEMAS[alias])
+        # New indices have no stale genre names and no fingerprints.
+        postgres_service, service = create_services(
+            pool,
+            settings,
+            reindex_state,
+            propagate_genre_renames=False,
+            fingerprints=None,
+            target_indices=target_indices,
+        )
+        try:
+            run_load(postgres_service, TransformDataService(**settings.transform.dict()), service, es, settings, engine)
+        finally:
+            postgres_service.release()
+        for alias, index_name in target_indices.items():
+            finish_bulk_index(es, index_name, INDEX_SCHEMAS[alias], settings.reindex.max_num_segments)
+    except Exception:
+        es.indices.delete(index=list(target_indices.values()), ignore_unavailable=True)
+        raise
+
+    for alias, index_name in target_indices.items():
+        swap_alias(es, alias, index_name, settings.reindex.keep_versions)
+    create_state(settings.state.storage, settings.state.path).set_states(reindex_state.state)
+    if settings.fingerprints.enabled:
+        fingerprints = FingerprintStore(settings.fingerprints.path)
+        for alias in target_indices:
+            fingerprints.forget(alias)
+    logger.info('Reindex finished.')
+
 
-    service = ElasticSaverService()
-    service.create_index(es, 'movies', filmworks_index_schema)
-    service.create_index(es, 'genres', genres_index_schema)
-    service.create_index(es, 'persons', persons_index_schema)
+def replay_dead_letters(pool: PostgresPool, es, settings: EtlSettings):
+    """Index again documents from dead-letter spool, for example after a fix of index mapping.
 
-    transform_service = TransformDataService()
+    Current versions of documents are loaded from postgres by their ids, documents deleted
+    since are skipped. Documents failed again are written to a new spool file.
+    """
 
-    while True:
+    spool = create_dead_letters(settings) or DeadLetterSpool(settings.dead_letters.directory)
+    postgres_service, service = create_services(pool, settings, create_state('memory'), dead_letters=spool)
+    transform_service = TransformDataService(**settings.transform.dict())
+    try:
+        with spool.replaying() as ids:
+            if films_ids := ids.get('movies'):
+                for filmworks_documents in postgres_service.stream_filmworks_documents_by_ids([], [], films_ids):
+                    data_to_elastic = transform_service.transform_filmworks_documents(filmworks_documents)
+                    service.bulk_store(es, 'movies', data_to_elastic)
+            if genres_ids := ids.get('genres'):
+                genres_data = postgres_service.load_genres_by_ids(genres_ids)
+                service.bulk_store(es, 'genres', transform_service.transform_genres_data(genres_data))
+            if persons_ids := ids.get('persons'):
+                persons_data = postgres_service.load_persons_by_ids(persons_ids)
+                service.bulk_store(es, 'persons', transform_service.transform_persons_data(persons_data))
+            replayed = {index_name: len(index_ids) for index_name, index_ids in ids.items()}
+            logger.info('Dead letters replayed: %s.', replayed)
+    finally:
+        postgres_service.release()
+
+
+def run_load(
+    postgres_service: PostgresLoaderService,
+    transform_service: TransformDataService,
+    service: ElasticSaverService,
+    es: Elasticsearch,
+    settings: EtlSettings,
+    engine: str = 'sequential',
+    stop_event: Optional[Event] = None,
+):
+    """Load data changed since saved states.
+
+    Once `stop_event` is set no more batches are extracted, batches extracted before are loaded.
+    """
+
+    stop_event = stop_event or Event()
+
+    if engine == 'pipeline':
+        runner = PipelineRunner(
+            postgres_service,
+            transform_service,
+            service,
+            es,
+            queue_size=settings.pipeline.queue_size,
+            streaming=settings.extract.streaming,
+            denormalized=settings.extract.denormalized,
+            stop_event=stop_event,
+        )
+        runner.run()
+        return
+
+    if settings.extract.streaming:
+        stream_from_postgres_to_elastic(
+            postgres_service,
+            transform_service,
+            service,
+            es,
+            denormalized=settings.extract.denormalized,
+            stop_event=stop_event,
+        )
+        return
+
+    while settings.extract.denormalized and not stop_event.is_set():
+        filmworks_documents = postgres_service.load_filmworks_documents()
+        if filmworks_documents is None:
+            break
+        data_to_elastic = transform_service.transform_filmworks_documents(filmworks_documents)
+        logger.info("Get filmworks documents from postgres. Transformed to save to elastic..")
+        service.bulk_store(es, 'movies', data_to_elastic, postgres_service.states_after_save)
+    while not settings.extract.denormalized and not stop_event.is_set():
         data_from_postgres = postgres_service.load_filmworks_data()
+        if data_from_postgres is None:
+            break
         data_to_elastic = transform_service.transform_filmworks_data(*data_from_postgres)
         if not data_to_elastic:
-            break
+            # Changed genres and persons of the page have no films, states move past them.
+            service.save_states(postgres_service.states_after_save)
+            continue
         logger.info("Get filmworks data from postgres. Transformed to save to elastic..")
         service.bulk_store(es, 'movies', data_to_elastic, postgres_service.states_after_save)
-    while True:
+    load_filmworks_persons(postgres_service, transform_service, service, es, stop_event)
+    while not stop_event.is_set():
         genres_data_from_postgres = postgres_service.load_genres_data()
         genres_data_to_elastic = transform_service.transform_genres_data(genres_data_from_postgres)
         if not genres_data_to_elastic:
             break
         logger.info("Get genres data from postgres. Transformed to save to elastic..")
         service.bulk_store(es, 'genres', genres_data_to_elastic, postgres_service.states_after_save)
-    while True:
+    while not stop_event.is_set():
         persons_data_from_postgres = postgres_service.load_persons_data()
-        if not persons_data_from_postgres:
+        persons_data_to_elastic = transform_service.transform_persons_data(persons_data_from_postgres)
+        if not persons_data_to_elastic:
+            break
+        logger.info("Get persons data from postgres. Transformed to save to elastic..")
+        service.bulk_store(es, 'persons', persons_data_to_elastic, postgres_service.states_after_save)
+
+
+def stream_from_postgres_to_elastic(
+    postgres_service: PostgresLoaderService,
+    transform_service: TransformDataService,
+    service: ElasticSaverService,
+    es: Elasticsearch,
+    denormalized: bool = False,
+    stop_event: Optional[Event] = None,
+):
+    """Load data through server-side cursors, so memory stays flat for any change set."""
+
+    stop_event = stop_event or Event()
+
+    while not stop_event.is_set():
+        if denormalized:
+            filmworks_batches = postgres_service.stream_filmworks_documents()
+        else:
+            filmworks_batches = postgres_service.stream_filmworks_data()
+        if filmworks_batches is None:
+            break
+        for filmworks_data in filmworks_batches:
+            if stop_event.is_set():
+                # States are saved only after all films of the step are loaded.
+                return
+            if denormalized:
+                data_to_elastic = transform_service.transform_filmworks_documents(filmworks_data)
+            else:
+                data_to_elastic = transform_service.transform_filmworks_data(*filmworks_data)
+            logger.info("Get filmworks data from postgres. Transformed to save to elastic..")
+            service.bulk_store(es, 'movies', data_to_elastic)
+        service.save_states(postgres_service.states_after_save)
+    load_filmworks_persons(postgres_service, transform_service, service, es, stop_event)
+    while not stop_event.is_set():
+        genres_data_to_elastic = transform_service.transform_genres_data(postgres_service.stream_genres_data())
+        if not genres_data_to_elastic:
+            break
+        logger.info("Get genres data from postgres. Transformed to save to elastic..")
+        service.bulk_store(es, 'genres', genres_data_to_elastic, postgres_service.states_after_save)
+    while not stop_event.is_set():
+        persons_data_to_elastic = transform_service.transform_persons_data(postgres_service.stream_persons_data())
+        if not persons_data_to_elastic:
             break
-        persons_data_to_elastic = transform_service.transform_persons_data(*persons_data_from_postgres)
         logger.info("Get persons data from postgres. Transformed to save to elastic..")
         service.bulk_store(es, 'persons', persons_data_to_elastic, postgres_service.states_after_save)
 
 
+def load_filmworks_persons(
+    postgres_service: PostgresLoaderService,
+    transform_service: TransformDataService,
+    service: ElasticSaverService,
+    es: Elasticsearch,
+    stop_event: Event,
+):
+    """Update cast fields of movies of changed persons, when partial person updates are enabled."""
+
+    while not stop_event.is_set():
+        filmworks_persons = postgres_service.load_filmworks_persons()
+        if filmworks_persons is None:
+            break
+        data_to_elastic = transform_service.transform_filmworks_persons(filmworks_persons)
+        logger.info("Get cast of filmworks from postgres. Transformed to update in elastic..")
+        service.bulk_store(es, 'movies', data_to_elastic, postgres_service.states_after_save, partial=True)
+
+
+@backoff()
+def capture_changes_to_elastic(settings: EtlSettings, engine: str = 'sequential', stop_event: Optional[Event] = None):
+    """Listen to changes in postgres and index them within seconds, runs until `stop_event` is set.
+
+    Changes made while nobody listened are taken by the usual load on start, which is also
+    repeated every `checkpoint_interval` seconds to move saved states forward.
+    Retries of unavailable services stop with the default `stop_event`, see backoff.STOP_EVENT.
+    """
+
+    stop_event = stop_event or STOP_EVENT
+
+    listen_conn = connect_to_postgres()
+    pool = create_postgres_pool(settings)
+    es = connect_elastic(settings)
+    try:
+        listen_conn.autocommit = True
+        if settings.cdc.install_triggers:
+            install_triggers(listen_conn, settings.cdc.channel)
+        listener = ChangeListener(listen_conn, settings.cdc.channel, settings.cdc.window, settings.cdc.max_ids)
+        # Listen before catch-up load, so changes committed during it are not lost.
+        listener.listen()
+
+        postgres_service, service = create_services(pool, settings)
+        create_indexes(service, es)
+        transform_service = TransformDataService(**settings.transform.dict())
+        while not stop_event.is_set():
+            run_load(postgres_service, transform_service, service, es, settings, engine, stop_event)
+            postgres_service.commit()
+            checkpoint_at = time.monotonic() + settings.cdc.checkpoint_interval
+            while not stop_event.is_set() and (timeout := checkpoint_at - time.monotonic()) > 0:
+                if changes := listener.get_changes(min(timeout, STOP_CHECK_INTERVAL)):
+                    index_changes(changes, postgres_service, transform_service, service, es)
+    finally:
+        listen_conn.close()
+        pool.closeall()
+        es.close()
+
+
+@backoff()
+def poll_postgres_to_elastic(settings: EtlSettings, engine: str = 'sequential', stop_event: Optional[Event] = None):
+    """Load changes in a loop with the same connections and services, runs until `stop_event` is set.
+
+    Poll interval is `min_interval` after loads finding data and grows by `backoff_factor`
+    up to `max_interval` while loads find nothing.
+    Retries of unavailable services stop with the default `stop_event`, see backoff.STOP_EVENT.
+    """
+
+    stop_event = stop_event or STOP_EVENT
+    pool = create_postgres_pool(settings)
+    es = connect_elastic(settings)
+    try:
+        postgres_service, service = create_services(pool, settings)
+        create_indexes(service, es)
+        transform_service = TransformDataService(**settings.transform.dict())
+        interval = settings.daemon.min_interval
+        while not stop_event.is_set():
+            extracted_states = dict(postgres_service.states_after_save)
+            run_load(postgres_service, transform_service, service, es, settings, engine, stop_event)
+            # End read transaction, so it does not stay open while sleeping.
+            postgres_service.commit()
+            if postgres_service.states_after_save != extracted_states:
+                interval = settings.daemon.min_interval
+            else:
+                interval = min(interval * settings.daemon.backoff_factor, settings.daemon.max_interval)
+            logger.debug('Next poll in %s seconds.', interval)
+            stop_event.wait(interval)
+    finally:
+        pool.closeall()
+        es.close()
+    logger.info('Daemon stopped.')
+
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Load movies data from postgres to elastic.')
+    parser.add_argument(
+        '--engine',
+        choices=['sequential', 'pipeline', 'async'],
+        default='sequential',
+        help='pipeline runs extract, transform and load stages in parallel, '
+             'async loads movies, genres and persons concurrently with asyncpg and AsyncElasticsearch',
+    )
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument(
+        '--daemon',
+        action='store_true',
+        help='keep running and poll postgres for changes with adaptive interval instead of a single load',
+    )
+    mode.add_argument(
+        '--cdc',
+        action='store_true',
+        help='run as a daemon indexing changes notified by postgres triggers instead of a single load',
+    )
+    mode.add_argument(
+        '--reindex',
+        action='store_true',
+        help='load all data to new versioned indices and switch index aliases to them when loaded',
+    )
+    mode.add_argument(
+        '--replay',
+        action='store_true',
+        help='index again documents from dead-letter spool, after the reason of their failure is fixed',
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='profile batches with cProfile and tracemalloc, also enabled by ETL_PROFILE environment variable',
+    )
+    args = parser.parse_args()
+    if (args.daemon or args.cdc or args.reindex) and args.engine == 'async':
+        parser.error('--daemon, --cdc and --reindex work with sequential and pipeline engines')
+
     log_file_path = path.join(path.dirname(path.abspath(__file__)), 'logging.conf')
     logging.config.fileConfig(log_file_path)
 
-    pg_conn = connect_to_postgres()
+    settings = load_settings()
+    METRICS.gauge('etl_state_lag_seconds', state_lag(create_state(settings.state.storage, settings.state.path)))
+    if args.profile or environ.get('ETL_PROFILE', '').lower() in ('1', 'true') or settings.profiling.enabled:
+        enable_profiling(settings.profiling)
+
+    if args.daemon or args.cdc:
+        serve_metrics(settings.metrics.host, settings.metrics.port)
+        # Stop after batches already extracted are loaded and their states saved. Failed calls of
+        # these batches are retried for the grace period, so the daemon stops while services are down.
+        STOP_EVENT.grace_period = settings.daemon.stop_grace_period
+        signal.signal(signal.SIGTERM, lambda signum, frame: STOP_EVENT.set())
+        try:
+            if args.daemon:
+                poll_postgres_to_elastic(settings, args.engine)
+            else:
+                capture_changes_to_elastic(settings, args.engine)
+        except Exception:
+            if not STOP_EVENT.is_set():
+                raise
+            logger.exception('Daemon stopped while services were unavailable, unloaded batches are not saved.')
+    else:
+        try:
+            if args.reindex and settings.reindex.partitions:
+                partitioned_reindex_to_elastic(settings, INDEX_SCHEMAS, connect_to_postgres, connect_elastic)
+            elif args.reindex:
+                pool = create_postgres_pool(settings)
+
+                es = connect_elastic(settings)
+
+                reindex_postgres_to_elastic(pool, es, settings, args.engine)
+            elif args.replay:
+                pool = create_postgres_pool(settings)
+
+                es = connect_elastic(settings)
+
+                replay_dead_letters(pool, es, settings)
+            elif args.engine == 'async':
+                asyncio.run(async_load_from_postgres_to_elastic(settings))
+            else:
+                pool = create_postgres_pool(settings)
 
-    es = connect_elastic()
+                es = connect_elastic(settings)
 
-    load_from_postgres_to_elastic(pg_conn, es)
+                load_from_postgres_to_elastic(pool, es, settings, args.engine)
+        finally:
+            log_summary(settings.metrics.summary_path)
@@ -0,0 +1,258 @@
+"""Metrics of ETL stages, bulk requests and state lag, exposed in prometheus text format or as json."""
+import asyncio
+import functools
+import json
+import logging
+import threading
+import time
+import types
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Optional, Tuple
+
+from state_saver import State
+
+logger = logging.getLogger()
+
+# Upper bounds of histogram buckets in seconds, from one fast query to one slow bulk load.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+DESCRIPTIONS = {
+    'etl_stage_seconds': ('histogram', 'Time of extract, transform and load calls.'),
+    'etl_stage_rows_total': ('counter', 'Rows extracted, documents transformed and documents indexed.'),
+    'etl_bulk_request_seconds': ('histogram', 'Time of bulk requests to elastic.'),
+    'etl_bulk_rejected_total': ('counter', 'Documents rejected by elastic because of load, they are sent again.'),
+    'etl_bulk_failed_total': ('counter', 'Documents elastic did not index after all retries.'),
+    'etl_dead_letters_total': ('counter', 'Documents written to dead-letter spool.'),
+    'etl_bulk_limits': ('gauge', 'Bulk size and thread count set by adaptive throttle.'),
+    'etl_circuit_breaker_opened_total': ('counter', 'Times bulk load was paused to let overloaded elastic recover.'),
+    'etl_state_lag_seconds': ('gauge', 'Time since update of the last row loaded by the saved state.'),
+}
+
+Labels = Tuple[Tuple[str, str], ...]
+
+
+class Histogram:
+
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for number, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[number] += 1
+        self.count += 1
+        self.sum += value
+
+
+class Metrics:
+    """Counters and histograms updated by services, and gauges computed when metrics are read."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters: Dict[str, Dict[Labels, float]] = {}
+        self.histograms: Dict[str, Dict[Labels, Histogram]] = {}
+        self.gauges: Dict[str, Callable[[], Dict[Labels, float]]] = {}
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            counter = self.counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self.lock:
+            self.histograms.setdefault(name, {}).setdefault(key, Histogram()).observe(value)
+
+    def gauge(self, name: str, callback: Callable[[], Dict[Labels, float]]) -> None:
+        """Register gauge, its values by labels are returned by `callback` every time metrics are read."""
+        self.gauges[name] = callback
+
+    def _gauge_values(self) -> Dict[str, Dict[Labels, float]]:
+        values = {}
+        for name, callback in self.gauges.items():
+            try:
+                values[name] = callback()
+            except Exception:
+                logger.exception('Gauge %s is not available.', name)
+        return values
+
+    def render(self) -> str:
+        """Metrics in prometheus text exposition format."""
+        lines = []
+
+        def header(name: str) -> None:
+            metric_type, description = DESCRIPTIONS.get(name, ('untyped', ''))
+            lines.extend(['# HELP {0} {1}'.format(name, description), '# TYPE {0} {1}'.format(name, metric_type)])
+
+        gauges = self._gauge_values()
+        with self.lock:
+            for name, values in {**self.counters, **gauges}.items():
+                header(name)
+                lines.extend('{0}{1} {2}'.format(name, _labels(labels), value) for labels, value in values.items())
+            for name, histograms in self.histograms.items():
+                header(name)
+                for labels, histogram in histograms.items():
+                    for bound, count in zip(BUCKETS, histogram.buckets):
+                        lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le=bound), count))
+                    lines.append('{0}_bucket{1} {2}'.format(name, _labels(labels, le='+Inf'), histogram.count))
+                    lines.append('{0}_sum{1} {2}'.format(name, _labels(labels), histogram.sum))
+                    lines.append('{0}_count{1} {2}'.format(name, _labels(labels), histogram.count))
+        return '\n'.join(lines) + '\n'
+
+    def summary(self) -> dict:
+        """Metrics as json-ready dict, histograms are reduced to count, total and average."""
+        gauges = self._gauge_values()
+        with self.lock:
+            summary = {
+                name: [{**dict(labels), 'value': value} for labels, value in values.items()]
+                for name, values in {**self.counters, **gauges}.items()
+            }
+            for name, histograms in self.histograms.items():
+                summary[name] = [
+                    {
+                        **dict(labels),
+                        'count': histogram.count,
+                        'seconds': round(histogram.sum, 3),
+                        'average_seconds': round(histogram.sum / histogram.count, 4) if histogram.count else None,
+                    }
+                    for labels, histogram in histograms.items()
+                ]
+        return summary
+
+
+METRICS = Metrics()
+
+
+def _labels(labels: Labels, **extra) -> str:
+    labels = [*labels, *extra.items()]
+    if not labels:
+        return ''
+    return '{{{0}}}'.format(','.join('{0}="{1}"'.format(key, value) for key, value in labels))
+
+
+def count_rows(value) -> int:
+    """Count rows of a service result: list of rows, batches of rows, or tuple led by list of rows."""
+    if value is None:
+        return 0
+    if isinstance(value, tuple):
+        return count_rows(value[0]) if value else 0
+    if isinstance(value, list):
+        return sum(count_rows(item) if isinstance(item, (list, tuple)) else 1 for item in value)
+    return 1
+
+
+def record_stage(stage_name: str, operation: str, seconds: float, rows: int) -> None:
+    METRICS.observe('etl_stage_seconds', seconds, stage=stage_name, operation=operation)
+    METRICS.inc('etl_stage_rows_total', rows, stage=stage_name, operation=operation)
+
+
+def stage(stage_name: str) -> Callable:
+    """Record time of the decorated service method and count rows it returns.
+
+    Iterators returned by streaming methods are measured while they are consumed.
+    """
+
+    def func_wrapper(func):
+        def record(seconds: float, rows: int) -> None:
+            record_stage(stage_name, func.__name__, seconds, rows)
+
+        def measured_iterator(iterator):
+            elapsed, rows = 0.0, 0
+            try:
+                while True:
+                    started = time.perf_counter()
+                    try:
+                        item = next(iterator)
+                    except StopIteration:
+                        return
+                    finally:
+                        elapsed += time.perf_counter() - started
+                    rows += count_rows([item])
+                    yield item
+            finally:
+                record(elapsed, rows)
+
+        def measured(result):
+            if isinstance(result, types.GeneratorType):
+                return measured_iterator(result), None
+            return result, count_rows(result)
+
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapped(*args, **kwargs):
+                started = time.perf_counter()
+                result = await func(*args, **kwargs)
+                record(time.perf_counter() - started, count_rows(result))
+                return result
+
+            return async_wrapped
+
+        @functools.wraps(func)
+        def wrapped(*args, **kwargs):
+            started = time.perf_counter()
+            result, rows = measured(func(*args, **kwargs))
+            if rows is not None:
+                record(time.perf_counter() - started, rows)
+            return result
+
+        return wrapped
+
+    return func_wrapper
+
+
+def state_lag(state: State) -> Callable[[], Dict[Labels, float]]:
+    """Gauge callback: seconds since update of the last loaded row of every saved `*_state`."""
+
+    def lags() -> Dict[Labels, float]:
+        now = datetime.now(timezone.utc)
+        values = {}
+        for key, value in state.storage.retrieve_state().items():
+            if key.endswith('_state') and isinstance(value, list):
+                updated_at = datetime.fromisoformat(value[0])
+                if updated_at.tzinfo is None:
+                    updated_at = updated_at.replace(tzinfo=timezone.utc)
+                values[(('state', key),)] = round((now - updated_at).total_seconds(), 3)
+        return values
+
+    return lags
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = METRICS.render().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve_metrics(host: str, port: int) -> Optional[ThreadingHTTPServer]:
+    """Serve `/metrics` from a daemon thread, nothing is served if `port` is 0."""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    logger.info('Metrics are served on %s:%s/metrics.', host, port)
+    return server
+
+
+def log_summary(summary_path: Optional[str] = None) -> None:
+    """Log metrics of the run as json, and write them to `summary_path` if it is set."""
+    summary = json.dumps(METRICS.summary())
+    logger.info('Run summary: %s', summary)
+    if summary_path:
+        with open(summary_path, 'w') as summary_file:
+            summary_file.write(summary)
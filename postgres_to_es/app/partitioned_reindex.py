@@ -0,0 +1,248 @@
+"""Full reindex split to id range partitions, loaded by worker processes with their own connections.
+
+Progress of every partition is checkpointed to the state store, so a reindex started again after
+a crash loads only what was not loaded yet.
+"""
+import logging
+import multiprocessing
+import traceback
+from queue import Empty
+from typing import Callable, Dict, List, Optional, Tuple
+from uuid import UUID
+
+from elasticsearch import Elasticsearch
+
+from fingerprints import FingerprintStore
+from reindex import create_bulk_index, finish_bulk_index, next_index_name, swap_alias
+from service import BASE_ID, FILMS_LOADED_KEYS, ElasticSaverService, PostgresLoaderService, TransformDataService
+from settings import EtlSettings
+from snapshot import attach_snapshot, export_snapshot
+from state_saver import State, create_state
+
+logger = logging.getLogger()
+
+REINDEX_STATE_KEY = 'partitioned_reindex'
+
+# States of incremental loads, set to the reindex start after aliases are switched.
+LOAD_STATE_KEYS = ('genres_state', 'persons_state', 'genres_data_state', 'persons_data_state')
+
+MAX_ID = str(UUID(int=2 ** 128 - 1))
+
+# Parent checks workers are alive at least this often while waiting for their progress.
+PROGRESS_TIMEOUT = 1.0
+
+
+def partition_bounds(partitions: int) -> List[Tuple[str, str]]:
+    """Split id space to `partitions` ranges (lower, upper], ids are random uuids, so ranges are about equal."""
+    step = 2 ** 128 // partitions
+    bounds = [str(UUID(int=step * number)) for number in range(partitions)] + [MAX_ID]
+    return list(zip(bounds, bounds[1:]))
+
+
+def load_page(
+    index_name: str,
+    last_id: str,
+    upper_id: str,
+    postgres_service: PostgresLoaderService,
+    transform_service: TransformDataService,
+) -> Tuple[List[dict], Optional[str]]:
+    """Load and transform the page after `last_id`, return documents and id to continue from, None at the end."""
+    if index_name == 'movies':
+        documents = postgres_service.load_filmworks_documents_range(last_id, upper_id)
+        if not documents:
+            return [], None
+        return transform_service.transform_filmworks_documents(documents), documents[-1].id
+    if index_name == 'genres':
+        genres_data = postgres_service.load_genres_range(last_id, upper_id)
+        if not genres_data:
+            return [], None
+        return transform_service.transform_genres_data(genres_data), genres_data[-1].id
+    persons_documents = postgres_service.load_persons_range(last_id, upper_id)
+    if not persons_documents:
+        return [], None
+    return transform_service.transform_persons_data(persons_documents), persons_documents[-1].id
+
+
+def reindex_worker(
+    settings: EtlSettings,
+    target_indices: Dict[str, str],
+    connect_postgres: Callable,
+    connect_elastic: Callable,
+    tasks: multiprocessing.Queue,
+    progress: multiprocessing.Queue,
+    snapshot_id: Optional[str] = None,
+) -> None:
+    """Load partitions taken from `tasks` until None is taken, report every loaded page to `progress`.
+
+    With `snapshot_id` all partitions are read in one transaction attached to the exported snapshot.
+    """
+
+    pg_conn = connect_postgres()
+    if snapshot_id:
+        attach_snapshot(pg_conn, snapshot_id)
+    es = connect_elastic(settings)
+    state_loader = create_state('memory')
+    # Worker failed to read fails the reindex, which is continued from checkpoints by the next start.
+    postgres_service = PostgresLoaderService(
+        pg_conn,
+        in_snapshot=bool(snapshot_id),
+        itersize=settings.extract.itersize,
+        state_loader=state_loader,
+        genre_batch_size=settings.batch_size.genre,
+        person_batch_size=settings.batch_size.person,
+    )
+    service = ElasticSaverService(
+        thread_count=settings.load.thread_count,
+        chunk_size=settings.load.chunk_size,
+        max_chunk_bytes=settings.load.max_chunk_bytes,
+        max_retries=settings.load.max_retries,
+        state_loader=state_loader,
+        ndjson=settings.load.ndjson,
+        target_indices=target_indices,
+    )
+    transform_service = TransformDataService(**settings.transform.dict())
+    partition_key = None
+    try:
+        while (task := tasks.get()) is not None:
+            partition_key, last_id, upper_id = task
+            index_name = partition_key.split(':')[0]
+            while True:
+                docs, last_id = load_page(index_name, last_id, upper_id, postgres_service, transform_service)
+                if not snapshot_id:
+                    # End read transaction, so it does not stay open for the whole partition.
+                    pg_conn.commit()
+                if last_id is None:
+                    break
+                service.bulk_store(es, index_name, docs)
+                progress.put(('checkpoint', partition_key, last_id))
+            progress.put(('finished', partition_key, None))
+    except Exception:
+        progress.put(('failed', partition_key, traceback.format_exc()))
+        raise
+    finally:
+        pg_conn.close()
+        es.close()
+
+
+def start_reindex(pg_conn, es: Elasticsearch, settings: EtlSettings, index_schemas: Dict[str, dict]) -> dict:
+    """Create new indices and checkpoints of all partitions, reindex starts at the time of current transaction."""
+    with pg_conn.cursor() as cursor:
+        cursor.execute('SELECT now()')
+        started_at = str(cursor.fetchone()[0])
+
+    target_indices = {alias: next_index_name(es, alias) for alias in index_schemas}
+    for alias, index_name in target_indices.items():
+        create_bulk_index(es, index_name, index_schemas[alias])
+    partitions = {
+        '{0}:{1}'.format(alias, number): {'last_id': lower_id, 'upper_id': upper_id, 'finished': False}
+        for alias in index_schemas
+        for number, (lower_id, upper_id) in enumerate(partition_bounds(settings.reindex.partitions))
+    }
+    return {'started_at': started_at, 'indices': target_indices, 'partitions': partitions}
+
+
+def run_workers(
+    settings: EtlSettings,
+    reindex: dict,
+    state: State,
+    connect_postgres: Callable,
+    connect_elastic: Callable,
+    snapshot_id: Optional[str] = None,
+) -> None:
+    """Load unfinished partitions with `workers` processes, checkpoints are saved as pages are loaded.
+
+    Raise exception if some worker failed, other workers are stopped then.
+    """
+    unfinished = [key for key, partition in reindex['partitions'].items() if not partition['finished']]
+    context = multiprocessing.get_context('spawn')
+    tasks, progress = context.Queue(), context.Queue()
+    for key in unfinished:
+        tasks.put((key, reindex['partitions'][key]['last_id'], reindex['partitions'][key]['upper_id']))
+    workers = [
+        context.Process(
+            target=reindex_worker,
+            args=(settings, reindex['indices'], connect_postgres, connect_elastic, tasks, progress, snapshot_id),
+            name='reindex-{0}'.format(number),
+        )
+        for number in range(min(settings.reindex.workers, len(unfinished)))
+    ]
+    for worker in workers:
+        tasks.put(None)
+        worker.start()
+    logger.info('%s partitions are loaded by %s workers.', len(unfinished), len(workers))
+
+    remaining = len(unfinished)
+    try:
+        while remaining:
+            try:
+                event, key, value = progress.get(timeout=PROGRESS_TIMEOUT)
+            except Empty:
+                if any(worker.exitcode not in (None, 0) for worker in workers):
+                    raise Exception('Reindex worker exited unexpectedly.')
+                continue
+            if event == 'failed':
+                raise Exception('Reindex of partition {0} failed:\n{1}'.format(key, value))
+            if event == 'checkpoint':
+                reindex['partitions'][key]['last_id'] = value
+            else:
+                reindex['partitions'][key]['finished'] = True
+                remaining -= 1
+                logger.info('Partition %s loaded, %s left.', key, remaining)
+            state.set_state(REINDEX_STATE_KEY, reindex)
+    finally:
+        for worker in workers:
+            if worker.is_alive() and remaining:
+                worker.terminate()
+            worker.join()
+
+
+def partitioned_reindex_to_elastic(
+    settings: EtlSettings,
+    index_schemas: Dict[str, dict],
+    connect_postgres: Callable,
+    connect_elastic: Callable,
+) -> None:
+    """Load all data to new versioned indices with worker processes and switch aliases to them.
+
+    With `consistent_snapshot` workers read the snapshot exported by the coordinator transaction,
+    which stays open until all partitions are loaded. Reindex interrupted by a crash is continued
+    by the next start from its checkpoints, remaining partitions are read from a new snapshot then.
+    """
+
+    state = create_state(settings.state.storage, settings.state.path)
+    es = connect_elastic(settings)
+    pg_conn = connect_postgres()
+    try:
+        snapshot_id = export_snapshot(pg_conn) if settings.extract.consistent_snapshot else None
+        reindex = state.get_state(REINDEX_STATE_KEY)
+        if reindex:
+            logger.info('Continue reindex to %s started at %s.', reindex['indices'], reindex['started_at'])
+        else:
+            reindex = start_reindex(pg_conn, es, settings, index_schemas)
+            state.set_state(REINDEX_STATE_KEY, reindex)
+
+        run_workers(settings, reindex, state, connect_postgres, connect_elastic, snapshot_id)
+        # Snapshot is not needed any more, transaction does not have to stay open while indices are merged.
+        pg_conn.close()
+
+        for alias, index_name in reindex['indices'].items():
+            finish_bulk_index(es, index_name, index_schemas[alias], settings.reindex.max_num_segments)
+        for alias, index_name in reindex['indices'].items():
+            swap_alias(es, alias, index_name, settings.reindex.keep_versions)
+    finally:
+        pg_conn.close()
+        es.close()
+
+    # Changes made since the reindex started are loaded again by incremental loads, films of all
+    # genres and persons are loaded already.
+    load_state = [reindex['started_at'], BASE_ID]
+    state.set_states({
+        **{key: load_state for key in LOAD_STATE_KEYS},
+        **{flag_key: True for flag_key in FILMS_LOADED_KEYS.values()},
+        REINDEX_STATE_KEY: None,
+    })
+    if settings.fingerprints.enabled:
+        fingerprints = FingerprintStore(settings.fingerprints.path)
+        for alias in reindex['indices']:
+            fingerprints.forget(alias)
+    logger.info('Reindex finished.')
@@ -0,0 +1,172 @@
+"""Pipelined ETL: extract, transform and load run in parallel workers joined by bounded queues."""
+import logging
+from concurrent.futures import ThreadPoolExecutor, wait
+from dataclasses import dataclass
+from queue import Empty, Full, Queue
+from threading import Event
+from typing import Any, Iterator, Optional
+
+from elasticsearch import Elasticsearch
+
+from service import ElasticSaverService, PostgresLoaderService, TransformDataService
+
+logger = logging.getLogger()
+
+QUEUE_TIMEOUT = 0.5
+
+
+@dataclass
+class Batch:
+
+    index_name: str
+    data: Any
+    states: Optional[dict]
+    # Partial documents only update their fields of indexed documents.
+    partial: bool = False
+
+
+class PipelineStopped(Exception):
+    """Other pipeline worker failed, so current worker has to stop."""
+
+
+class PipelineRunner:
+    """Run extract, transform and load stages in separate threads.
+
+    Stages are joined by bounded queues, so a slow stage makes the faster ones wait
+    instead of piling batches up in memory. States are saved by the load stage only
+    after elastic accepted the batch.
+    """
+
+    def __init__(
+        self,
+        postgres_service: PostgresLoaderService,
+        transform_service: TransformDataService,
+        saver_service: ElasticSaverService,
+        es: Elasticsearch,
+        queue_size: int = 4,
+        streaming: bool = False,
+        denormalized: bool = False,
+        stop_event: Optional[Event] = None,
+    ):
+        self.postgres_service = postgres_service
+        self.transform_service = transform_service
+        self.saver_service = saver_service
+        self.es = es
+        self.streaming = streaming
+        self.denormalized = denormalized
+        self.transform_queue = Queue(maxsize=queue_size)
+        self.load_queue = Queue(maxsize=queue_size)
+        self.stopped = Event()
+        # Set from outside to stop extraction, batches extracted before are still loaded.
+        self.stop_event = stop_event or Event()
+
+    def run(self) -> None:
+        """Run all stages and wait for them, first error of any stage is raised."""
+        with ThreadPoolExecutor(max_workers=3, thread_name_prefix='etl') as executor:
+            futures = [
+                executor.submit(self._worker, self._extract),
+                executor.submit(self._worker, self._transform),
+                executor.submit(self._worker, self._load),
+            ]
+            wait(futures)
+        for future in futures:
+            future.result()
+
+    def _worker(self, stage) -> None:
+        try:
+            stage()
+        except PipelineStopped:
+            pass
+        except Exception:
+            self.stopped.set()
+            raise
+
+    def _put(self, queue: Queue, item: Optional[Batch]) -> None:
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=QUEUE_TIMEOUT)
+                return
+            except Full:
+                continue
+        raise PipelineStopped
+
+    def _get(self, queue: Queue) -> Optional[Batch]:
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=QUEUE_TIMEOUT)
+            except Empty:
+                continue
+        raise PipelineStopped
+
+    def _extract(self) -> None:
+        for batch in self._extracted_batches():
+            if self.stop_event.is_set():
+                break
+            self._put(self.transform_queue, batch)
+        self._put(self.transform_queue, None)
+
+    def _transform(self) -> None:
+        transformers = {
+            'movies': (
+                self.transform_service.transform_filmworks_documents if self.denormalized
+                else lambda data: self.transform_service.transform_filmworks_data(*data)
+            ),
+            'genres': self.transform_service.transform_genres_data,
+            'persons': self.transform_service.transform_persons_data,
+        }
+        while (batch := self._get(self.transform_queue)) is not None:
+            if batch.data and batch.partial:
+                batch.data = self.transform_service.transform_filmworks_persons(batch.data)
+            elif batch.data:
+                batch.data = transformers[batch.index_name](batch.data)
+            logger.info("Get %s data from postgres. Transformed to save to elastic..", batch.index_name)
+            self._put(self.load_queue, batch)
+        self._put(self.load_queue, None)
+
+    def _load(self) -> None:
+        while (batch := self._get(self.load_queue)) is not None:
+            if batch.data:
+                self.saver_service.bulk_store(self.es, batch.index_name, batch.data, batch.states, batch.partial)
+            elif batch.states:
+                self.saver_service.save_states(batch.states)
+
+    def _extracted_batches(self) -> Iterator[Batch]:
+        """Extract batches in the same order as sequential load does.
+
+        Every batch carries a copy of states reached by extraction, to be saved after load.
+        """
+        postgres_service = self.postgres_service
+
+        if self.streaming:
+            if self.denormalized:
+                stream_filmworks = postgres_service.stream_filmworks_documents
+            else:
+                stream_filmworks = postgres_service.stream_filmworks_data
+            while (filmworks_batches := stream_filmworks()) is not None:
+                for filmworks_data in filmworks_batches:
+                    yield Batch('movies', filmworks_data, None)
+                yield Batch('movies', None, dict(postgres_service.states_after_save))
+            yield from self._filmworks_persons_batches()
+            while genres_data := list(postgres_service.stream_genres_data()):
+                yield Batch('genres', genres_data, dict(postgres_service.states_after_save))
+            while persons_data := list(postgres_service.stream_persons_data()):
+                yield Batch('persons', persons_data, dict(postgres_service.states_after_save))
+            return
+
+        while self.denormalized and (filmworks_documents := postgres_service.load_filmworks_documents()) is not None:
+            yield Batch('movies', filmworks_documents, dict(postgres_service.states_after_save))
+        while not self.denormalized and (filmworks_data := postgres_service.load_filmworks_data()) is not None:
+            # Page of changed genres and persons without films only moves states.
+            film_work_data = filmworks_data if filmworks_data[0] else None
+            yield Batch('movies', film_work_data, dict(postgres_service.states_after_save))
+        yield from self._filmworks_persons_batches()
+        while genres_data := postgres_service.load_genres_data():
+            yield Batch('genres', genres_data, dict(postgres_service.states_after_save))
+        while persons_data := postgres_service.load_persons_data():
+            yield Batch('persons', persons_data, dict(postgres_service.states_after_save))
+
+    def _filmworks_persons_batches(self) -> Iterator[Batch]:
+        """Extract cast of films of changed persons, when partial person updates are enabled."""
+        postgres_service = self.postgres_service
+        while (filmworks_persons := postgres_service.load_filmworks_persons()) is not None:
+            yield Batch('movies', filmworks_persons, dict(postgres_service.states_after_save), partial=True)
@@ -1,27 +1,31 @@
-"""Get raw data from postgres."""
+"""Get raw data from postgres.
+
+Queries use positional parameters ($1, $2, ...), so their text stays the same for every batch
+and postgres may plan them once as prepared statements.
+"""
 
 genres_query = """
                     SELECT id, updated_at
                     FROM content.genre
-                    WHERE updated_at > '{0}'
-                    ORDER BY updated_at
-                    LIMIT 100;
+                    WHERE (updated_at, id) > ($1, $2)
+                    ORDER BY updated_at, id
+                    LIMIT $3;
                 """
 
 filmworks_by_genre = """
                         SELECT gfw.film_work_id
                         FROM content.genre_film_work gfw
                         INNER JOIN content.film_work fw ON gfw.film_work_id = fw.id
-                        WHERE gfw.genre_id IN {0}
+                        WHERE gfw.genre_id = ANY($1::uuid[])
                         ORDER BY fw.updated_at;
                     """
 
 persons_query = """
             SELECT id, updated_at
             FROM content.person
-            WHERE updated_at > '{0}'
-            ORDER BY updated_at
-            LIMIT 100;
+            WHERE (updated_at, id) > ($1, $2)
+            ORDER BY updated_at, id
+            LIMIT $3;
         """
 
 filmworks_data_query = """
@@ -29,7 +33,7 @@ filmworks_data_query = """
                 FROM content.person_film_work pfw
                 INNER JOIN content.person prs ON (pfw.person_id = prs.id)
                 INNER JOIN content.film_work fw ON (pfw.film_work_id = fw.id)
-                WHERE pfw.person_id IN {persons_ids} OR fw.id IN {filmworks_ids}
+                WHERE pfw.person_id = ANY($1::uuid[]) OR fw.id = ANY($2::uuid[])
                 ORDER BY fw.updated_at;
             """
 
@@ -38,10 +42,24 @@ filmworks_persons_query = """
                 FROM content.person_film_work pfw
                 INNER JOIN content.person prs ON (pfw.person_id = prs.id)
                 INNER JOIN content.film_work fw ON (pfw.film_work_id = fw.id)
-                WHERE pfw.person_id IN {persons_ids}
+                WHERE pfw.person_id = ANY($1::uuid[])
                 ORDER BY fw.updated_at;
             """
 
+filmworks_by_person = """
+                        SELECT DISTINCT pfw.film_work_id
+                        FROM content.person_film_work pfw
+                        WHERE pfw.person_id = ANY($1::uuid[]);
+                    """
+
+filmworks_persons_by_ids_query = """
+                SELECT pfw.film_work_id, pfw.person_id, pfw.role, prs.full_name, fw.updated_at
+                FROM content.person_film_work pfw
+                INNER JOIN content.person prs ON (pfw.person_id = prs.id)
+                INNER JOIN content.film_work fw ON (pfw.film_work_id = fw.id)
+                WHERE fw.id = ANY($1::uuid[]);
+            """
+
 filmworks_additional_query = """
             SELECT fw.id,
                    fw.title,
@@ -51,30 +69,145 @@ filmworks_additional_query = """
             FROM content.film_work fw
              LEFT OUTER JOIN content.genre_film_work gfw ON (fw.id = gfw.film_work_id)
              LEFT OUTER JOIN content.genre ON (gfw.genre_id = content.genre.id)
-             WHERE fw.id IN {filmworks_ids}
+             WHERE fw.id = ANY($1::uuid[])
              GROUP BY fw.id;
         """
 
 genres_data_query = """
                     SELECT id, name, description, updated_at
                     FROM content.genre
-                    WHERE updated_at > '{0}'
-                    ORDER BY updated_at
-                    LIMIT 100;
+                    WHERE (updated_at, id) > ($1, $2)
+                    ORDER BY updated_at, id
+                    LIMIT $3;
                 """
 
-persons_data_query = """
-                    SELECT pfw.person_id, p.full_name, pfw.role, p.updated_at
-                    FROM content.person_film_work pfw
-                    INNER JOIN content.person p ON (pfw.person_id = p.id)
-                    WHERE p.updated_at > '{0}'
-                    ORDER BY p.updated_at
-                    LIMIT 100;
+# Persons of `persons_page` aggregated to elastic documents, one row per person.
+# Roles and films are distinct and ordered, so the same credits always give the same document.
+persons_page_documents = """
+                    SELECT p.id,
+                           p.full_name,
+                           ARRAY_AGG(DISTINCT pfw.role ORDER BY pfw.role)::text[] AS roles,
+                           ARRAY_AGG(DISTINCT pfw.film_work_id ORDER BY pfw.film_work_id)::text[] AS film_ids,
+                           p.updated_at
+                    FROM persons_page p
+                    INNER JOIN content.person_film_work pfw ON (pfw.person_id = p.id)
+                    GROUP BY p.id, p.full_name, p.updated_at
+"""
+
+persons_documents_query = """
+                    WITH persons_page AS (
+                        SELECT id, full_name, updated_at
+                        FROM content.person prs
+                        WHERE (updated_at, id) > ($1, $2)
+                          AND EXISTS (SELECT 1 FROM content.person_film_work WHERE person_id = prs.id)
+                        ORDER BY updated_at, id
+                        LIMIT $3
+                    )
+""" + persons_page_documents + """
+                    ORDER BY p.updated_at, p.id;
                 """
 
-films_by_person_query = """
-                SELECT pfw.person_id, ARRAY_AGG(DISTINCT pfw.film_work_id) AS film_ids
+# Cast of the film `fw` aggregated to elastic document fields.
+# Cast is ordered, so the same cast always gives the same document.
+filmwork_persons_lateral = """
+             LEFT JOIN LATERAL (
+                SELECT (ARRAY_AGG(prs.full_name ORDER BY prs.full_name, prs.id)
+                           FILTER (WHERE pfw.role = 'director'))[1] AS director,
+                       JSON_AGG(JSON_BUILD_OBJECT('id', prs.id, 'name', prs.full_name) ORDER BY prs.full_name, prs.id)
+                           FILTER (WHERE pfw.role = 'actor') AS actors,
+                       ARRAY_AGG(prs.full_name ORDER BY prs.full_name, prs.id)
+                           FILTER (WHERE pfw.role = 'actor') AS actors_names,
+                       JSON_AGG(JSON_BUILD_OBJECT('id', prs.id, 'name', prs.full_name) ORDER BY prs.full_name, prs.id)
+                           FILTER (WHERE pfw.role = 'writer') AS writers,
+                       ARRAY_AGG(prs.full_name ORDER BY prs.full_name, prs.id)
+                           FILTER (WHERE pfw.role = 'writer') AS writers_names
                 FROM content.person_film_work pfw
-                WHERE pfw.person_id IN {persons_ids}
-                GROUP BY pfw.person_id;
-            """
+                INNER JOIN content.person prs ON (pfw.person_id = prs.id)
+                WHERE pfw.film_work_id = fw.id
+             ) persons ON TRUE
+"""
+
+filmworks_documents_select = """
+            SELECT fw.id,
+                   fw.title,
+                   fw.description,
+                   fw.rating,
+                   COALESCE(genres.names, ARRAY[]::text[]),
+                   persons.director,
+                   COALESCE(persons.actors, '[]'::json),
+                   COALESCE(persons.actors_names, ARRAY[]::text[]),
+                   COALESCE(persons.writers, '[]'::json),
+                   COALESCE(persons.writers_names, ARRAY[]::text[])
+            FROM content.film_work fw
+             LEFT JOIN LATERAL (
+                SELECT ARRAY_AGG(DISTINCT g.name) AS names
+                FROM content.genre_film_work gfw
+                INNER JOIN content.genre g ON (gfw.genre_id = g.id)
+                WHERE gfw.film_work_id = fw.id
+             ) genres ON TRUE
+""" + filmwork_persons_lateral
+
+filmworks_documents_query = filmworks_documents_select + """
+             WHERE fw.id = ANY($3::uuid[]) OR fw.id IN (
+                SELECT gfw.film_work_id FROM content.genre_film_work gfw WHERE gfw.genre_id = ANY($1::uuid[])
+                UNION
+                SELECT pfw.film_work_id FROM content.person_film_work pfw WHERE pfw.person_id = ANY($2::uuid[])
+             );
+        """
+
+# Pages of id range ($1, $2], for full reindex split to partitions by id ranges.
+filmworks_documents_range_query = filmworks_documents_select + """
+             WHERE fw.id > $1 AND fw.id <= $2
+             ORDER BY fw.id
+             LIMIT $3;
+        """
+
+genres_range_query = """
+                    SELECT id, name, description, updated_at
+                    FROM content.genre
+                    WHERE id > $1 AND id <= $2
+                    ORDER BY id
+                    LIMIT $3;
+                """
+
+persons_documents_range_query = """
+                    WITH persons_page AS (
+                        SELECT id, full_name, updated_at
+                        FROM content.person prs
+                        WHERE id > $1 AND id <= $2
+                          AND EXISTS (SELECT 1 FROM content.person_film_work WHERE person_id = prs.id)
+                        ORDER BY id
+                        LIMIT $3
+                    )
+""" + persons_page_documents + """
+                    ORDER BY p.id;
+                """
+
+filmworks_persons_documents_query = """
+            SELECT fw.id,
+                   persons.director,
+                   COALESCE(persons.actors, '[]'::json),
+                   COALESCE(persons.actors_names, ARRAY[]::text[]),
+                   COALESCE(persons.writers, '[]'::json),
+                   COALESCE(persons.writers_names, ARRAY[]::text[])
+            FROM content.film_work fw
+""" + filmwork_persons_lateral + """
+             WHERE fw.id IN (
+                SELECT pfw.film_work_id FROM content.person_film_work pfw WHERE pfw.person_id = ANY($1::uuid[])
+             );
+        """
+
+genres_by_ids_query = """
+                    SELECT id, name, description, updated_at
+                    FROM content.genre
+                    WHERE id = ANY($1::uuid[]);
+                """
+
+persons_documents_by_ids_query = """
+                    WITH persons_page AS (
+                        SELECT id, full_name, updated_at
+                        FROM content.person
+                        WHERE id = ANY($1::uuid[])
+                    )
+""" + persons_page_documents + """;
+                """
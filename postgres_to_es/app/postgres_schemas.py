@@ -57,31 +57,69 @@ class GenreData:
 
 
 @dataclass
-class PersonsData:
+class PersonDocument:
 
     __slots__ = (
         'id',
         'full_name',
-        'role',
-        'updated_at'
+        'roles',
+        'film_ids',
+        'updated_at',
     )
 
     id: str
     full_name: str
-    role: List[str]
+    roles: List[str]
+    film_ids: List[str]
     updated_at: Optional[datetime]
 
 
 @dataclass
-class FilmsByPerson:
+class FilmworkDocument:
 
     __slots__ = (
         'id',
-        'film_ids'
+        'title',
+        'description',
+        'rating',
+        'genres',
+        'director',
+        'actors',
+        'actors_names',
+        'writers',
+        'writers_names',
     )
 
     id: str
-    film_ids: List[str]
+    title: str
+    description: Optional[str]
+    rating: Optional[float]
+    genres: List[str]
+    director: Optional[str]
+    actors: List[dict]
+    actors_names: List[str]
+    writers: List[dict]
+    writers_names: List[str]
+
+
+@dataclass
+class FilmworkPersons:
+
+    __slots__ = (
+        'id',
+        'director',
+        'actors',
+        'actors_names',
+        'writers',
+        'writers_names',
+    )
+
+    id: str
+    director: Optional[str]
+    actors: List[dict]
+    actors_names: List[str]
+    writers: List[dict]
+    writers_names: List[str]
 
 
 class InstanceSchema(BaseModel):
@@ -104,6 +142,17 @@ class FilmworkSchema(BaseModel):
     writers: List[InstanceSchema]
 
 
+class FilmworkPersonsSchema(BaseModel):
+    """Part of filmwork document updated when persons change."""
+
+    id: str
+    director: Optional[str] = None
+    actors_names: List[str]
+    writers_names: List[str]
+    actors: List[InstanceSchema]
+    writers: List[InstanceSchema]
+
+
 class GenreSchema(BaseModel):
 
     id: str
@@ -0,0 +1,90 @@
+"""Opt-in profiling of ETL batches with cProfile and tracemalloc.
+
+Methods are wrapped only when profiling is enabled, so disabled profiling costs nothing.
+"""
+import cProfile
+import functools
+import itertools
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from typing import Callable
+
+from service import ElasticSaverService, PostgresLoaderService, TransformDataService
+from settings import ProfilingSettings
+
+logger = logging.getLogger()
+
+PROFILED_METHODS = {
+    PostgresLoaderService: ('load_filmworks_data', 'load_filmworks_documents'),
+    TransformDataService: (
+        'transform_filmworks_data',
+        'transform_filmworks_documents',
+        'transform_filmworks_persons',
+        'transform_genres_data',
+        'transform_persons_data',
+    ),
+    ElasticSaverService: ('bulk_store',),
+}
+
+
+class BatchProfiler:
+    """Profile sampled calls and write `.pstats` and top allocations of every profiled call to `directory`.
+
+    tracemalloc traces the whole process, so only one call is profiled at a time, calls
+    made by other threads meanwhile run as usual.
+    """
+
+    def __init__(self, directory: str = 'profiles', sample_rate: float = 1.0, top: int = 25):
+        self.directory = directory
+        self.sample_rate = sample_rate
+        self.top = top
+        self.lock = threading.Lock()
+        self.numbers = itertools.count(1)
+        os.makedirs(directory, exist_ok=True)
+
+    def _write(self, name: str, profile: cProfile.Profile, snapshot: tracemalloc.Snapshot, peak: int) -> None:
+        file_name = os.path.join(
+            self.directory, '{0}_{1:05d}_{2}'.format(time.strftime('%Y%m%d%H%M%S'), next(self.numbers), name),
+        )
+        profile.dump_stats(file_name + '.pstats')
+        with open(file_name + '.allocations.txt', 'w') as report:
+            report.write('Peak traced memory: {0:.1f} KiB\n'.format(peak / 1024))
+            for statistic in snapshot.statistics('lineno')[:self.top]:
+                report.write('{0}\n'.format(statistic))
+        logger.info('Profile of %s written to %s.', name, file_name)
+
+    def wrap(self, func: Callable) -> Callable:
+        @functools.wraps(func)
+        def profiled(*args, **kwargs):
+            if random.random() >= self.sample_rate or not self.lock.acquire(blocking=False):
+                return func(*args, **kwargs)
+            try:
+                tracemalloc.start()
+                profile = cProfile.Profile()
+                profile.enable()
+                try:
+                    return func(*args, **kwargs)
+                finally:
+                    profile.disable()
+                    snapshot = tracemalloc.take_snapshot()
+                    _, peak = tracemalloc.get_traced_memory()
+                    tracemalloc.stop()
+                    self._write(func.__name__, profile, snapshot, peak)
+            finally:
+                self.lock.release()
+
+        return profiled
+
+
+def enable_profiling(settings: ProfilingSettings) -> BatchProfiler:
+    """Wrap methods of sync services by profiler, for all their instances."""
+    profiler = BatchProfiler(settings.directory, settings.sample_rate, settings.top)
+    for service_class, names in PROFILED_METHODS.items():
+        for name in names:
+            setattr(service_class, name, profiler.wrap(getattr(service_class, name)))
+    logger.info('Profiling of %s of batches to %s is enabled.', settings.sample_rate, settings.directory)
+    return profiler
@@ -0,0 +1,73 @@
+"""Blue/green full reindex: data is loaded to new versioned indices, which replace live ones by alias swap."""
+import copy
+import logging
+import re
+from typing import List
+
+from elasticsearch import Elasticsearch
+
+from backoff import backoff
+
+logger = logging.getLogger()
+
+
+def versioned_indices(es: Elasticsearch, alias: str) -> List[str]:
+    """Get existing `{alias}_v{n}` indices ordered by version."""
+    pattern = re.compile(r'^{0}_v(\d+)$'.format(re.escape(alias)))
+    indices = es.indices.get(index='{0}_v*'.format(alias), ignore_unavailable=True, allow_no_indices=True)
+    return sorted((name for name in indices if pattern.match(name)), key=lambda name: int(pattern.match(name)[1]))
+
+
+def next_index_name(es: Elasticsearch, alias: str) -> str:
+    indices = versioned_indices(es, alias)
+    version = int(indices[-1].rsplit('_v', 1)[1]) + 1 if indices else 1
+    return '{0}_v{1}'.format(alias, version)
+
+
+@backoff()
+def create_bulk_index(es: Elasticsearch, index_name: str, index_settings: dict) -> None:
+    """Create index tuned for bulk load: no refreshes and no replicas until load is finished."""
+    body = copy.deepcopy(index_settings)
+    body.setdefault('settings', {}).update({'refresh_interval': '-1', 'number_of_replicas': 0})
+    # Ignore 400 means to ignore "Index Already Exist" error of retried request.
+    es.indices.create(index=index_name, ignore=400, body=body)
+    logger.info('Index %s created for bulk load.', index_name)
+
+
+@backoff()
+def finish_bulk_index(es: Elasticsearch, index_name: str, index_settings: dict, max_num_segments: int = 1) -> None:
+    """Restore settings of index schema, then refresh and force merge the index.
+
+    Settings missing in schema are reset to elastic defaults.
+    """
+    settings = index_settings.get('settings', {})
+    es.indices.put_settings(index=index_name, body={
+        'index': {
+            'refresh_interval': settings.get('refresh_interval'),
+            'number_of_replicas': settings.get('number_of_replicas'),
+        },
+    })
+    es.indices.refresh(index=index_name)
+    es.indices.forcemerge(index=index_name, max_num_segments=max_num_segments, request_timeout=3600)
+    logger.info('Index %s settings restored and merged to %s segments.', index_name, max_num_segments)
+
+
+@backoff()
+def swap_alias(es: Elasticsearch, alias: str, index_name: str, keep_versions: int = 1) -> None:
+    """Point `alias` to `index_name` with one atomic request and delete versions older than `keep_versions`.
+
+    Index created before blue/green reindex has the alias name itself, it is deleted by the same request.
+    """
+    actions = [{'add': {'index': index_name, 'alias': alias}}]
+    if es.indices.exists_alias(name=alias):
+        old_indices = list(es.indices.get_alias(name=alias))
+        actions.extend({'remove': {'index': old_index, 'alias': alias}} for old_index in old_indices)
+    elif es.indices.exists(index=alias):
+        actions.append({'remove_index': {'index': alias}})
+    es.indices.update_aliases(body={'actions': actions})
+    logger.info('Alias %s switched to %s.', alias, index_name)
+
+    previous_versions = [name for name in versioned_indices(es, alias) if name != index_name]
+    for old_index in previous_versions[:max(len(previous_versions) - keep_versions, 0)]:
+        es.indices.delete(index=old_index, ignore_unavailable=True)
+        logger.info('Old index %s deleted.', old_index)
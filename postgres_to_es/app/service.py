@@ -1,170 +1,600 @@
 """Service to load data from postgres to elasticsearch."""
+import json
 import logging
-
-from collections import defaultdict
-from datetime import date
-from typing import List, Tuple
-
-from backoff import backoff
-
-from elasticsearch import Elasticsearch
-from elasticsearch.helpers import bulk
+import random
+import re
+import time
+
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from datetime import date, datetime
+from functools import lru_cache
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Type, TypeVar
+from uuid import uuid4
+
+from backoff import NotRetriedError, backoff, exponential_sleep_generator
+from bulk_writer import NdjsonBulkWriter
+from connections import PostgresPool
+from dead_letters import DeadLetterSpool
+from fingerprints import FingerprintStore
+from metrics import METRICS, record_stage, stage
+from throttle import BulkThrottle
+
+import psycopg2
+from elasticsearch import ConnectionError as ElasticConnectionError, Elasticsearch, TransportError
+from elasticsearch.helpers import parallel_bulk, streaming_bulk
+from pydantic import BaseModel
+from pydantic.fields import SHAPE_LIST
 
 from postgres_data_query import (
     filmworks_additional_query,
     filmworks_by_genre,
-    films_by_person_query,
+    filmworks_by_person,
     filmworks_data_query,
+    filmworks_documents_query,
+    filmworks_documents_range_query,
+    filmworks_persons_by_ids_query,
+    filmworks_persons_documents_query,
     filmworks_persons_query,
+    genres_by_ids_query,
+    genres_range_query,
     genres_query,
     genres_data_query,
+    persons_documents_by_ids_query,
+    persons_documents_range_query,
     persons_query,
-    persons_data_query,
+    persons_documents_query,
 )
 from postgres_schemas import (
     MovieData,
     PersonFilm,
     GenreData,
-    PersonsData,
+    PersonDocument,
     FilmworkSchema,
     GenreSchema,
     PersonSchema,
-    FilmsByPerson,
+    FilmworkDocument,
+    FilmworkPersons,
+    FilmworkPersonsSchema,
 )
-from state_saver import JsonFileStorage, State
+from state_saver import State, create_state
 
 logger = logging.getLogger()
 
 BASE_STATE = date.min.strftime('%Y-%m-%d %X')
+BASE_ID = '00000000-0000-0000-0000-000000000000'
 
+# Elastic answers these statuses for documents it can accept later.
+RETRY_STATUSES = (429, 503)
 
-class PostgresLoaderService:
-    """Save data to postgres."""
+# Only fields of bulk response needed to account documents.
+BULK_FILTER_PATH = ['items.*._id', 'items.*.status', 'items.*.error']
 
-    states_after_save = {}
+# Flags saved once films of all changed genres or persons were loaded, by state keys of the changes.
+FILMS_LOADED_KEYS = {'genres_state': 'genres_films_loaded', 'persons_state': 'persons_films_loaded'}
 
-    def __init__(self, connection):
-        self.connection = connection
-        self.cursor = self.connection.cursor()
-        self.storage = JsonFileStorage('state_config.json')
-        self.state_loader = State(self.storage)
+Row = TypeVar('Row')
 
-    def _make_valid_query_values(self, item: tuple) -> tuple:
-        """Make tuple without one value comma for query."""
-        return (item[0], '') if len(item) == 1 else item
 
-    @backoff()
-    def load_filmworks_data(self) -> Tuple[List[MovieData], List[PersonFilm]]:
-        """Load raw data from postgres."""
+class BaseLoaderService:
+    """States handling shared by postgres loaders.
 
-        genres_state = self.state_loader.get_state('genres_state')
-        if not genres_state:
-            genres_state = BASE_STATE
+    State of every entity is the (updated_at, id) pair of its last extracted row,
+    so rows with equal updated_at are never skipped between batches.
+    """
 
-        self.cursor.execute(genres_query.format(genres_state))
-        genres_data = self.cursor.fetchall()
-        genres_ids = tuple([genre_id[0] for genre_id in genres_data])
+    def __init__(
+        self,
+        state_loader: Optional[State] = None,
+        genre_batch_size: int = 100,
+        person_batch_size: int = 100,
+        propagate_genre_renames: bool = False,
+        partial_person_updates: bool = False,
+    ):
+        self.state_loader = state_loader or create_state()
+        self.genre_batch_size = genre_batch_size
+        self.person_batch_size = person_batch_size
+        # Genre renames and person changes may be applied to movies in elastic without reloading
+        # whole films, once films of all genres or persons were loaded.
+        self.propagate_genre_renames = propagate_genre_renames
+        self.partial_person_updates = partial_person_updates
+        self.films_loaded = {
+            state_key: bool(self.state_loader.get_state(flag_key))
+            for state_key, flag_key in FILMS_LOADED_KEYS.items()
+        }
+        self.states_after_save = {}
+
+    def _extract_state(self, state_key: str) -> Tuple[str, str]:
+        """Get state to extract from.
+
+        Extracted batches may still be on their way to elastic, so extraction goes on from the
+        last extracted state, and saved state is used only for the first batch.
+        """
+        state = self.states_after_save.get(state_key) or self.state_loader.get_state(state_key) or BASE_STATE
+        if isinstance(state, str):
+            # States saved before keyset pagination keep only updated_at.
+            return state, BASE_ID
+        return state[0], state[1]
+
+    def _ids_to_reload(self, state_key: str, changed_ids: List[str], applied_in_elastic: bool) -> List[str]:
+        """Get ids of changed genres or persons whose films have to be reloaded whole.
+
+        Films are loaded for all of them once no changes are left after the state, the flag of it
+        is saved with states of the next load. Load interrupted before has not loaded all films yet.
+        """
+        if not changed_ids and not self.films_loaded[state_key]:
+            self.films_loaded[state_key] = True
+            self.states_after_save[FILMS_LOADED_KEYS[state_key]] = True
+        if not applied_in_elastic or not self.films_loaded[state_key]:
+            return changed_ids
+        return []
+
+    def _remember_state(self, state_key: str, updated_at: datetime, row_id: str) -> None:
+        """Remember state of extracted row to save it after load."""
+        self.states_after_save[state_key] = [str(updated_at), row_id]
+
+
+class PostgresLoaderService(BaseLoaderService):
+    """Save data to postgres."""
 
-        if genres_ids:
-            genres_ids = self._make_valid_query_values(genres_ids)
-            new_genre_state = str(genres_data[0][1])
-            final_genre_state = str(genres_data[-1][1])
-            self.states_after_save['genres_state'] = final_genre_state
+    def __init__(
+        self,
+        connection=None,
+        itersize: int = 1000,
+        pool: Optional[PostgresPool] = None,
+        in_snapshot: bool = False,
+        **kwargs,
+    ):
+        """Use `connection`, or borrow one from `pool`, then broken connection is replaced by retries.
+
+        With `in_snapshot` the connection is in a transaction attached to an exported snapshot,
+        failed queries are not retried then, as a new transaction would not read the snapshot.
+        """
+        super().__init__(**kwargs)
+        self.pool = pool
+        self.in_snapshot = in_snapshot
+        self.connection = connection
+        self.cursor = connection.cursor() if connection else None
+        self.itersize = itersize
+        self.prepared_statements: Dict[str, Tuple[str, List[str]]] = {}
+
+    def _connect(self) -> None:
+        """Borrow connection from the pool, if the service has none since it was lost or released.
+
+        Borrowing fails while postgres is not available, then the query is retried by backoff.
+        """
+        if self.connection is None:
+            self.connection = self.pool.getconn()
+            self.cursor = self.connection.cursor()
+
+    def _recover(self, error: psycopg2.Error) -> None:
+        """Make connection usable for retry after failed query.
+
+        Failed transaction is rolled back. Lost connection is returned to the pool as broken and
+        a live one is borrowed by the next query. Prepared statements are forgotten in both cases,
+        as the failed transaction may have prepared them.
+        Raise NotRetriedError if the connection can not be made usable.
+        """
+        self.prepared_statements.clear()
+        if self.in_snapshot:
+            raise NotRetriedError('Query failed in a transaction reading exported snapshot.') from error
+        lost = self.connection.closed or isinstance(error, (psycopg2.InterfaceError, psycopg2.OperationalError))
+        if not lost:
+            try:
+                self.connection.rollback()
+                self.cursor.execute('DEALLOCATE ALL')
+                return
+            except psycopg2.Error:
+                # Connection died during rollback, it is replaced like a lost one.
+                pass
+        if self.pool is None:
+            raise NotRetriedError('Postgres connection is lost, there is no pool to borrow another one.') from error
+        logger.info('Postgres connection is lost, borrow another one.')
+        self.pool.putconn(self.connection, broken=True)
+        self.connection = self.cursor = None
+
+    def release(self) -> None:
+        """Return borrowed connection to the pool.
+
+        Prepared statements are deallocated, the next borrower numbers its statements from zero.
+        """
+        if self.pool is None or self.connection is None:
+            return
+        self.prepared_statements.clear()
+        connection, self.connection, self.cursor = self.connection, None, None
+        try:
+            connection.rollback()
+            connection.cursor().execute('DEALLOCATE ALL')
+        except psycopg2.Error:
+            self.pool.putconn(connection, broken=True)
+            return
+        self.pool.putconn(connection)
+
+    def commit(self) -> None:
+        """End read transaction, so it does not stay open between loads."""
+        if self.connection is not None:
+            self.connection.commit()
+
+    def _execute(self, query: str, *params) -> None:
+        """Execute query as prepared statement, postgres parses and plans it once per connection."""
+        self._connect()
+        try:
+            if query not in self.prepared_statements:
+                name = 'etl_{0}'.format(len(self.prepared_statements))
+                self.cursor.execute('PREPARE {0} AS {1}'.format(name, query))
+                self.cursor.execute(
+                    'SELECT parameter_types::text[] FROM pg_prepared_statements WHERE name = %s',
+                    (name,),
+                )
+                self.prepared_statements[query] = name, self.cursor.fetchone()[0]
+
+            name, parameter_types = self.prepared_statements[query]
+            # Python values are sent as literals, so every parameter is cast to the type postgres expects.
+            placeholders = ', '.join(['%s::{0}'.format(parameter_type) for parameter_type in parameter_types])
+            self.cursor.execute('EXECUTE {0} ({1})'.format(name, placeholders), params)
+        except psycopg2.Error as error:
+            self._recover(error)
+            raise
+
+    def _fetchall(self, query: str, *params) -> list:
+        self._execute(query, *params)
+        return self.cursor.fetchall()
+
+    def _stream(self, query: str, row_type: Type[Row], *params) -> Iterator[Row]:
+        """Yield typed rows from a server-side named cursor, `itersize` rows per round trip.
+
+        Cursor can not be declared for EXECUTE, so parameters are bound by psycopg2 here.
+        """
+        query = re.sub(r'\$(\d+)', r'%(p\1)s', query)
+        self._connect()
+        try:
+            with self.connection.cursor(name='etl_{0}'.format(uuid4().hex)) as cursor:
+                cursor.itersize = self.itersize
+                cursor.execute(query, {'p{0}'.format(number): param for number, param in enumerate(params, 1)})
+                for row in cursor:
+                    yield row_type(*row)
+        except psycopg2.Error as error:
+            self._recover(error)
+            raise
+
+    def _chunks(self, rows: Iterable[Row]) -> Iterator[List[Row]]:
+        """Split rows to lists of `itersize` length."""
+        rows = iter(rows)
+        while chunk := list(islice(rows, self.itersize)):
+            yield chunk
+
+    def _changed_ids(self, state_key: str, query: str, limit: int) -> List[str]:
+        """Get ids changed since saved state and remember state to save after load."""
+        changed_data = self._fetchall(query, *self._extract_state(state_key), limit)
+        if changed_data:
+            self._remember_state(state_key, changed_data[-1][1], changed_data[-1][0])
+        return [item[0] for item in changed_data]
+
+    def _changed_genres_ids(self) -> List[str]:
+        """Get ids of changed genres to reload their films."""
+        genres_ids = self._changed_ids('genres_state', genres_query, self.genre_batch_size)
+        return self._ids_to_reload('genres_state', genres_ids, self.propagate_genre_renames)
+
+    def _changed_persons_ids(self) -> List[str]:
+        """Get ids of changed persons to reload their films."""
+        if self.partial_person_updates and self.films_loaded['persons_state']:
+            # Changes are left to load_filmworks_persons, which moves the state then.
+            return []
+        persons_ids = self._changed_ids('persons_state', persons_query, self.person_batch_size)
+        return self._ids_to_reload('persons_state', persons_ids, self.partial_person_updates)
+
+    @stage('extract')
+    @backoff()
+    def load_filmworks_data(self) -> Optional[Tuple[List[MovieData], List[PersonFilm]]]:
+        """Load raw data from postgres.
 
-            self.state_loader.set_state('genres_state', new_genre_state)
-            self.cursor.execute(filmworks_by_genre.format(genres_ids))
-        filmworks_data_genres = self.cursor.fetchall()
-        filmworks_ids_changed_genres = tuple([filmwork_id[0] for filmwork_id in filmworks_data_genres])
+        Return None if there are no changed genres and persons. Changed genres and persons
+        may have no films, then empty lists are returned and states still have to be saved.
+        """
 
-        persons_state = self.state_loader.get_state('persons_state')
-        if not persons_state:
-            persons_state = BASE_STATE
+        genres_ids = self._changed_genres_ids()
+        persons_ids = self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
 
-        self.cursor.execute(persons_query.format(persons_state))
-        persons_data = self.cursor.fetchall()
-        persons_ids = tuple([person_id[0] for person_id in persons_data])
+        filmworks_ids_changed_genres = []
+        if genres_ids:
+            filmworks_data_genres = self._fetchall(filmworks_by_genre, genres_ids)
+            filmworks_ids_changed_genres = [filmwork_id[0] for filmwork_id in filmworks_data_genres]
 
+        filmworks_data_persons = []
         if persons_ids and filmworks_ids_changed_genres:
-            persons_ids = self._make_valid_query_values(persons_ids)
-            filmworks_ids_changed_genres = self._make_valid_query_values(filmworks_ids_changed_genres)
-            new_person_state = str(persons_data[0][1])
-            final_person_state = str(persons_data[-1][1])
-            self.states_after_save['persons_state'] = final_person_state
-            self.state_loader.set_state('persons_state', new_person_state)
-
-            self.cursor.execute(
-                filmworks_data_query.format(persons_ids=persons_ids, filmworks_ids=filmworks_ids_changed_genres),
-            )
+            filmworks_data_persons = self._fetchall(filmworks_data_query, persons_ids, filmworks_ids_changed_genres)
         elif persons_ids:
-            persons_ids = self._make_valid_query_values(persons_ids)
-            new_person_state = str(persons_data[0][1])
-            final_person_state = str(persons_data[-1][1])
-            self.states_after_save['persons_state'] = final_person_state
-            self.state_loader.set_state('persons_state', new_person_state)
+            filmworks_data_persons = self._fetchall(filmworks_persons_query, persons_ids)
 
-            self.cursor.execute(filmworks_persons_query.format(persons_ids=persons_ids))
-
-        filmworks_data_persons = self.cursor.fetchall()
-        filmworks_ids_changed_persons = tuple(set([filmwork_id[0] for filmwork_id in filmworks_data_persons]))
+        filmworks_ids_changed_persons = [filmwork_id[0] for filmwork_id in filmworks_data_persons]
         person_film_data = [PersonFilm(*item) for item in filmworks_data_persons]
 
-        final_filmworks_ids = tuple(set(filmworks_ids_changed_genres + filmworks_ids_changed_persons))
-
+        final_filmworks_ids = list(set(filmworks_ids_changed_genres + filmworks_ids_changed_persons))
+        additional_film_data = []
         if final_filmworks_ids:
-            final_filmworks_ids = self._make_valid_query_values(final_filmworks_ids)
-            self.cursor.execute(filmworks_additional_query.format(filmworks_ids=final_filmworks_ids))
-        additional_film_data = self.cursor.fetchall()
+            additional_film_data = self._fetchall(filmworks_additional_query, final_filmworks_ids)
         film_work_data = [MovieData(*item) for item in additional_film_data]
 
         return film_work_data, person_film_data
 
-    def load_genres_data(self):
-        """Load genres data from postgres."""
-        genres_data_state = self.state_loader.get_state('genres_data_state')
-        if not genres_data_state:
-            genres_data_state = BASE_STATE
-        self.cursor.execute(genres_data_query.format(genres_data_state))
-        raw_genres_data = self.cursor.fetchall()
-        if raw_genres_data:
-            new_genre_data_state = str(raw_genres_data[0][-1])
-            final_genre_data_state = str(raw_genres_data[-1][-1])
-            self.states_after_save['genres_data_state'] = final_genre_data_state
-            self.state_loader.set_state('genres_data_state', new_genre_data_state)
+    @stage('extract')
+    def stream_filmworks_data(self) -> Optional[Iterator[Tuple[List[MovieData], List[PersonFilm]]]]:
+        """Stream raw filmworks data with batches of `itersize` films.
+
+        Films linked to changed genres and persons are read through server-side cursors,
+        so memory does not depend on the size of the change set.
+        Return None if there are no changed genres and persons.
+        """
+
+        genres_ids = self._changed_genres_ids()
+        persons_ids = self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
+
+        def film_ids() -> Iterator[str]:
+            if genres_ids:
+                yield from self._stream(filmworks_by_genre, str, genres_ids)
+            if persons_ids:
+                yield from self._stream(filmworks_by_person, str, persons_ids)
+
+        def batches() -> Iterator[Tuple[List[MovieData], List[PersonFilm]]]:
+            for filmworks_ids in self._chunks(film_ids()):
+                raw_person_film_data = self._fetchall(filmworks_persons_by_ids_query, filmworks_ids)
+                person_film_data = [PersonFilm(*item) for item in raw_person_film_data]
+                raw_film_work_data = self._fetchall(filmworks_additional_query, filmworks_ids)
+                film_work_data = [MovieData(*item) for item in raw_film_work_data]
+                yield film_work_data, person_film_data
+
+        return batches()
+
+    @stage('extract')
+    @backoff()
+    def load_filmworks_documents(self) -> Optional[List[FilmworkDocument]]:
+        """Load filmwork documents aggregated by postgres, one row per film.
 
-        return [GenreData(*item) for item in raw_genres_data]
+        Films of changed genres and persons are found and aggregated by one query.
+        Return None if there are no changed genres and persons.
+        """
+
+        genres_ids = self._changed_genres_ids()
+        persons_ids = self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
+
+        raw_documents = self._fetchall(filmworks_documents_query, genres_ids, persons_ids, [])
+        return [FilmworkDocument(*item) for item in raw_documents]
+
+    @stage('extract')
+    def stream_filmworks_documents(self) -> Optional[Iterator[List[FilmworkDocument]]]:
+        """Stream filmwork documents aggregated by postgres with batches of `itersize` films.
+
+        Return None if there are no changed genres and persons.
+        """
 
-    def load_persons_data(self):
-        """Load persons data from postgres."""
-        persons_data_state = self.state_loader.get_state('persons_data_state')
-        if not persons_data_state:
-            persons_data_state = BASE_STATE
-        self.cursor.execute(persons_data_query.format(persons_data_state))
-        raw_persons_data = self.cursor.fetchall()
-        persons_ids = tuple([person_id[0] for person_id in raw_persons_data])
+        genres_ids = self._changed_genres_ids()
+        persons_ids = self._changed_persons_ids()
+        if not genres_ids and not persons_ids:
+            return None
 
-        if persons_ids:
-            new_persons_state = str(raw_persons_data[0][-1])
-            final_persons_data_state = str(raw_persons_data[-1][-1])
-            self.states_after_save['persons_data_state'] = final_persons_data_state
-            self.state_loader.set_state('persons_data_state', new_persons_state)
+        return self.stream_filmworks_documents_by_ids(genres_ids, persons_ids, [])
 
-            persons_ids = self._make_valid_query_values(persons_ids)
-            self.cursor.execute(films_by_person_query.format(persons_ids=persons_ids))
+    def stream_filmworks_documents_by_ids(
+        self,
+        genres_ids: List[str],
+        persons_ids: List[str],
+        filmworks_ids: List[str],
+    ) -> Iterator[List[FilmworkDocument]]:
+        """Stream documents of given films and films of given genres and persons, states are not used."""
+        params = (genres_ids, persons_ids, filmworks_ids)
+        return self._chunks(self._stream(filmworks_documents_query, FilmworkDocument, *params))
+
+    @stage('extract')
+    @backoff()
+    def load_filmworks_persons(self) -> Optional[List[FilmworkPersons]]:
+        """Load cast of films of changed persons, to update only cast fields of movies.
+
+        Return None if there are no changed persons or films of changed persons are reloaded whole.
+        """
+        if not self.partial_person_updates or not self.films_loaded['persons_state']:
+            return None
+        persons_ids = self._changed_ids('persons_state', persons_query, self.person_batch_size)
+        if not persons_ids:
+            return None
+        return self.load_filmworks_persons_by_ids(persons_ids)
+
+    def load_filmworks_persons_by_ids(self, persons_ids: List[str]) -> List[FilmworkPersons]:
+        """Load cast of films of given persons, states are not used."""
+        raw_filmworks_persons = self._fetchall(filmworks_persons_documents_query, persons_ids)
+        return [FilmworkPersons(*item) for item in raw_filmworks_persons]
+
+    @stage('extract')
+    def load_genres_data(self):
+        """Load genres data from postgres."""
+        params = (*self._extract_state('genres_data_state'), self.genre_batch_size)
+        raw_genres_data = self._fetchall(genres_data_query, *params)
+        if raw_genres_data:
+            self._remember_state('genres_data_state', raw_genres_data[-1][-1], raw_genres_data[-1][0])
 
-            raw_films_by_persons = self.cursor.fetchall()
-            films_ids_by_person = [FilmsByPerson(*item) for item in raw_films_by_persons]
+        return [GenreData(*item) for item in raw_genres_data]
 
-            return [PersonsData(*item) for item in raw_persons_data], films_ids_by_person
+    @stage('extract')
+    def stream_genres_data(self) -> Iterator[GenreData]:
+        """Stream genres data from postgres."""
+        params = (*self._extract_state('genres_data_state'), self.genre_batch_size)
+        for genre in self._stream(genres_data_query, GenreData, *params):
+            self._remember_state('genres_data_state', genre.updated_at, genre.id)
+            yield genre
+
+    @stage('extract')
+    def load_genres_by_ids(self, genres_ids: List[str]) -> List[GenreData]:
+        """Load data of given genres, states are not used."""
+        return [GenreData(*item) for item in self._fetchall(genres_by_ids_query, genres_ids)]
+
+    @stage('extract')
+    def load_persons_data(self) -> List[PersonDocument]:
+        """Load persons documents aggregated by postgres, `person_batch_size` persons with all their credits."""
+        params = (*self._extract_state('persons_data_state'), self.person_batch_size)
+        persons_documents = [PersonDocument(*item) for item in self._fetchall(persons_documents_query, *params)]
+        if persons_documents:
+            self._remember_state('persons_data_state', persons_documents[-1].updated_at, persons_documents[-1].id)
+        return persons_documents
+
+    @stage('extract')
+    def stream_persons_data(self) -> Iterator[PersonDocument]:
+        """Stream persons documents from postgres."""
+        params = (*self._extract_state('persons_data_state'), self.person_batch_size)
+        for person in self._stream(persons_documents_query, PersonDocument, *params):
+            self._remember_state('persons_data_state', person.updated_at, person.id)
+            yield person
+
+    @stage('extract')
+    def load_persons_by_ids(self, persons_ids: List[str]) -> List[PersonDocument]:
+        """Load documents of given persons, states are not used."""
+        return [PersonDocument(*item) for item in self._fetchall(persons_documents_by_ids_query, persons_ids)]
+
+    @stage('extract')
+    def load_filmworks_documents_range(self, last_id: str, upper_id: str) -> List[FilmworkDocument]:
+        """Load `itersize` filmwork documents with ids after `last_id` up to `upper_id`, states are not used."""
+        raw_documents = self._fetchall(filmworks_documents_range_query, last_id, upper_id, self.itersize)
+        return [FilmworkDocument(*item) for item in raw_documents]
+
+    @stage('extract')
+    def load_genres_range(self, last_id: str, upper_id: str) -> List[GenreData]:
+        """Load genres with ids after `last_id` up to `upper_id`, states are not used."""
+        raw_genres_data = self._fetchall(genres_range_query, last_id, upper_id, self.genre_batch_size)
+        return [GenreData(*item) for item in raw_genres_data]
 
+    @stage('extract')
+    def load_persons_range(self, last_id: str, upper_id: str) -> List[PersonDocument]:
+        """Load persons documents with ids after `last_id` up to `upper_id`, states are not used."""
+        raw_documents = self._fetchall(persons_documents_range_query, last_id, upper_id, self.person_batch_size)
+        return [PersonDocument(*item) for item in raw_documents]
+
+
+def genre_rename_query(old_name: str, new_name: str) -> dict:
+    """Get update_by_query body replacing genre name in movies."""
+    return {
+        'query': {'term': {'genre': old_name}},
+        'script': {
+            'lang': 'painless',
+            'source': (
+                'for (int i = 0; i < ctx._source.genre.size(); i++) {'
+                ' if (ctx._source.genre[i] == params.old_name) { ctx._source.genre[i] = params.new_name; } '
+                '}'
+            ),
+            'params': {'old_name': old_name, 'new_name': new_name},
+        },
+    }
+
+
+def changed_documents(
+    fingerprints: Optional[FingerprintStore],
+    index_name: str,
+    docs: List[dict],
+    partial: bool = False,
+) -> Tuple[List[dict], Dict[str, bytes]]:
+    """Drop documents equal to their indexed versions, return the rest with fingerprints to save after load."""
+    if not fingerprints:
+        return docs, {}
+    if partial:
+        # Fingerprints are kept for whole documents only.
+        fingerprints.forget(index_name, [doc['id'] for doc in docs])
+        return docs, {}
+    changed_docs, changed_fingerprints = fingerprints.changed_documents(index_name, docs)
+    logger.info(
+        'Fingerprints of %s: %s unchanged documents skipped, %s changed.',
+        index_name,
+        len(docs) - len(changed_docs),
+        len(changed_docs),
+    )
+    return changed_docs, changed_fingerprints
+
+
+@dataclass
+class BulkResult:
+
+    __slots__ = (
+        'success',
+        'failed',
+        'errors',
+    )
+
+    success: int
+    failed: int
+    errors: List[dict]
+
+
+class BulkStoreError(Exception):
+    """Not all documents of the batch were indexed, so states of the batch were not saved."""
+
+    def __init__(self, index_name: str, result: BulkResult):
+        super().__init__('{0} of {1} documents were not indexed to {2}'.format(
+            result.failed, result.success + result.failed, index_name,
+        ))
+        self.index_name = index_name
+        self.result = result
+
+
+def dead_letter_failures(
+    dead_letters: Optional[DeadLetterSpool],
+    index_name: str,
+    result: BulkResult,
+    sent_docs: Dict[str, dict],
+    fingerprints: Dict[str, bytes],
+    partial: bool = False,
+) -> None:
+    """Spool documents not indexed after all retries, raise BulkStoreError if there is no spool.
+
+    Fingerprints of spooled documents are dropped, so they are not taken as indexed.
+    """
+    if not result.failed:
         return
+    for error in result.errors[:10]:
+        logger.error('Document %s not indexed: %s', error.get('_id'), error.get('error'))
+    if dead_letters is None:
+        raise BulkStoreError(index_name, result)
+    dead_letters.write(index_name, [(sent_docs.get(error.get('_id')), error) for error in result.errors], partial)
+    METRICS.inc('etl_dead_letters_total', len(result.errors), index=index_name)
+    for error in result.errors:
+        fingerprints.pop(error.get('_id'), None)
 
 
 class ElasticSaverService:
     """Save data from postgres to elastic."""
 
-    def __init__(self):
-        self.storage = JsonFileStorage('state_config.json')
-        self.state_loader = State(self.storage)
+    def __init__(
+        self,
+        thread_count: int = 1,
+        chunk_size: int = 500,
+        max_chunk_bytes: int = 100 * 1024 * 1024,
+        max_retries: int = 3,
+        state_loader: Optional[State] = None,
+        ndjson: bool = False,
+        propagate_genre_renames: bool = False,
+        fingerprints: Optional[FingerprintStore] = None,
+        target_indices: Optional[Dict[str, str]] = None,
+        dead_letters: Optional[DeadLetterSpool] = None,
+        throttle: Optional[BulkThrottle] = None,
+    ):
+        self.thread_count = thread_count
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.max_retries = max_retries
+        self.state_loader = state_loader or create_state()
+        self.bulk_writer = NdjsonBulkWriter(chunk_size, max_chunk_bytes) if ndjson else None
+        self.propagate_genre_renames = propagate_genre_renames
+        # Documents equal to their indexed versions are not sent again.
+        self.fingerprints = fingerprints
+        # Documents of an index may be sent to another one, like a new version of it being built.
+        self.target_indices = target_indices or {}
+        # Documents elastic refused for good are spooled, so they do not block states of their batches.
+        self.dead_letters = dead_letters
+        # Bulk size and thread count adapted to elastic load, instead of fixed ones.
+        self.throttle = throttle
 
     @backoff()
     def create_index(self, es: Elasticsearch, index_name: str, index_settings: dict) -> bool:
@@ -177,6 +607,8 @@ class ElasticSaverService:
                 # Ignore 400 means to ignore "Index Already Exist" error.
                 es.indices.create(index=index_name, ignore=400, body=index_settings)
                 logger.info('Index created')
+                if self.fingerprints:
+                    self.fingerprints.forget(index_name)
             created = True
         except Exception as ex:
             logger.exception("Something went wrong in create index: %s", str(ex))
@@ -191,8 +623,16 @@ class ElasticSaverService:
         except Exception as ex:
             logger.exception('Error in indexing data: %s', str(ex))
 
-    def gendata(self, index_name: str, docs: List[dict]) -> dict:
+    def gendata(self, index_name: str, docs: List[dict], partial: bool = False) -> dict:
         for doc in docs:
+            if partial:
+                yield {
+                    "_op_type": "update",
+                    "_index": index_name,
+                    "_id": doc['id'],
+                    "doc": doc
+                }
+                continue
             yield {
                 "_index": index_name,
                 "_id": doc['id'],
@@ -200,97 +640,363 @@ class ElasticSaverService:
             }
 
     @backoff()
-    def bulk_store(self, es: Elasticsearch, index_name: str, list_of_record: List[dict], states: dict = None) -> None:
+    def rename_genres(self, es: Elasticsearch, genres_docs: List[dict]) -> None:
+        """Apply renames of genres to movies in elastic, without reloading the movies from postgres.
+
+        Old names are read from genres index, so it has to be updated after the renames.
+        """
+        names = {doc['id']: doc['name'] for doc in genres_docs}
+        saved_genres = es.mget(index='genres', body={'ids': list(names)}, _source_includes=['name'])
+        for genre in saved_genres['docs']:
+            if not genre.get('found') or genre['_source']['name'] == names[genre['_id']]:
+                continue
+            old_name, new_name = genre['_source']['name'], names[genre['_id']]
+            result = es.update_by_query(
+                index='movies',
+                body=genre_rename_query(old_name, new_name),
+                slices='auto',
+                refresh=True,
+            )
+            if self.fingerprints:
+                # Movies changed in elastic, their saved fingerprints do not match them any more.
+                self.fingerprints.forget('movies')
+            if result.get('failures'):
+                raise Exception('Rename of genre {0} failed: {1}'.format(old_name, result['failures'][:10]))
+            logger.info('Genre %s renamed to %s in %s movies.', old_name, new_name, result.get('updated'))
+
+    @backoff()
+    def _send_bulk(
+        self,
+        es: Elasticsearch,
+        index_name: str,
+        docs: List[dict],
+        partial: bool = False,
+    ) -> Tuple[int, List[dict]]:
+        """Send documents with bulk requests, return count of indexed documents and failed items.
+
+        Partial documents update only their fields of documents already indexed.
+        With throttle bulk size and thread count are taken from it, and it is told how elastic coped.
+        """
+        chunk_size, thread_count = self.throttle.limits() if self.throttle else (self.chunk_size, self.thread_count)
+        options = {
+            'chunk_size': chunk_size,
+            'max_chunk_bytes': self.max_chunk_bytes,
+            'raise_on_error': False,
+        }
+        started = time.perf_counter()
+        success = 0
+        failed_items = []
         try:
-            bulk(es, self.gendata(index_name, list_of_record))
-        except Exception as ex:
-            logger.exception('Error in indexing data: %s', str(ex))
+            if self.bulk_writer:
+                results = self._send_ndjson_bodies(es, index_name, docs, partial, chunk_size, thread_count)
+            elif thread_count > 1:
+                actions = self.gendata(index_name, docs, partial)
+                results = parallel_bulk(es, actions, thread_count=thread_count, **options)
+            else:
+                results = streaming_bulk(es, self.gendata(index_name, docs, partial), **options)
+
+            for ok, item in results:
+                if ok:
+                    success += 1
+                else:
+                    failed_items.append(item)
+        except TransportError as error:
+            # Requests failed whole because of elastic load are retried by backoff with lower limits.
+            if self.throttle and (isinstance(error, ElasticConnectionError) or error.status_code in RETRY_STATUSES):
+                self.throttle.record_overload()
+            raise
+
+        if self.throttle and docs:
+            rejected = sum(next(iter(item.values())).get('status') in RETRY_STATUSES for item in failed_items)
+            self.throttle.record(time.perf_counter() - started, -(-len(docs) // chunk_size), rejected)
+        return success, failed_items
+
+    def _send_ndjson_bodies(
+        self,
+        es: Elasticsearch,
+        index_name: str,
+        docs: List[dict],
+        partial: bool = False,
+        chunk_size: Optional[int] = None,
+        thread_count: Optional[int] = None,
+    ) -> Iterator[Tuple[bool, dict]]:
+        """Send documents serialized by bulk writer, yield result of every document like streaming_bulk does.
+
+        With several threads up to `thread_count` bodies are in flight, the next body is serialized
+        when the oldest response is read, so memory does not grow with the number of documents.
+        """
+
+        def send(body: bytes) -> dict:
+            return es.bulk(body=body, filter_path=BULK_FILTER_PATH)
+
+        def results(response: dict) -> Iterator[Tuple[bool, dict]]:
+            for item in response.get('items', []):
+                info = next(iter(item.values()))
+                yield 200 <= info.get('status', 500) < 300, item
+
+        thread_count = thread_count or self.thread_count
+        bodies = self.bulk_writer.bodies(index_name, docs, partial, chunk_size or self.chunk_size)
+        if thread_count <= 1:
+            for body in bodies:
+                yield from results(send(body))
+            return
+
+        with ThreadPoolExecutor(max_workers=thread_count) as executor:
+            in_flight = deque()
+            for body in bodies:
+                if len(in_flight) >= thread_count:
+                    yield from results(in_flight.popleft().result())
+                in_flight.append(executor.submit(send, body))
+            while in_flight:
+                yield from results(in_flight.popleft().result())
 
+    @backoff()
+    def _send_deletes(self, es: Elasticsearch, index_name: str, ids: List[str]) -> List[dict]:
+        """Send delete actions with bulk requests, return failed items, missing documents are not failures."""
+        actions = ({'_op_type': 'delete', '_index': index_name, '_id': doc_id} for doc_id in ids)
+        options = {'chunk_size': self.chunk_size, 'max_chunk_bytes': self.max_chunk_bytes, 'raise_on_error': False}
+        return [
+            item for ok, item in streaming_bulk(es, actions, **options)
+            if not ok and next(iter(item.values())).get('status') != 404
+        ]
+
+    def bulk_delete(self, es: Elasticsearch, index_name: str, ids: List[str]) -> BulkResult:
+        """Delete documents of rows deleted in postgres, BulkStoreError is raised if some are not deleted."""
+        if self.fingerprints:
+            # Document created again with the same content has to be sent again.
+            self.fingerprints.forget(index_name, ids)
+        errors = []
+        if ids:
+            errors = [next(iter(item.values())) for item in self._send_deletes(
+                es, self.target_indices.get(index_name, index_name), ids,
+            )]
+        result = BulkResult(success=len(ids) - len(errors), failed=len(errors), errors=errors)
+        logger.info('Delete from %s: %s documents deleted, %s failed.', index_name, result.success, result.failed)
+        if result.failed:
+            raise BulkStoreError(index_name, result)
+        return result
+
+    def bulk_store(
+        self,
+        es: Elasticsearch,
+        index_name: str,
+        list_of_record: List[dict],
+        states: dict = None,
+        partial: bool = False,
+    ) -> BulkResult:
+        """Index documents and save states if every document was indexed.
+
+        Documents rejected because of elastic load are sent again, the rest of the batch is not.
+        Documents still not indexed are written to dead-letter spool, if there is one, and states are saved.
+        Without spool BulkStoreError is raised, states are not saved then.
+        With `partial` documents only update their fields, missing documents are skipped.
+        """
+        started = time.perf_counter()
+        if index_name == 'genres' and self.propagate_genre_renames and list_of_record:
+            self.rename_genres(es, list_of_record)
+
+        docs, fingerprints = changed_documents(self.fingerprints, index_name, list_of_record, partial)
+        sent_docs = {doc['id']: doc for doc in docs}
+        result = BulkResult(success=0, failed=0, errors=[])
+        sleep_generator = exponential_sleep_generator(0.1, 2, 10)
+        missing = 0
+        for attempt in range(self.max_retries + 1):
+            success, failed_items = self._send_bulk(es, self.target_indices.get(index_name, index_name), docs, partial)
+            result.success += success
+
+            docs_by_id: Dict[str, dict] = {doc['id']: doc for doc in docs}
+            docs = []
+            errors = []
+            for item in failed_items:
+                info = next(iter(item.values()))
+                if partial and info.get('status') == 404:
+                    # Document is not indexed yet, it is loaded whole with its film.
+                    missing += 1
+                elif info.get('status') in RETRY_STATUSES and attempt < self.max_retries:
+                    docs.append(docs_by_id[info['_id']])
+                else:
+                    errors.append(info)
+            result.failed += len(errors)
+            result.errors.extend(errors)
+            if not docs:
+                break
+            METRICS.inc('etl_bulk_rejected_total', len(docs), index=index_name)
+            logger.info('%s documents rejected by elastic, retry them.', len(docs))
+            time.sleep(next(sleep_generator))
+
+        record_stage('load', 'bulk_store', time.perf_counter() - started, result.success)
+        METRICS.inc('etl_bulk_failed_total', result.failed, index=index_name)
+        logger.info('Load to %s: %s documents indexed, %s failed.', index_name, result.success, result.failed)
+        if missing:
+            logger.info('%s partial documents skipped, they are missing in %s.', missing, index_name)
+        dead_letter_failures(self.dead_letters, index_name, result, sent_docs, fingerprints, partial)
+
+        if self.fingerprints:
+            self.fingerprints.save(index_name, fingerprints)
         logger.info('Success load to elastic. Start saving states..')
-        for state_key, state_value in states.items():
-            self.state_loader.set_state(state_key, state_value)
+        self.save_states(states or {})
+        return result
 
+    def save_states(self, states: dict) -> None:
+        """Save states of loaded data with one commit."""
+        self.state_loader.set_states(states)
 
-class TransformDataService:
-    """Data transformer from raw postgres to elastic loader."""
 
+@lru_cache(maxsize=None)
+def schema_invariants(schema: Type[BaseModel]) -> Tuple[List[str], List[str]]:
+    """Get names of schema fields which can not be None and names of its list fields."""
+    fields = schema.__fields__.values()
+    required_fields = [field.name for field in fields if not field.allow_none]
+    list_fields = [field.name for field in fields if field.shape == SHAPE_LIST]
+    return required_fields, list_fields
+
+
+class TransformDataService:
+    """Data transformer from raw postgres to elastic loader.
+
+    Documents are validated by pydantic schemas. In fast mode documents are built in the schema
+    format right away, and only `sample_rate` of them (all in `strict` mode) are validated
+    and compared with what the schema would return.
+    """
+
+    def __init__(self, fast: bool = False, sample_rate: float = 0.0, strict: bool = False):
+        self.fast = fast
+        self.sample_rate = sample_rate
+        self.strict = strict
+
+    def _document(self, schema: Type[BaseModel], doc: dict) -> dict:
+        """Get document to load to elastic, `doc` keys have to be in order of schema fields.
+
+        None items of lists, like genre of a film without genres, are dropped in both modes,
+        and required fields are checked not to be None for every document in fast mode too.
+        """
+        required_fields, list_fields = schema_invariants(schema)
+        for name in list_fields:
+            if doc[name] and None in doc[name]:
+                doc[name] = [item for item in doc[name] if item is not None]
+        if not self.fast:
+            return schema.parse_obj(doc).dict()
+
+        missing_fields = [name for name in required_fields if doc[name] is None]
+        if missing_fields:
+            raise ValueError('Fast transform of {0} {1} has no values of {2}'.format(
+                schema.__name__, doc.get('id'), missing_fields,
+            ))
+
+        if self.strict or random.random() < self.sample_rate:
+            validated_doc = schema.parse_obj(doc).dict()
+            if json.dumps(validated_doc) != json.dumps(doc):
+                raise ValueError('Fast transform of {0} {1} differs from schema: {2} != {3}'.format(
+                    schema.__name__, doc.get('id'), doc, validated_doc,
+                ))
+        return doc
+
+    @stage('transform')
     def transform_filmworks_data(
         self,
-        film_work_data: List[MovieData],
-        person_film_data: List[PersonFilm],
+        film_work_data: Iterable[MovieData],
+        person_film_data: Iterable[PersonFilm],
     ) -> List[dict]:
         """Transform raw data from postgres to elastic format."""
 
         person_data = defaultdict(list)
         result = []
         for pers in person_film_data:
-            person_info = {'id': pers.person_id, 'role': pers.role, 'full_name': pers.full_name}
-            person_data[pers.film_id].append(person_info)
+            person_data[pers.film_id].append(pers)
 
         for film in film_work_data:
+            director = None
             writers = []
             actors = []
             actors_names = []
             writers_names = []
 
+            for person in person_data.get(film.id, ()):
+                role = person.role
+                if role == 'director':
+                    director = person.full_name
+                elif role == 'writer':
+                    writers.append({'id': person.person_id, 'name': person.full_name})
+                    writers_names.append(person.full_name)
+                elif role == 'actor':
+                    actors.append({'id': person.person_id, 'name': person.full_name})
+                    actors_names.append(person.full_name)
+
             movie = {
                 'id': film.id,
-                'imdb_rating': film.rating,
-                'description': film.description,
+                'imdb_rating': None if film.rating is None else float(film.rating),
+                'genre': film.genres,
                 'title': film.title,
+                'description': film.description,
+                'director': director,
+                'actors_names': actors_names,
+                'writers_names': writers_names,
+                'actors': actors,
+                'writers': writers,
+            }
+            result.append(self._document(FilmworkSchema, movie))
+
+        return result
+
+    @stage('transform')
+    def transform_filmworks_documents(self, documents: Iterable[FilmworkDocument]) -> List[dict]:
+        """Map filmwork documents aggregated by postgres to elastic format."""
+
+        result = []
+        for film in documents:
+            movie = {
+                'id': film.id,
+                'imdb_rating': None if film.rating is None else float(film.rating),
                 'genre': film.genres,
+                'title': film.title,
+                'description': film.description,
+                'director': film.director,
+                'actors_names': film.actors_names,
+                'writers_names': film.writers_names,
+                'actors': film.actors,
+                'writers': film.writers,
             }
+            result.append(self._document(FilmworkSchema, movie))
+        return result
 
-            if persons := person_data.get(film.id):
-                for person in persons:
-                    role = person['role']
-                    if role == 'director':
-                        movie['director'] = person['full_name']
-                    elif role == 'writer':
-                        writers.append({'id': person['id'], 'name': person['full_name']})
-                        writers_names.append(person['full_name'])
-                    elif role == 'actor':
-                        actors.append({'id': person['id'], 'name': person['full_name']})
-                        actors_names.append(person['full_name'])
-            movie['actors'] = actors
-            movie['actors_names'] = actors_names
-            movie['writers'] = writers
-            movie['writers_names'] = writers_names
-            if not movie.get('director'):
-                movie['director'] = None
-            result.append(FilmworkSchema.parse_obj(movie).dict())
+    @stage('transform')
+    def transform_filmworks_persons(self, filmworks_persons: Iterable[FilmworkPersons]) -> List[dict]:
+        """Map cast of films to partial movies documents."""
 
+        result = []
+        for film in filmworks_persons:
+            movie = {
+                'id': film.id,
+                'director': film.director,
+                'actors_names': film.actors_names,
+                'writers_names': film.writers_names,
+                'actors': film.actors,
+                'writers': film.writers,
+            }
+            result.append(self._document(FilmworkPersonsSchema, movie))
         return result
 
-    def transform_genres_data(self, genres_data: List[GenreData]) -> List[dict]:
+    @stage('transform')
+    def transform_genres_data(self, genres_data: Iterable[GenreData]) -> List[dict]:
         """Transform genres data to load to elastic."""
 
         result = []
         for genre in genres_data:
             genres_info = {'id': genre.id, 'name': genre.name, 'description': genre.description}
-            result.append(GenreSchema.parse_obj(genres_info).dict())
+            result.append(self._document(GenreSchema, genres_info))
         return result
 
-    def transform_persons_data(
-        self,
-        persons_data: List[PersonsData],
-        films_by_person: List[FilmsByPerson],
-    ) -> List[dict]:
-        """Transform persons data to load to elastic."""
+    @stage('transform')
+    def transform_persons_data(self, persons_documents: Iterable[PersonDocument]) -> List[dict]:
+        """Map persons documents aggregated by postgres to elastic format."""
 
         result = []
-        person_films = {person_films.id: person_films.film_ids for person_films in films_by_person}
-        person_roles = defaultdict(set)
-        for person in persons_data:
-            person_roles[person.id].add(person.role)
-
-        for person in persons_data:
-            roles = list(person_roles.get(person.id))
+        for person in persons_documents:
             persons_info = {
                 'id': person.id,
                 'full_name': person.full_name,
-                'role': roles,
-                'film_ids': person_films.get(person.id, []),
+                'role': person.roles,
+                'film_ids': person.film_ids,
             }
-            result.append(PersonSchema.parse_obj(persons_info).dict())
+            result.append(self._document(PersonSchema, persons_info))
         return result
@@ -0,0 +1,156 @@
+"""ETL settings validated from config.yaml."""
+from typing import Optional
+
+from pydantic import BaseModel
+from YamJam import yamjam
+
+
+class ExtractSettings(BaseModel):
+
+    streaming: bool = False
+    denormalized: bool = False
+    propagate_genre_renames: bool = False
+    partial_person_updates: bool = False
+    consistent_snapshot: bool = True
+    itersize: int = 1000
+
+
+class BatchSizeSettings(BaseModel):
+
+    genre: int = 100
+    person: int = 100
+
+
+class TransformSettings(BaseModel):
+
+    fast: bool = False
+    sample_rate: float = 0.01
+    strict: bool = False
+
+
+class LoadSettings(BaseModel):
+
+    thread_count: int = 1
+    chunk_size: int = 500
+    max_chunk_bytes: int = 100 * 1024 * 1024
+    max_retries: int = 3
+    ndjson: bool = False
+    http_compress: bool = False
+
+
+class ConnectionSettings(BaseModel):
+
+    postgres_pool_size: int = 2
+    postgres_check_interval: float = 30.0
+    elastic_maxsize: int = 10
+    elastic_timeout: float = 30.0
+    elastic_retry_on_timeout: bool = True
+    elastic_max_retries: int = 3
+
+
+class PipelineSettings(BaseModel):
+
+    queue_size: int = 4
+
+
+class AsyncEngineSettings(BaseModel):
+
+    pool_size: int = 3
+    max_in_flight: int = 4
+
+
+class DaemonSettings(BaseModel):
+
+    min_interval: float = 1.0
+    max_interval: float = 300.0
+    backoff_factor: float = 2.0
+    # Seconds batches in flight on SIGTERM are still retried for while services are unavailable.
+    stop_grace_period: float = 30.0
+
+
+class CdcSettings(BaseModel):
+
+    channel: str = 'etl_changes'
+    install_triggers: bool = True
+    window: float = 1.0
+    max_ids: int = 1000
+    checkpoint_interval: float = 300
+
+
+class FingerprintSettings(BaseModel):
+
+    enabled: bool = False
+    path: str = 'fingerprints.sqlite3'
+
+
+class DeadLetterSettings(BaseModel):
+
+    enabled: bool = False
+    directory: str = 'dead_letters'
+
+
+class ReindexSettings(BaseModel):
+
+    keep_versions: int = 1
+    max_num_segments: int = 1
+    partitions: int = 0
+    workers: int = 4
+
+
+class MetricsSettings(BaseModel):
+
+    host: str = '0.0.0.0'
+    port: int = 9108
+    summary_path: Optional[str] = None
+
+
+class ThrottleSettings(BaseModel):
+
+    enabled: bool = False
+    min_chunk_size: int = 50
+    max_chunk_size: int = 2000
+    chunk_step: int = 50
+    max_thread_count: int = 8
+    latency_target: float = 2.0
+    decrease_factor: float = 0.5
+    breaker_threshold: int = 5
+    breaker_timeout: float = 30.0
+
+
+class ProfilingSettings(BaseModel):
+
+    enabled: bool = False
+    directory: str = 'profiles'
+    sample_rate: float = 1.0
+    top: int = 25
+
+
+class StateSettings(BaseModel):
+
+    storage: str = 'json'
+    path: Optional[str] = None
+
+
+class EtlSettings(BaseModel):
+
+    state: StateSettings = StateSettings()
+    extract: ExtractSettings = ExtractSettings()
+    batch_size: BatchSizeSettings = BatchSizeSettings()
+    transform: TransformSettings = TransformSettings()
+    load: LoadSettings = LoadSettings()
+    connections: ConnectionSettings = ConnectionSettings()
+    pipeline: PipelineSettings = PipelineSettings()
+    async_engine: AsyncEngineSettings = AsyncEngineSettings()
+    daemon: DaemonSettings = DaemonSettings()
+    cdc: CdcSettings = CdcSettings()
+    fingerprints: FingerprintSettings = FingerprintSettings()
+    dead_letters: DeadLetterSettings = DeadLetterSettings()
+    throttle: ThrottleSettings = ThrottleSettings()
+    reindex: ReindexSettings = ReindexSettings()
+    metrics: MetricsSettings = MetricsSettings()
+    profiling: ProfilingSettings = ProfilingSettings()
+
+
+def load_settings() -> EtlSettings:
+    """Read `etl` section of config.yaml, missing keys fall back to defaults."""
+    return EtlSettings.parse_obj(yamjam().get('etl') or {})
@@ -0,0 +1,78 @@
+"""Exported postgres snapshots, so parallel extraction workers read the database at one point in time."""
+import asyncio
+from contextlib import asynccontextmanager, suppress
+from typing import AsyncIterator, List
+
+from asyncpg import Connection, Pool
+from psycopg2.extensions import ISOLATION_LEVEL_REPEATABLE_READ
+
+from backoff import NotRetriedError
+
+
+def export_snapshot(connection) -> str:
+    """Open a repeatable read transaction and export its snapshot.
+
+    Snapshot may be attached by other connections while this transaction stays open.
+    """
+    connection.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_export_snapshot()')
+        return cursor.fetchone()[0]
+
+
+def attach_snapshot(connection, snapshot_id: str) -> None:
+    """Open a repeatable read transaction reading exported snapshot, it lasts until commit or rollback."""
+    connection.set_session(isolation_level=ISOLATION_LEVEL_REPEATABLE_READ, readonly=True)
+    with connection.cursor() as cursor:
+        cursor.execute('SET TRANSACTION SNAPSHOT %s', (snapshot_id,))
+
+
+class SnapshotPool:
+    """Connections reading one snapshot, used by loader services in place of the pool.
+
+    Failed query aborts the snapshot transaction and a lost connection can not attach the snapshot
+    again, so errors are raised as NotRetriedError. The load fails and the next one continues from
+    saved states with a new snapshot.
+    """
+
+    def __init__(self, connections: List[Connection]):
+        self.connections = asyncio.Queue()
+        for connection in connections:
+            self.connections.put_nowait(connection)
+
+    async def fetch(self, query: str, *args) -> list:
+        connection = await self.connections.get()
+        try:
+            return await connection.fetch(query, *args)
+        except Exception as error:
+            raise NotRetriedError('Query failed in a transaction reading exported snapshot.') from error
+        finally:
+            self.connections.put_nowait(connection)
+
+
+@asynccontextmanager
+async def snapshot_pool(pool: Pool, size: int) -> AsyncIterator[SnapshotPool]:
+    """Take `size` connections of the pool and make all of them read the snapshot exported by the first one."""
+    connections = []
+    transactions = []
+    try:
+        snapshot_id = None
+        for _ in range(size):
+            connection = await pool.acquire()
+            connections.append(connection)
+            transaction = connection.transaction(isolation='repeatable_read', readonly=True)
+            await transaction.start()
+            transactions.append(transaction)
+            if snapshot_id is None:
+                snapshot_id = await connection.fetchval('SELECT pg_export_snapshot()')
+            else:
+                await connection.execute("SET TRANSACTION SNAPSHOT '{0}'".format(snapshot_id))
+        yield SnapshotPool(connections)
+    finally:
+        # Connections lost with the snapshot fail to roll back, the pool replaces them.
+        for transaction in transactions:
+            with suppress(Exception):
+                await transaction.rollback()
+        for connection in connections:
+            with suppress(Exception):
+                await pool.release(connection)
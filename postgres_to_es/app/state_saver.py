@@ -1,5 +1,8 @@
 import abc
 import json
+import os
+import sqlite3
+from threading import Lock
 from typing import Any, Optional
 
 
@@ -20,13 +23,22 @@ class JsonFileStorage(BaseStorage):
         self.file_path = file_path
 
     def save_state(self, state: dict) -> None:
-        if self.file_path:
-            with open(self.file_path, 'w') as state_file:
-                json.dump(state, state_file)
-        else:
+        if not self.file_path:
             self.file_path = 'state_config.json'
-            with open(self.file_path, 'w') as state_file:
-                json.dump(state, state_file)
+        # Пишем во временный файл и заменяем им основной: при падении остаётся старое или новое
+        # состояние целиком, а не обрезанный файл.
+        tmp_file_path = '{0}.tmp'.format(self.file_path)
+        with open(tmp_file_path, 'w') as state_file:
+            json.dump(state, state_file)
+            state_file.flush()
+            os.fsync(state_file.fileno())
+        os.replace(tmp_file_path, self.file_path)
+
+        dir_fd = os.open(os.path.dirname(os.path.abspath(self.file_path)), os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
 
     def retrieve_state(self) -> dict:
         try:
@@ -37,24 +49,86 @@ class JsonFileStorage(BaseStorage):
             return {}
 
 
+class SqliteStorage(BaseStorage):
+    """Хранилище состояния во встроенной базе SQLite, каждое сохранение - одна транзакция."""
+
+    def __init__(self, file_path: str = 'state.sqlite3'):
+        self.connection = sqlite3.connect(file_path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=FULL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)')
+        self.lock = Lock()
+
+    def save_state(self, state: dict) -> None:
+        with self.lock:
+            self.connection.execute('BEGIN')
+            try:
+                self.connection.executemany(
+                    'INSERT INTO state (key, value) VALUES (?, ?) '
+                    'ON CONFLICT (key) DO UPDATE SET value = excluded.value',
+                    [(key, json.dumps(value)) for key, value in state.items()],
+                )
+                self.connection.execute('COMMIT')
+            except Exception:
+                self.connection.execute('ROLLBACK')
+                raise
+
+    def retrieve_state(self) -> dict:
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM state').fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+
+class MemoryStorage(BaseStorage):
+    """Хранилище состояния в памяти процесса, для загрузок, которые при падении начинаются заново."""
+
+    def __init__(self):
+        self.state = {}
+
+    def save_state(self, state: dict) -> None:
+        self.state = dict(state)
+
+    def retrieve_state(self) -> dict:
+        return dict(self.state)
+
+
 class State:
     """
     Класс для хранения состояния при работе с данными, чтобы постоянно не перечитывать данные с начала.
     Здесь представлена реализация с сохранением состояния в файл.
     В целом ничего не мешает поменять это поведение на работу с БД или распределённым хранилищем.
+
+    Состояние читается из хранилища один раз и дальше хранится в памяти,
+    хранилище используется только для записи.
     """
 
     def __init__(self, storage: BaseStorage):
         self.storage = storage
+        self.state = storage.retrieve_state()
+        self.lock = Lock()
 
     def set_state(self, key: str, value: Any) -> None:
         """Установить состояние для определённого ключа"""
-        state = self.storage.retrieve_state()
-        state[key] = value
-        self.storage.save_state(state)
+        self.set_states({key: value})
+
+    def set_states(self, states: dict) -> None:
+        """Установить состояние для нескольких ключей и сохранить их одной записью"""
+        if not states:
+            return
+        with self.lock:
+            self.state.update(states)
+            self.storage.save_state(dict(self.state))
 
     def get_state(self, key: str) -> Any:
         """Получить состояние по определённому ключу"""
-        state = self.storage.retrieve_state()
-        stored_state = state.get(key)
-        return stored_state
+        with self.lock:
+            return self.state.get(key)
+
+
+def create_state(storage: str = 'json', file_path: Optional[str] = None) -> State:
+    """Создать состояние с хранилищем `json`, `sqlite` или `memory`"""
+    if storage == 'memory':
+        return State(MemoryStorage())
+    if storage == 'sqlite':
+        return State(SqliteStorage(file_path or 'state.sqlite3'))
+    return State(JsonFileStorage(file_path or 'state_config.json'))
@@ -0,0 +1,272 @@
+"""Deterministic synthetic catalog of the `content` schema, for benchmarks without production data.
+
+The same `films` and `seed` always give the same rows, every film is generated from its own number,
+so any part of the catalog is generated without generating the rest.
+"""
+import hashlib
+import io
+import logging
+import random
+from datetime import datetime, timedelta, timezone
+from typing import Iterator, List, Tuple
+from uuid import UUID
+
+from postgres_schemas import (
+    FilmworkDocument,
+    FilmworkPersons,
+    GenreData,
+    MovieData,
+    PersonDocument,
+    PersonFilm,
+)
+
+logger = logging.getLogger()
+
+SCHEMA_DDL = """
+    CREATE SCHEMA IF NOT EXISTS content;
+    CREATE TABLE IF NOT EXISTS content.film_work (
+        id uuid PRIMARY KEY,
+        title text NOT NULL,
+        description text,
+        creation_date date,
+        rating float,
+        type text NOT NULL,
+        created_at timestamp with time zone,
+        updated_at timestamp with time zone
+    );
+    CREATE TABLE IF NOT EXISTS content.genre (
+        id uuid PRIMARY KEY,
+        name text NOT NULL,
+        description text,
+        created_at timestamp with time zone,
+        updated_at timestamp with time zone
+    );
+    CREATE TABLE IF NOT EXISTS content.person (
+        id uuid PRIMARY KEY,
+        full_name text NOT NULL,
+        created_at timestamp with time zone,
+        updated_at timestamp with time zone
+    );
+    CREATE TABLE IF NOT EXISTS content.genre_film_work (
+        id uuid PRIMARY KEY,
+        genre_id uuid NOT NULL REFERENCES content.genre (id) ON DELETE CASCADE,
+        film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+        created_at timestamp with time zone
+    );
+    CREATE TABLE IF NOT EXISTS content.person_film_work (
+        id uuid PRIMARY KEY,
+        person_id uuid NOT NULL REFERENCES content.person (id) ON DELETE CASCADE,
+        film_work_id uuid NOT NULL REFERENCES content.film_work (id) ON DELETE CASCADE,
+        role text NOT NULL,
+        created_at timestamp with time zone
+    );
+    CREATE INDEX IF NOT EXISTS film_work_updated_at_idx ON content.film_work (updated_at, id);
+    CREATE INDEX IF NOT EXISTS genre_updated_at_idx ON content.genre (updated_at, id);
+    CREATE INDEX IF NOT EXISTS person_updated_at_idx ON content.person (updated_at, id);
+    CREATE UNIQUE INDEX IF NOT EXISTS film_work_genre_idx ON content.genre_film_work (film_work_id, genre_id);
+    CREATE INDEX IF NOT EXISTS genre_film_work_genre_idx ON content.genre_film_work (genre_id);
+    CREATE UNIQUE INDEX IF NOT EXISTS film_work_person_role_idx
+        ON content.person_film_work (film_work_id, person_id, role);
+    CREATE INDEX IF NOT EXISTS person_film_work_person_idx ON content.person_film_work (person_id);
+"""
+
+# Columns filled by the generator, tables of an existing database may have more.
+COLUMNS = {
+    'genre': ('id', 'name', 'description', 'created_at', 'updated_at'),
+    'person': ('id', 'full_name', 'created_at', 'updated_at'),
+    'film_work': ('id', 'title', 'description', 'rating', 'type', 'created_at', 'updated_at'),
+    'genre_film_work': ('id', 'genre_id', 'film_work_id', 'created_at'),
+    'person_film_work': ('id', 'person_id', 'film_work_id', 'role', 'created_at'),
+}
+
+BASE_TIME = datetime(2021, 1, 1, tzinfo=timezone.utc)
+
+GENRES = 30
+
+WORDS = (
+    'night', 'city', 'love', 'war', 'star', 'river', 'secret', 'last', 'dark', 'summer', 'king', 'road',
+    'ghost', 'island', 'storm', 'dream', 'fire', 'silent', 'golden', 'lost', 'winter', 'empire', 'heart',
+    'shadow', 'journey', 'family', 'stranger', 'ocean', 'mountain', 'machine', 'garden', 'promise',
+)
+
+# Credits of one film: (minimal, maximal) count of persons in every role.
+CREDITS = {'director': (1, 1), 'writer': (1, 3), 'actor': (3, 10)}
+
+# Rows of films are generated and copied to postgres by chunks of this size.
+COPY_CHUNK_SIZE = 10000
+
+Credit = Tuple[int, str]
+
+
+def synthetic_id(seed: int, kind: str, number: int) -> str:
+    return str(UUID(bytes=hashlib.md5('{0}:{1}:{2}'.format(seed, kind, number).encode()).digest(), version=4))
+
+
+class SyntheticCatalog:
+    """Catalog of `films` films, half as many persons and up to `GENRES` genres."""
+
+    def __init__(self, films: int, seed: int = 0):
+        self.films = films
+        self.persons = max(films // 2, max(high for _, high in CREDITS.values()))
+        self.genres = min(GENRES, films)
+        self.seed = seed
+
+    def _words(self, rng: random.Random, count: int) -> str:
+        return ' '.join(rng.choice(WORDS) for _ in range(count))
+
+    def genre_id(self, number: int) -> str:
+        return synthetic_id(self.seed, 'genre', number)
+
+    def genre_name(self, number: int) -> str:
+        return 'Genre {0}'.format(number)
+
+    def person_id(self, number: int) -> str:
+        return synthetic_id(self.seed, 'person', number)
+
+    def person_name(self, number: int) -> str:
+        return 'Person {0}'.format(number)
+
+    def film_id(self, number: int) -> str:
+        return synthetic_id(self.seed, 'film', number)
+
+    def updated_at(self, number: int) -> datetime:
+        return BASE_TIME + timedelta(seconds=number)
+
+    def film(self, number: int) -> Tuple[tuple, List[int], List[Credit]]:
+        """Row of film `number`, numbers of its genres and its credits as (person number, role)."""
+        rng = random.Random('{0}:film:{1}'.format(self.seed, number))
+        row = (
+            self.film_id(number),
+            '{0} {1}'.format(self._words(rng, rng.randint(1, 4)).capitalize(), number),
+            None if rng.random() < 0.05 else self._words(rng, rng.randint(10, 60)).capitalize(),
+            None if rng.random() < 0.05 else round(rng.uniform(1, 10), 1),
+        )
+        genres = sorted(rng.sample(range(self.genres), rng.randint(1, min(3, self.genres))))
+        credits = []
+        for role, (low, high) in CREDITS.items():
+            credits.extend((person, role) for person in rng.sample(range(self.persons), rng.randint(low, high)))
+        return row, genres, credits
+
+    def films_range(self, start: int, stop: int) -> Iterator[Tuple[tuple, List[int], List[Credit]]]:
+        return (self.film(number) for number in range(start, min(stop, self.films)))
+
+    def table_rows(self, start: int, stop: int) -> dict:
+        """Rows of films from `start` to `stop` and of their links, by table."""
+        rows = {'film_work': [], 'genre_film_work': [], 'person_film_work': []}
+        for number in range(start, min(stop, self.films)):
+            (film_id, title, description, rating), genres, credits = self.film(number)
+            updated_at = self.updated_at(number)
+            rows['film_work'].append((film_id, title, description, rating, 'movie', updated_at, updated_at))
+            rows['genre_film_work'].extend(
+                (synthetic_id(self.seed, 'genre_film_work', number * GENRES + genre), self.genre_id(genre), film_id,
+                 updated_at)
+                for genre in genres
+            )
+            rows['person_film_work'].extend(
+                (synthetic_id(self.seed, 'person_film_work:{0}'.format(role), number * self.persons + person),
+                 self.person_id(person), film_id, role, updated_at)
+                for person, role in credits
+            )
+        return rows
+
+    def movie_data(self, start: int, stop: int) -> Tuple[List[MovieData], List[PersonFilm]]:
+        """Films as `load_filmworks_data` extracts them."""
+        movies, person_films = [], []
+        for (film_id, title, description, rating), genres, credits in self.films_range(start, stop):
+            movies.append(MovieData(film_id, title, description, rating, [self.genre_name(g) for g in genres]))
+            person_films.extend(
+                PersonFilm(film_id, self.person_id(person), role, self.person_name(person), self.updated_at(person))
+                for person, role in credits
+            )
+        return movies, person_films
+
+    def _cast(self, credits: List[Credit]) -> Tuple[str, list, list, list, list]:
+        def people(role: str) -> List[Tuple[str, str]]:
+            return sorted((self.person_name(person), self.person_id(person)) for person, r in credits if r == role)
+
+        actors, writers = people('actor'), people('writer')
+        return (
+            people('director')[0][0],
+            [{'id': person_id, 'name': name} for name, person_id in actors],
+            [name for name, _ in actors],
+            [{'id': person_id, 'name': name} for name, person_id in writers],
+            [name for name, _ in writers],
+        )
+
+    def filmwork_documents(self, start: int, stop: int) -> List[FilmworkDocument]:
+        """Films as `load_filmworks_documents` extracts them, aggregated by postgres."""
+        return [
+            FilmworkDocument(
+                film_id, title, description, rating, sorted(self.genre_name(g) for g in genres), *self._cast(credits),
+            )
+            for (film_id, title, description, rating), genres, credits in self.films_range(start, stop)
+        ]
+
+    def filmworks_persons(self, start: int, stop: int) -> List[FilmworkPersons]:
+        """Cast of films as `load_filmworks_persons` extracts it."""
+        return [FilmworkPersons(row[0], *self._cast(credits)) for row, _, credits in self.films_range(start, stop)]
+
+    def genres_data(self) -> List[GenreData]:
+        return [
+            GenreData(self.genre_id(number), self.genre_name(number), None, self.updated_at(number))
+            for number in range(self.genres)
+        ]
+
+    def persons_data(self, start: int, stop: int) -> List[PersonDocument]:
+        """Persons credited in films from `start` to `stop`, as `load_persons_data` extracts them."""
+        credits_by_person = {}
+        for (film_id, *_), _, credits in self.films_range(start, stop):
+            for person, role in credits:
+                roles, film_ids = credits_by_person.setdefault(person, (set(), set()))
+                roles.add(role)
+                film_ids.add(film_id)
+        return [
+            PersonDocument(
+                self.person_id(person), self.person_name(person), sorted(roles), sorted(film_ids),
+                self.updated_at(person),
+            )
+            for person, (roles, film_ids) in credits_by_person.items()
+        ]
+
+
+def _copy(cursor, table: str, rows: List[tuple]) -> None:
+    """Copy rows with COPY text format, generated values have no characters to escape."""
+    buffer = io.StringIO()
+    for row in rows:
+        buffer.write('\t'.join(r'\N' if value is None else str(value) for value in row))
+        buffer.write('\n')
+    buffer.seek(0)
+    cursor.copy_expert('COPY content.{0} ({1}) FROM STDIN'.format(table, ', '.join(COLUMNS[table])), buffer)
+
+
+def load_catalog(connection, catalog: SyntheticCatalog, truncate: bool = False) -> None:
+    """Create `content` tables if they do not exist and fill them with the catalog.
+
+    Tables having rows are truncated only with `truncate`, otherwise nothing is loaded.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(SCHEMA_DDL)
+        cursor.execute('SELECT EXISTS (SELECT 1 FROM content.film_work)')
+        if cursor.fetchone()[0]:
+            if not truncate:
+                raise ValueError('content.film_work has rows, truncate it to load synthetic catalog.')
+            cursor.execute('TRUNCATE {0}'.format(', '.join('content.{0}'.format(table) for table in COLUMNS)))
+
+        _copy(cursor, 'genre', [
+            (genre.id, genre.name, genre.description, genre.updated_at, genre.updated_at)
+            for genre in catalog.genres_data()
+        ])
+        for start in range(0, catalog.persons, COPY_CHUNK_SIZE):
+            _copy(cursor, 'person', [
+                (catalog.person_id(number), catalog.person_name(number),
+                 catalog.updated_at(number), catalog.updated_at(number))
+                for number in range(start, min(start + COPY_CHUNK_SIZE, catalog.persons))
+            ])
+        for start in range(0, catalog.films, COPY_CHUNK_SIZE):
+            for table, rows in catalog.table_rows(start, start + COPY_CHUNK_SIZE).items():
+                _copy(cursor, table, rows)
+            logger.info('%s of %s synthetic films copied.', min(start + COPY_CHUNK_SIZE, catalog.films), catalog.films)
+        connection.commit()
+        # Planner statistics of fresh tables, so benchmark queries get production-like plans.
+        cursor.execute('ANALYZE {0}'.format(', '.join('content.{0}'.format(table) for table in COLUMNS)))
+    connection.commit()
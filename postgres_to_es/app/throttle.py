@@ -0,0 +1,105 @@
+"""Adaptive limits of bulk load, raised while elastic keeps up and cut when it is overloaded."""
+import logging
+import time
+from threading import Lock
+from typing import Dict, Tuple
+
+from backoff import STOP_EVENT
+from metrics import METRICS, Labels
+from settings import ThrottleSettings
+
+logger = logging.getLogger()
+
+
+class BulkThrottle:
+    """Bulk size and concurrency controlled by additive increase and multiplicative decrease.
+
+    Every healthy round of bulk requests adds `chunk_step` documents to bulk size and one thread,
+    up to their maximums. A round with rejected documents or with requests slower than
+    `latency_target` seconds cuts both by `decrease_factor`.
+
+    After `breaker_threshold` overloaded rounds in a row the circuit breaker opens, and no
+    requests are sent for `breaker_timeout` seconds. Then one round is let through with the
+    lowest limits: the breaker closes if it is healthy and opens again if it is not.
+    """
+
+    def __init__(
+        self,
+        chunk_size: int = 500,
+        thread_count: int = 1,
+        min_chunk_size: int = 50,
+        max_chunk_size: int = 2000,
+        chunk_step: int = 50,
+        max_thread_count: int = 8,
+        latency_target: float = 2.0,
+        decrease_factor: float = 0.5,
+        breaker_threshold: int = 5,
+        breaker_timeout: float = 30.0,
+    ):
+        self.min_chunk_size = min_chunk_size
+        self.max_chunk_size = max(max_chunk_size, min_chunk_size)
+        self.chunk_step = chunk_step
+        self.max_thread_count = max(max_thread_count, 1)
+        self.latency_target = latency_target
+        self.decrease_factor = decrease_factor
+        self.breaker_threshold = breaker_threshold
+        self.breaker_timeout = breaker_timeout
+        self.chunk_size = min(max(chunk_size, self.min_chunk_size), self.max_chunk_size)
+        self.thread_count = min(max(thread_count, 1), self.max_thread_count)
+        self.overloads = 0
+        self.opened_until = 0.0
+        self.lock = Lock()
+
+    def limits(self) -> Tuple[int, int]:
+        """Wait while circuit breaker is open, then return bulk size and thread count to send with."""
+        with self.lock:
+            delay = self.opened_until - time.monotonic()
+        if delay > 0:
+            logger.info('Circuit breaker is open, elastic is given %.1f seconds to recover.', delay)
+            STOP_EVENT.wait(delay)
+        with self.lock:
+            return self.chunk_size, self.thread_count
+
+    def record(self, seconds: float, requests: int, rejected: int = 0) -> None:
+        """Adapt limits to a round of `requests` bulk requests sent in `seconds` with `rejected` documents.
+
+        Requests of a round are sent `thread_count` at a time, so latency of one request is taken
+        as time of the round divided by number of its waves.
+        """
+        waves = max(1, -(-requests // self.thread_count))
+        latency = seconds / waves
+        if rejected or latency > self.latency_target:
+            logger.info('Elastic is overloaded: %s documents rejected, bulk latency %.2f seconds.', rejected, latency)
+            self.record_overload()
+            return
+        with self.lock:
+            self.overloads = 0
+            self.chunk_size = min(self.chunk_size + self.chunk_step, self.max_chunk_size)
+            self.thread_count = min(self.thread_count + 1, self.max_thread_count)
+
+    def record_overload(self) -> None:
+        """Cut limits after rejections, slow requests or failed requests, open circuit breaker if it repeats."""
+        with self.lock:
+            self.overloads += 1
+            self.chunk_size = max(int(self.chunk_size * self.decrease_factor), self.min_chunk_size)
+            self.thread_count = max(int(self.thread_count * self.decrease_factor), 1)
+            if self.overloads < self.breaker_threshold:
+                return
+            self.opened_until = time.monotonic() + self.breaker_timeout
+            # Round let through after the timeout probes elastic with the lowest limits.
+            self.chunk_size = self.min_chunk_size
+            self.thread_count = 1
+        METRICS.inc('etl_circuit_breaker_opened_total')
+        logger.warning('Circuit breaker opened after %s overloaded rounds of bulk requests.', self.overloads)
+
+    def gauge(self) -> Dict[Labels, float]:
+        """Gauge callback: current limits of bulk load."""
+        with self.lock:
+            return {(('limit', 'chunk_size'),): self.chunk_size, (('limit', 'thread_count'),): self.thread_count}
+
+
+def create_throttle(settings: ThrottleSettings, chunk_size: int, thread_count: int) -> BulkThrottle:
+    """Create throttle starting from configured bulk size and thread count, its limits are exposed as a gauge."""
+    throttle = BulkThrottle(chunk_size, thread_count, **settings.dict(exclude={'enabled'}))
+    METRICS.gauge('etl_bulk_limits', throttle.gauge)
+    return throttle
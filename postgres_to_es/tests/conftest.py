@@ -0,0 +1,50 @@
+import json
+import os
+import sys
+
+import pytest
+from elasticsearch.serializer import JSONSerializer
+
+# Modules of the app import each other as scripts do.
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'app'))
+
+
+class FakeTransport:
+    serializer = JSONSerializer()
+
+
+class FakeElastic:
+    """Elasticsearch answering bulk requests from documents kept in memory, `statuses` override answers by id."""
+
+    def __init__(self):
+        self.transport = FakeTransport()
+        self.indices = {}
+        self.statuses = {}
+        self.requests = []
+
+    def bulk(self, body, **kwargs):
+        if isinstance(body, bytes):
+            body = body.decode()
+        self.requests.append(body)
+        lines = iter(line for line in body.split('\n') if line)
+        items = []
+        for line in lines:
+            (op_type, meta), = json.loads(line).items()
+            documents = self.indices.setdefault(meta['_index'], {})
+            status = self.statuses.get(meta['_id'])
+            if op_type == 'delete':
+                status = status or (200 if documents.pop(meta['_id'], None) else 404)
+            else:
+                source = json.loads(next(lines))
+                if op_type == 'update' and meta['_id'] not in documents:
+                    status = status or 404
+                status = status or 201
+                if status < 300:
+                    documents[meta['_id']] = {**documents.get(meta['_id'], {}), **source.get('doc', source)}
+            items.append({op_type: {'_index': meta['_index'], '_id': meta['_id'], 'status': status}})
+        return {'errors': any(next(iter(item.values()))['status'] >= 300 for item in items), 'items': items}
+
+
+@pytest.fixture
+def es():
+    return FakeElastic()
@@ -0,0 +1,70 @@
+import threading
+import time
+from threading import Event
+
+import pytest
+
+from backoff import StopEvent, backoff
+
+
+def test_retries_are_given_up_when_stop_is_requested():
+    stop_event = Event()
+    calls = []
+
+    @backoff(start_sleep_time=60, factor=1, border_sleep_time=60, stop_event=stop_event)
+    def unavailable():
+        calls.append(time.monotonic())
+        raise ConnectionError('service is down')
+
+    threading.Timer(0.2, stop_event.set).start()
+    started = time.monotonic()
+    with pytest.raises(ConnectionError):
+        unavailable()
+    assert time.monotonic() - started < 5
+    assert len(calls) == 1
+
+
+def test_call_is_retried_until_it_succeeds():
+    results = iter([ConnectionError('service is down'), ConnectionError('service is down'), 'ok'])
+
+    @backoff(start_sleep_time=0.001, factor=1, border_sleep_time=0.001, stop_event=Event())
+    def flaky():
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert flaky() == 'ok'
+
+
+def test_call_in_flight_is_retried_within_grace_period():
+    stop_event = StopEvent(grace_period=5)
+    results = iter([ConnectionError('service is down'), ConnectionError('service is down'), 'ok'])
+
+    @backoff(start_sleep_time=0.01, factor=1, border_sleep_time=0.01, stop_event=stop_event)
+    def flaky():
+        # Shutdown is requested while the call is in flight.
+        stop_event.set()
+        result = next(results)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    assert flaky() == 'ok'
+
+
+def test_retries_are_given_up_when_grace_period_is_over():
+    stop_event = StopEvent(grace_period=0.2)
+    calls = []
+
+    @backoff(start_sleep_time=60, factor=1, border_sleep_time=60, stop_event=stop_event)
+    def unavailable():
+        calls.append(time.monotonic())
+        raise ConnectionError('service is down')
+
+    threading.Timer(0.1, stop_event.set).start()
+    started = time.monotonic()
+    with pytest.raises(ConnectionError):
+        unavailable()
+    assert time.monotonic() - started < 5
+    assert len(calls) >= 2
@@ -0,0 +1,82 @@
+import threading
+
+import orjson
+
+from bulk_writer import NdjsonBulkWriter
+from service import ElasticSaverService
+from state_saver import create_state
+
+
+def documents(count: int) -> list:
+    return [{'id': 'film-{0}'.format(number), 'title': 'Title {0}'.format(number)} for number in range(count)]
+
+
+def body_ids(body: bytes) -> list:
+    lines = body.split(b'\n')
+    assert lines[-1] == b''
+    return [orjson.loads(action)['index']['_id'] for action in lines[:-1:2]]
+
+
+def test_bodies_are_cut_at_document_limit():
+    writer = NdjsonBulkWriter(chunk_size=2)
+    bodies = list(writer.bodies('movies', documents(5)))
+
+    assert [body_ids(body) for body in bodies] == [['film-0', 'film-1'], ['film-2', 'film-3'], ['film-4']]
+    assert [len(body_ids(body)) for body in writer.bodies('movies', documents(5), chunk_size=3)] == [3, 2]
+    assert writer.chunk_size == 2
+
+
+def test_bodies_are_cut_at_byte_limit():
+    docs = documents(6)
+    document_size = len(b''.join(NdjsonBulkWriter().bodies('movies', docs[:1])))
+    writer = NdjsonBulkWriter(chunk_size=100, max_chunk_bytes=document_size * 2 + 1)
+    bodies = list(writer.bodies('movies', docs))
+
+    assert [len(body_ids(body)) for body in bodies] == [2, 2, 2]
+    assert all(len(body) <= writer.max_chunk_bytes for body in bodies)
+    # Document larger than the limit is still sent, alone.
+    assert [len(body_ids(body)) for body in NdjsonBulkWriter(max_chunk_bytes=1).bodies('movies', docs[:2])] == [1, 1]
+
+
+def test_partial_documents_are_updates():
+    body, = NdjsonBulkWriter().bodies('movies', [{'id': 'film-1', 'director': 'Name'}], partial=True)
+    assert [orjson.loads(line) for line in body.split(b'\n')[:-1]] == [
+        {'update': {'_index': 'movies', '_id': 'film-1'}},
+        {'doc': {'id': 'film-1', 'director': 'Name'}},
+    ]
+
+
+def test_parallel_bodies_are_serialized_as_responses_come(es):
+    release = threading.Event()
+    consumed = []
+    bulk = es.bulk
+
+    def slow_bulk(body, **kwargs):
+        release.wait(5)
+        return bulk(body, **kwargs)
+
+    def docs():
+        for doc in documents(20):
+            consumed.append(doc['id'])
+            yield doc
+
+    es.bulk = slow_bulk
+    service = ElasticSaverService(thread_count=2, chunk_size=100, ndjson=True, state_loader=create_state('memory'))
+    results = []
+
+    def send():
+        results.extend(service._send_ndjson_bodies(es, 'movies', docs(), chunk_size=1))
+
+    sender = threading.Thread(target=send)
+    sender.start()
+    try:
+        sender.join(0.3)
+        # Two bodies are in flight, the third one waits for a response with the next document in buffer.
+        assert len(consumed) == 4
+    finally:
+        release.set()
+        sender.join(5)
+
+    assert len(results) == 20 and all(ok for ok, item in results)
+    assert len(es.indices['movies']) == 20
+    assert service.bulk_writer.chunk_size == 100
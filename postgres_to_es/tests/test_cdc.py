@@ -0,0 +1,63 @@
+from cdc import ChangeSet, index_changes
+from postgres_schemas import FilmworkDocument, PersonDocument
+from service import ElasticSaverService, TransformDataService
+from state_saver import create_state
+
+
+class FakeLoaderService:
+    """Postgres with given films and persons, other rows are deleted."""
+
+    def __init__(self, filmworks=(), persons=()):
+        self.filmworks = {film.id: film for film in filmworks}
+        self.persons = {person.id: person for person in persons}
+        self.films_loaded = {'genres_state': True, 'persons_state': True}
+        self.propagate_genre_renames = False
+        self.partial_person_updates = False
+
+    def stream_filmworks_documents_by_ids(self, genres_ids, persons_ids, filmworks_ids):
+        yield [self.filmworks[film_id] for film_id in filmworks_ids if film_id in self.filmworks]
+
+    def load_genres_by_ids(self, genres_ids):
+        return []
+
+    def load_persons_by_ids(self, persons_ids):
+        return [self.persons[person_id] for person_id in persons_ids if person_id in self.persons]
+
+    def commit(self):
+        pass
+
+
+def film(film_id: str) -> FilmworkDocument:
+    return FilmworkDocument(film_id, 'Title', None, None, ['Drama'], None, [], [], [], [])
+
+
+def test_deleted_rows_are_deleted_from_elastic(es):
+    es.indices = {
+        'movies': {'film-1': {'id': 'film-1'}, 'film-2': {'id': 'film-2'}},
+        'persons': {'person-1': {'id': 'person-1'}, 'person-2': {'id': 'person-2'}},
+    }
+    postgres_service = FakeLoaderService(
+        filmworks=[film('film-2')],
+        persons=[PersonDocument('person-2', 'Name', ['actor'], ['film-2'], None)],
+    )
+    changes = ChangeSet()
+    # Notifications of triggers on DELETE: film-1 is deleted with the role of person-1, the only one the person had.
+    for payload in (
+        {'table': 'film_work', 'id': 'film-1'},
+        {'table': 'person_film_work', 'id': 'role-1', 'film_work_id': 'film-1', 'person_id': 'person-1'},
+        {'table': 'film_work', 'id': 'film-2'},
+        {'table': 'person_film_work', 'id': 'role-2', 'film_work_id': 'film-2', 'person_id': 'person-2'},
+    ):
+        changes.add(payload)
+
+    service = ElasticSaverService(state_loader=create_state('memory'))
+    index_changes(changes, postgres_service, TransformDataService(), service, es)
+
+    assert list(es.indices['movies']) == ['film-2']
+    assert list(es.indices['persons']) == ['person-2']
+
+
+def test_delete_of_missing_document_is_not_a_failure(es):
+    service = ElasticSaverService(state_loader=create_state('memory'))
+    result = service.bulk_delete(es, 'genres', ['genre-1'])
+    assert (result.success, result.failed) == (1, 0)
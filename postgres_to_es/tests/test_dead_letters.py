@@ -0,0 +1,83 @@
+import gzip
+import os
+
+import pytest
+
+import load_data
+from dead_letters import SPOOL_SUFFIX, DeadLetterSpool
+from postgres_schemas import GenreData
+from service import ElasticSaverService
+from settings import EtlSettings
+from state_saver import create_state
+
+
+class FakeLoaderService:
+    """Postgres with current versions of genres."""
+
+    genres = {}
+
+    def __init__(self, **kwargs):
+        pass
+
+    def load_genres_by_ids(self, genres_ids):
+        return [self.genres[genre_id] for genre_id in genres_ids if genre_id in self.genres]
+
+    def release(self):
+        pass
+
+
+def test_refused_documents_are_spooled_and_states_saved(es, tmp_path):
+    spool = DeadLetterSpool(str(tmp_path))
+    state = create_state('memory')
+    service = ElasticSaverService(state_loader=state, dead_letters=spool)
+    es.statuses['genre-2'] = 400
+
+    docs = [{'id': 'genre-1', 'name': 'Drama'}, {'id': 'genre-2', 'name': 'Comedy'}]
+    result = service.bulk_store(es, 'genres', docs, {'genres_data_state': ['2021-01-01', 'genre-2']})
+
+    assert (result.success, result.failed) == (1, 1)
+    assert state.get_state('genres_data_state') == ['2021-01-01', 'genre-2']
+    with spool.replaying() as ids:
+        assert ids == {'genres': ['genre-2']}
+    assert not os.listdir(str(tmp_path))
+
+
+def test_spooled_documents_are_replayed_from_postgres(es, tmp_path, monkeypatch):
+    settings = EtlSettings.parse_obj({'dead_letters': {'enabled': True, 'directory': str(tmp_path)}})
+    DeadLetterSpool(str(tmp_path)).write('genres', [
+        ({'id': 'genre-1', 'name': 'Old name'}, {'_id': 'genre-1', 'status': 400}),
+        ({'id': 'genre-2', 'name': 'Deleted'}, {'_id': 'genre-2', 'status': 400}),
+    ])
+    monkeypatch.setattr(load_data, 'PostgresLoaderService', FakeLoaderService)
+    monkeypatch.setattr(FakeLoaderService, 'genres', {'genre-1': GenreData('genre-1', 'New name', None, None)})
+
+    load_data.replay_dead_letters(None, es, settings)
+
+    assert es.indices['genres'] == {'genre-1': {'id': 'genre-1', 'name': 'New name', 'description': None}}
+    assert not os.listdir(str(tmp_path))
+
+
+def test_failed_replay_keeps_spooled_documents(tmp_path):
+    spool = DeadLetterSpool(str(tmp_path))
+    spool.write('movies', [(None, {'_id': 'film-1', 'status': 400})])
+    with pytest.raises(ConnectionError):
+        with spool.replaying() as ids:
+            assert ids == {'movies': ['film-1']}
+            raise ConnectionError('elastic is down')
+    # Failures of the failed replay are spooled to a new file meanwhile.
+    spool.write('movies', [(None, {'_id': 'film-2', 'status': 400})])
+
+    with spool.replaying() as ids:
+        assert sorted(ids['movies']) == ['film-1', 'film-2']
+
+
+def test_damaged_tail_of_spool_does_not_lose_entries_before_it(tmp_path):
+    spool = DeadLetterSpool(str(tmp_path))
+    spool.write('persons', [(None, {'_id': 'person-1', 'status': 400})])
+    spool_path = os.path.join(str(tmp_path), 'persons' + SPOOL_SUFFIX)
+    member = gzip.compress(b'{"index": "persons", "id": "person-2"}\n')
+    with open(spool_path, 'ab') as spool_file:
+        spool_file.write(member[:len(member) // 2])
+
+    with spool.replaying() as ids:
+        assert ids == {'persons': ['person-1']}
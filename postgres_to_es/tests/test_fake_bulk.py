@@ -0,0 +1,34 @@
+import threading
+
+import pytest
+from elasticsearch import Elasticsearch
+
+from fake_bulk import create_server
+from service import ElasticSaverService
+from state_saver import create_state
+
+
+@pytest.fixture
+def fake_elastic():
+    server = create_server(port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    es = Elasticsearch([{'host': '127.0.0.1', 'port': server.server_address[1]}])
+    yield es
+    es.close()
+    server.shutdown()
+    server.server_close()
+
+
+def test_requested_documents_are_not_found(fake_elastic):
+    response = fake_elastic.mget(index='genres', body={'ids': ['genre-1', 'genre-2']})
+    assert response['docs'] == [
+        {'_index': 'genres', '_id': 'genre-1', 'found': False},
+        {'_index': 'genres', '_id': 'genre-2', 'found': False},
+    ]
+
+
+def test_genres_are_loaded_with_rename_propagation(fake_elastic):
+    service = ElasticSaverService(state_loader=create_state('memory'), propagate_genre_renames=True)
+    result = service.bulk_store(fake_elastic, 'genres', [{'id': 'genre-1', 'name': 'Drama', 'description': None}])
+    assert (result.success, result.failed) == (1, 0)
+    assert fake_elastic.transport.perform_request('GET', '/_fake/stats')['actions'] == {'genres:index': 1}
@@ -0,0 +1,59 @@
+import pytest
+
+import fingerprints
+from fingerprints import FingerprintStore
+from service import BulkStoreError, ElasticSaverService
+from state_saver import create_state
+
+
+def sent_count(es) -> int:
+    return sum(body.count('\n') // 2 for body in es.requests)
+
+
+@pytest.fixture
+def service(tmp_path):
+    store = FingerprintStore(str(tmp_path / 'fingerprints.sqlite3'))
+    return ElasticSaverService(state_loader=create_state('memory'), fingerprints=store)
+
+
+def test_unchanged_documents_are_skipped(es, service):
+    docs = [{'id': 'genre-1', 'name': 'Drama'}, {'id': 'genre-2', 'name': 'Comedy'}]
+    service.bulk_store(es, 'genres', docs)
+    assert sent_count(es) == 2
+
+    # Key order does not change the fingerprint.
+    result = service.bulk_store(es, 'genres', [{'name': 'Drama', 'id': 'genre-1'}, {'id': 'genre-2', 'name': 'Horror'}])
+    assert sent_count(es) == 3
+    assert result.success == 1
+    assert es.indices['genres']['genre-2']['name'] == 'Horror'
+
+
+def test_document_elastic_refused_is_sent_again(es, service):
+    es.statuses['genre-1'] = 400
+    with pytest.raises(BulkStoreError):
+        service.bulk_store(es, 'genres', [{'id': 'genre-1', 'name': 'Drama'}])
+
+    es.statuses.clear()
+    service.bulk_store(es, 'genres', [{'id': 'genre-1', 'name': 'Drama'}])
+    assert sent_count(es) == 2
+    assert 'genre-1' in es.indices['genres']
+
+
+def test_partial_update_makes_whole_document_sent_again(es, service):
+    service.bulk_store(es, 'movies', [{'id': 'film-1', 'director': 'Old'}])
+    service.bulk_store(es, 'movies', [{'id': 'film-1', 'director': 'New'}], partial=True)
+    service.bulk_store(es, 'movies', [{'id': 'film-1', 'director': 'Old'}])
+
+    assert sent_count(es) == 3
+    assert es.indices['movies']['film-1']['director'] == 'Old'
+
+
+def test_fingerprints_are_looked_up_by_chunks(tmp_path, monkeypatch):
+    monkeypatch.setattr(fingerprints, 'LOOKUP_CHUNK_SIZE', 3)
+    store = FingerprintStore(str(tmp_path / 'fingerprints.sqlite3'))
+    docs = [{'id': 'person-{0}'.format(number), 'full_name': 'Name'} for number in range(10)]
+    changed_docs, changed_fingerprints = store.changed_documents('persons', docs)
+    store.save('persons', changed_fingerprints)
+
+    changed_docs, _ = store.changed_documents('persons', docs + [{'id': 'person-10', 'full_name': 'Name'}])
+    assert changed_docs == [{'id': 'person-10', 'full_name': 'Name'}]
@@ -0,0 +1,200 @@
+from datetime import datetime
+
+import psycopg2
+import pytest
+from psycopg2.pool import PoolError
+
+from async_service import AsyncPostgresLoaderService
+from backoff import NotRetriedError, backoff
+from postgres_data_query import genres_data_query, genres_query, persons_documents_query, persons_query
+from service import BASE_ID, PostgresLoaderService
+from state_saver import State, create_state
+
+
+class FakeCursor:
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, query, params=None):
+        if self.connection.closed:
+            raise psycopg2.OperationalError('server closed the connection unexpectedly')
+
+    def fetchone(self):
+        return [[]]
+
+    def fetchall(self):
+        return [('row',)]
+
+
+class FakeConnection:
+
+    def __init__(self):
+        self.closed = 0
+
+    def cursor(self, name=None):
+        return FakeCursor(self)
+
+    def rollback(self):
+        pass
+
+
+class FakePool:
+    """Pool of fake connections, postgres is down for `outage` borrows."""
+
+    def __init__(self, outage: int = 0):
+        self.outage = outage
+        self.borrowed = set()
+
+    def getconn(self):
+        if self.outage:
+            self.outage -= 1
+            raise psycopg2.OperationalError('could not connect to server')
+        connection = FakeConnection()
+        self.borrowed.add(connection)
+        return connection
+
+    def putconn(self, connection, broken=False):
+        if connection not in self.borrowed:
+            raise PoolError('trying to put unkeyed connection')
+        self.borrowed.remove(connection)
+
+
+def test_query_is_retried_until_postgres_is_back():
+    pool = FakePool()
+    service = PostgresLoaderService(pool=pool, state_loader=create_state('memory'))
+    assert service._fetchall('SELECT 1') == [('row',)]
+
+    # Connection is dropped, and new connections are refused for more than one retry.
+    service.connection.closed = 2
+    pool.outage = 3
+    fetchall = backoff(start_sleep_time=0.001, factor=1, border_sleep_time=0.001)(service._fetchall)
+
+    assert fetchall('SELECT 1') == [('row',)]
+    assert pool.outage == 0
+    assert pool.borrowed == {service.connection}
+
+
+def test_released_service_borrows_connection_again():
+    pool = FakePool()
+    service = PostgresLoaderService(pool=pool, state_loader=create_state('memory'))
+    service._fetchall('SELECT 1')
+    service.release()
+    assert not pool.borrowed
+
+    assert service._fetchall('SELECT 1') == [('row',)]
+    assert pool.borrowed == {service.connection}
+
+
+def test_failed_query_in_snapshot_is_not_retried():
+    connection = FakeConnection()
+    rollbacks = []
+    connection.rollback = lambda: rollbacks.append(True)
+    service = PostgresLoaderService(connection, in_snapshot=True, state_loader=create_state('memory'))
+    connection.closed = 2
+    fetchall = backoff(start_sleep_time=0.001, factor=1, border_sleep_time=0.001)(service._fetchall)
+
+    with pytest.raises(NotRetriedError):
+        fetchall('SELECT 1')
+    assert not rollbacks
+
+
+def test_lost_connection_without_pool_is_not_retried():
+    connection = FakeConnection()
+    service = PostgresLoaderService(connection, state_loader=create_state('memory'))
+    connection.closed = 2
+    fetchall = backoff(start_sleep_time=0.001, factor=1, border_sleep_time=0.001)(service._fetchall)
+
+    with pytest.raises(NotRetriedError):
+        fetchall('SELECT 1')
+
+
+def changes_service(state: State, changes: dict, **kwargs) -> PostgresLoaderService:
+    """Service reading changed (id, updated_at) rows from `changes` by query, other queries find nothing."""
+    service = PostgresLoaderService(FakeConnection(), state_loader=State(state.storage), **kwargs)
+
+    def fetchall(query, updated_at=None, last_id=None, limit=None):
+        rows = sorted(changes.get(query, []), key=lambda row: (row[1], row[0]))
+        return [row for row in rows if (row[1], row[0]) > (updated_at, last_id)][:limit]
+
+    service._fetchall = fetchall
+    return service
+
+
+def test_interrupted_load_reloads_films_of_genres_changed_after_it():
+    state = create_state('memory')
+    changes = {genres_query: [('genre-1', '2021-01-01 00:00:01'), ('genre-2', '2021-01-01 00:00:02')]}
+    service = changes_service(state, changes, genre_batch_size=1, propagate_genre_renames=True)
+    assert service._changed_genres_ids() == ['genre-1']
+    # Load is interrupted after its first batch was saved.
+    service.state_loader.set_states(service.states_after_save)
+
+    service = changes_service(state, changes, genre_batch_size=1, propagate_genre_renames=True)
+    assert service._changed_genres_ids() == ['genre-2']
+    assert service._changed_genres_ids() == []
+    service.state_loader.set_states(service.states_after_save)
+
+    # Films of all genres are loaded, renames of genres are applied in elastic then.
+    changes[genres_query].append(('genre-1', '2021-01-01 00:00:03'))
+    service = changes_service(state, changes, genre_batch_size=1, propagate_genre_renames=True)
+    assert service._changed_genres_ids() == []
+    assert service.states_after_save['genres_state'] == ['2021-01-01 00:00:03', 'genre-1']
+
+
+def test_interrupted_load_reloads_films_of_persons_changed_after_it():
+    state = create_state('memory')
+    changes = {persons_query: [('person-1', '2021-01-01 00:00:01'), ('person-2', '2021-01-01 00:00:02')]}
+    service = changes_service(state, changes, person_batch_size=1, partial_person_updates=True)
+    assert service._changed_persons_ids() == ['person-1']
+    service.state_loader.set_states(service.states_after_save)
+
+    service = changes_service(state, changes, person_batch_size=1, partial_person_updates=True)
+    assert service.load_filmworks_persons() is None
+    assert service._changed_persons_ids() == ['person-2']
+    assert service._changed_persons_ids() == []
+    service.state_loader.set_states(service.states_after_save)
+
+    # Films of all persons are loaded, cast of their films is updated partially then.
+    changes[persons_query].append(('person-1', '2021-01-01 00:00:03'))
+    service = changes_service(state, changes, person_batch_size=1, partial_person_updates=True)
+    assert service._changed_persons_ids() == []
+    assert service.load_filmworks_persons() == []
+    assert service.states_after_save['persons_state'] == ['2021-01-01 00:00:03', 'person-1']
+
+
+def test_changes_with_equal_updated_at_are_not_skipped_between_batches():
+    state = create_state('memory')
+    changes = {genres_query: [('genre-c', '2021-01-01'), ('genre-a', '2021-01-01'), ('genre-b', '2021-01-01')]}
+    service = changes_service(state, changes, genre_batch_size=2)
+
+    assert service._changed_ids('genres_state', genres_query, 2) == ['genre-a', 'genre-b']
+    assert service.states_after_save['genres_state'] == ['2021-01-01', 'genre-b']
+    assert service._changed_ids('genres_state', genres_query, 2) == ['genre-c']
+    assert service._changed_ids('genres_state', genres_query, 2) == []
+
+
+def test_legacy_state_continues_from_its_updated_at():
+    state = create_state('memory')
+    state.set_state('genres_state', '2021-01-01')
+    changes = {genres_query: [('genre-a', '2020-12-31'), ('genre-b', '2021-01-01'), ('genre-c', '2021-01-02')]}
+    service = changes_service(state, changes)
+
+    assert service._extract_state('genres_state') == ('2021-01-01', BASE_ID)
+    # Rows of the saved updated_at may be loaded again, but none is skipped.
+    assert service._changed_ids('genres_state', genres_query, 10) == ['genre-b', 'genre-c']
+
+
+@pytest.mark.parametrize('query', [genres_query, persons_query, genres_data_query, persons_documents_query])
+def test_keyset_queries_page_on_updated_at_and_id(query):
+    query = ' '.join(query.split())
+    assert '(updated_at, id) > ($1, $2)' in query
+    assert 'ORDER BY updated_at, id' in query
+
+
+def test_async_service_binds_legacy_state_as_datetime():
+    state = create_state('memory')
+    state.set_state('genres_state', '2021-01-01 10:00:00')
+    service = AsyncPostgresLoaderService(None, state_loader=state)
+
+    assert service._state_params('genres_state', 10) == (datetime(2021, 1, 1, 10), BASE_ID, 10)
+    assert service._state_params('persons_state', 10) == (datetime.min, BASE_ID, 10)
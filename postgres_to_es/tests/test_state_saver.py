@@ -0,0 +1,69 @@
+import json
+import os
+
+import pytest
+
+import state_saver
+from state_saver import BaseStorage, JsonFileStorage, SqliteStorage, State
+
+
+class CountingStorage(BaseStorage):
+
+    def __init__(self):
+        self.saved = []
+        self.retrieved = 0
+
+    def save_state(self, state: dict) -> None:
+        self.saved.append(state)
+
+    def retrieve_state(self) -> dict:
+        self.retrieved += 1
+        return {'genres_state': ['2021-01-01 00:00:00', 'genre-1']}
+
+
+def test_states_are_saved_with_one_commit():
+    storage = CountingStorage()
+    state = State(storage)
+    state.set_states({'genres_state': ['2021-01-01 00:00:01', 'genre-2'], 'persons_state': ['2021-01-01', 'p']})
+    state.set_states({})
+
+    assert storage.saved == [{
+        'genres_state': ['2021-01-01 00:00:01', 'genre-2'],
+        'persons_state': ['2021-01-01', 'p'],
+    }]
+    assert state.get_state('genres_state') == ['2021-01-01 00:00:01', 'genre-2']
+    assert storage.retrieved == 1
+
+
+def test_json_state_is_replaced_whole(tmp_path, monkeypatch):
+    file_path = str(tmp_path / 'state.json')
+    storage = JsonFileStorage(file_path)
+    storage.save_state({'genres_state': 'old'})
+    replaced = []
+
+    def replace(src, dst):
+        replaced.append((src, dst))
+        os.rename(src, dst)
+
+    monkeypatch.setattr(state_saver.os, 'replace', replace)
+
+    storage.save_state({'genres_state': 'new'})
+    assert replaced == [(file_path + '.tmp', file_path)]
+    assert storage.retrieve_state() == {'genres_state': 'new'}
+
+    def broken_dump(state, state_file):
+        state_file.write('{"genres_state": ')
+        raise OSError('No space left on device')
+
+    monkeypatch.setattr(state_saver.json, 'dump', broken_dump)
+    with pytest.raises(OSError):
+        storage.save_state({'genres_state': 'newer'})
+    with open(file_path) as state_file:
+        assert json.load(state_file) == {'genres_state': 'new'}
+
+
+def test_sqlite_state_is_kept_between_runs(tmp_path):
+    file_path = str(tmp_path / 'state.sqlite3')
+    State(SqliteStorage(file_path)).set_states({'genres_state': ['2021-01-01 00:00:00', 'genre-1']})
+    state = State(SqliteStorage(file_path))
+    assert state.get_state('genres_state') == ['2021-01-01 00:00:00', 'genre-1']
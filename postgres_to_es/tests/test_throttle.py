@@ -0,0 +1,63 @@
+import time
+
+import pytest
+
+from throttle import BulkThrottle
+
+
+@pytest.fixture
+def throttle():
+    return BulkThrottle(
+        chunk_size=500,
+        thread_count=4,
+        min_chunk_size=50,
+        max_chunk_size=600,
+        chunk_step=50,
+        max_thread_count=5,
+        latency_target=1.0,
+        decrease_factor=0.5,
+        breaker_threshold=3,
+        breaker_timeout=0.2,
+    )
+
+
+def test_limits_grow_additively_up_to_maximums(throttle):
+    throttle.record(seconds=0.1, requests=4)
+    assert throttle.limits() == (550, 5)
+    throttle.record(seconds=0.1, requests=4)
+    throttle.record(seconds=0.1, requests=4)
+    assert throttle.limits() == (600, 5)
+
+
+def test_limits_shrink_multiplicatively_on_rejections_and_slow_requests(throttle):
+    throttle.record(seconds=0.1, requests=4, rejected=1)
+    assert throttle.limits() == (250, 2)
+    # Two waves of two requests in 3 seconds are slower than the latency target.
+    throttle.record(seconds=3.0, requests=4)
+    assert throttle.limits() == (125, 1)
+    throttle.record(seconds=0.1, requests=1)
+    assert throttle.limits() == (175, 2)
+    assert throttle.overloads == 0
+
+
+def test_breaker_opens_lets_one_round_through_and_closes(throttle):
+    for _ in range(3):
+        throttle.record_overload()
+    assert throttle.opened_until > time.monotonic()
+
+    # Open: requests wait for the timeout, then the half-open round is sent with the lowest limits.
+    started = time.monotonic()
+    assert throttle.limits() == (50, 1)
+    assert time.monotonic() - started >= 0.15
+
+    # Overloaded half-open round opens the breaker again.
+    throttle.record(seconds=0.1, requests=1, rejected=1)
+    assert throttle.opened_until > time.monotonic()
+    assert throttle.limits() == (50, 1)
+
+    # Healthy round closes it, limits grow again and requests are not delayed.
+    throttle.record(seconds=0.1, requests=1)
+    started = time.monotonic()
+    assert throttle.limits() == (100, 2)
+    assert time.monotonic() - started < 0.1
+    assert throttle.overloads == 0
@@ -0,0 +1,35 @@
+import pytest
+
+from postgres_schemas import MovieData, PersonFilm
+from service import TransformDataService
+
+
+def transform(movie: MovieData, **kwargs) -> list:
+    cast = [PersonFilm(movie.id, 'person-1', 'actor', 'Actor Name', None)]
+    return TransformDataService(**kwargs).transform_filmworks_data([movie], cast)
+
+
+def test_film_without_genres_has_empty_genre_in_both_modes():
+    movie = MovieData('film-1', 'Title', None, None, [None])
+    expected = [{
+        'id': 'film-1',
+        'imdb_rating': None,
+        'genre': [],
+        'title': 'Title',
+        'description': None,
+        'director': None,
+        'actors_names': ['Actor Name'],
+        'writers_names': [],
+        'actors': [{'id': 'person-1', 'name': 'Actor Name'}],
+        'writers': [],
+    }]
+
+    assert transform(movie) == expected
+    assert transform(movie, fast=True) == expected
+    assert transform(movie, fast=True, strict=True) == expected
+
+
+def test_fast_mode_checks_required_fields_without_sampling():
+    movie = MovieData('film-1', None, None, 8.5, ['Drama'])
+    with pytest.raises(ValueError):
+        transform(movie, fast=True, sample_rate=0.0)